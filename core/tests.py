@@ -1,3 +1,62 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.test import Client, override_settings
+from django.urls import reverse
 
-# Create your tests here.
+from room.perf import PerformanceTestCase, timing_test
+
+# Performance regression tests of the core pages: query budgets with more
+# users in the database at each size, and timing baselines with
+# DJANGO_PERF_TIMINGS=1 (see room/perf.py).
+
+USER_COUNTS = (10, 1000)
+
+
+def grow_users(count):
+    """Add users until there are at least ``count``."""
+    existing = User.objects.count()
+    User.objects.bulk_create([User(username=f'perf_user{i:05d}') for i in range(existing, count)])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PageQueryTests(PerformanceTestCase):
+    sizes = USER_COUNTS
+
+    def get(self, name, client=None):
+        response = (client or self.client).get(reverse(name))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_anonymous_pages(self):
+        for name in ('frontpage', 'login', 'signup'):
+            self.assertQueryBudget(name, 0, lambda size: self.get(name), setup=grow_users)
+
+    def test_frontpage_logged_in(self):
+        client = Client()
+        client.force_login(User.objects.create_user('member'))
+        self.assertQueryBudget(
+            'frontpage (logged in)', 2, lambda size: self.get('frontpage', client), setup=grow_users
+        )
+
+    def test_signup(self):
+        def signup(size):
+            client = Client()
+            response = client.post(reverse('signup'), {
+                'username': f'new_user{size}',
+                'email': f'new_user{size}@example.com',
+                'password1': 'correct-horse-battery',
+                'password2': 'correct-horse-battery',
+            })
+            self.assertRedirects(response, reverse('frontpage'), fetch_redirect_response=False)
+
+        self.assertQueryBudget('signup', 11, signup, setup=grow_users)
+
+
+@timing_test
+class PageTimingTests(PerformanceTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        grow_users(max(USER_COUNTS))
+
+    def test_timings(self):
+        for name in ('frontpage', 'login', 'signup'):
+            self.assertTimingBaseline(name, lambda: self.client.get(reverse(name)))
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 from re import A
 
@@ -51,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'room.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'djangochat.urls'
@@ -76,7 +78,38 @@ ASGI_APPLICATION = 'djangochat.asgi.application'
 
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            # Channels shared by a worker's sockets (room/hubs.py) take bursts for all of them
+            'channel_capacity': {'hub.*': 10000},
+        },
+    }
+}
+
+# Serve ws/chat/ with room.consumers.LeanChatConsumer, which shares group
+# subscriptions per worker and keeps little state per idle socket.
+LEAN_CHAT_CONSUMER = os.environ.get('DJANGO_LEAN_CHAT_CONSUMER') == '1'
+
+# Chat sockets are pinged after HEARTBEAT_INTERVAL seconds of silence and
+# evicted without an answer within HEARTBEAT_TIMEOUT. IDLE_TIMEOUT, if set,
+# also closes sockets that send no chat frames for that long (see
+# room/heartbeat.py).
+HEARTBEAT_INTERVAL = float(os.environ.get('DJANGO_HEARTBEAT_INTERVAL', '30'))
+HEARTBEAT_TIMEOUT = float(os.environ.get('DJANGO_HEARTBEAT_TIMEOUT', '10'))
+IDLE_TIMEOUT = float(os.environ['DJANGO_IDLE_TIMEOUT']) if os.environ.get('DJANGO_IDLE_TIMEOUT') else None
+
+# Room affinity: each worker's name, e.g. "a". The proxy in front of the
+# site routes /workers/<name>/ to that worker, so its sockets stay on the
+# site's origin and keep the session cookie. Rooms are spread over the
+# registered workers by consistent hashing and their sockets are sent to
+# the room's worker (see room/affinity.py).
+CHAT_WORKER_NAME = os.environ.get('DJANGO_CHAT_WORKER_NAME') or None
+
+# Room and membership lookups are cached (see room/cache.py). Use a shared
+# backend such as Redis or Memcached when running more than one process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
@@ -96,6 +129,46 @@ DATABASES = {
     }
 }
 
+# Messages can be split across several SQLite files by room id to spread
+# write locks (see room/routers.py). Each shard must be migrated with
+# `manage.py migrate --database messages_<n>`.
+MESSAGE_SHARDS = int(os.environ.get('DJANGO_MESSAGE_SHARDS', '0'))
+
+for shard in range(MESSAGE_SHARDS):
+    DATABASES[f'messages_{shard}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'messages_{shard}.sqlite3',
+    }
+
+if MESSAGE_SHARDS:
+    DATABASE_ROUTERS = ['room.routers.MessageShardRouter']
+
+# When set, new messages are acknowledged once written to an append-only
+# journal in this directory and stored in the database in the background
+# (see room/journal.py).
+MESSAGE_JOURNAL_DIR = os.environ.get('DJANGO_MESSAGE_JOURNAL_DIR')
+
+# Per-room message sequence numbers are taken one at a time from the room's
+# RoomSequence row, so they increase across worker processes. Larger blocks
+# save a query per message but only keep numbers in order within a process;
+# use them with a single worker only (see room/sequence.py).
+MESSAGE_SEQ_BLOCK_SIZE = int(os.environ.get('DJANGO_MESSAGE_SEQ_BLOCK_SIZE', '1'))
+
+# Opt-in cProfile sampling of views and websocket events (see
+# room/profiling.py). Profiling is off unless PROFILING_DIR is set.
+PROFILING_DIR = os.environ.get('DJANGO_PROFILING_DIR')
+PROFILING_SAMPLE_RATE = float(os.environ.get('DJANGO_PROFILING_SAMPLE_RATE', '0'))
+PROFILING_USERS = [name for name in os.environ.get('DJANGO_PROFILING_USERS', '').split(',') if name]
+
+# Per-stage latency tracing of chat messages (see room/tracing.py).
+MESSAGE_TRACING = os.environ.get('DJANGO_MESSAGE_TRACING') == '1'
+
+# Timing baselines of the performance regression tests (see room/perf.py).
+PERF_TIMINGS = os.environ.get('DJANGO_PERF_TIMINGS') == '1'
+PERF_BASELINE_FILE = os.environ.get('DJANGO_PERF_BASELINE_FILE', BASE_DIR / 'perf_baselines.json')
+PERF_REGRESSION_THRESHOLD = float(os.environ.get('DJANGO_PERF_REGRESSION_THRESHOLD', '0.5'))
+PERF_UPDATE_BASELINES = os.environ.get('DJANGO_PERF_UPDATE_BASELINES') == '1'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
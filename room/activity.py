@@ -0,0 +1,86 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import Room
+
+# Sending a message used to save the whole Room row just to bump
+# last_activity. Activity is now recorded in memory and written back as a
+# single-column UPDATE at most once per interval per room.
+
+FLUSH_INTERVAL = getattr(settings, 'ROOM_ACTIVITY_FLUSH_INTERVAL', 5)
+
+_lock = threading.Lock()
+_pending = {}
+_last_flushed = {}
+_timer = None
+
+
+def touch(room_id, when=None):
+    """Record activity in a room, writing it out if the interval has passed."""
+    when = when or timezone.now()
+    with _lock:
+        previous = _pending.get(room_id)
+        if previous is None or when > previous:
+            _pending[room_id] = when
+        due = _take_due(time.monotonic(), only=room_id)
+        if not due:
+            _schedule()
+    for room_id, when in due.items():
+        _write(room_id, when)
+
+
+def flush(force=True):
+    """Write out pending activity. Returns the number of rooms updated.
+
+    With force=False only rooms whose interval has passed are written.
+    """
+    with _lock:
+        if force:
+            due = dict(_pending)
+            _pending.clear()
+            now = time.monotonic()
+            for room_id in due:
+                _last_flushed[room_id] = now
+        else:
+            due = _take_due(time.monotonic())
+    for room_id, when in due.items():
+        _write(room_id, when)
+    return len(due)
+
+
+def _take_due(now, only=None):
+    room_ids = [only] if only is not None else list(_pending)
+    due = {}
+    for room_id in room_ids:
+        if now - _last_flushed.get(room_id, 0) >= FLUSH_INTERVAL:
+            due[room_id] = _pending.pop(room_id)
+            _last_flushed[room_id] = now
+    return due
+
+
+def _schedule():
+    global _timer
+    if _timer is None:
+        _timer = threading.Timer(FLUSH_INTERVAL, _flush_in_thread)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _write(room_id, when):
+    Room.objects.filter(pk=room_id, last_activity__lt=when).update(last_activity=when)
+
+
+def _flush_in_thread():
+    global _timer
+    try:
+        flush(force=False)
+    finally:
+        close_old_connections()
+        with _lock:
+            _timer = None
+            if _pending:
+                _schedule()
@@ -1,6 +1,187 @@
 from django.contrib import admin
-from .models import Room
+from django.contrib.admin.views.main import PAGE_VAR
+from django.core.paginator import Paginator
+from django.db import OperationalError, connections
+from django.db.models import prefetch_related_objects
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
 
-# Register your models here.
+from .models import Invitation, Message, Room, RoomHour
+from .routers import message_databases, message_db_for_room, message_shards
 
-admin.site.register(Room)  
\ No newline at end of file
+# The message and invitation tables are too large for the default admin
+# changelist. These admins never run an exact COUNT(*) and page by primary
+# key ("before=<id>") instead of OFFSET, always ordering newest first. They
+# never join users onto messages, since messages may live in another
+# database.
+
+ESTIMATE_CAP = 10000
+
+
+def estimated_row_count(model, using):
+    """Row count from ANALYZE statistics, or the id range if there are none."""
+    table = model._meta.db_table
+    with connections[using].cursor() as cursor:
+        try:
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            row = cursor.fetchone()
+        except OperationalError:
+            row = None
+        if row:
+            return int(row[0].split()[0])
+        cursor.execute(f'SELECT COALESCE(MAX(id) - MIN(id) + 1, 0) FROM {table}')
+        return cursor.fetchone()[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            return estimated_row_count(queryset.model, queryset.db)
+        # Filtered: count at most ESTIMATE_CAP rows
+        return queryset.order_by()[:ESTIMATE_CAP].count()
+
+
+class BeforeIdFilter(admin.SimpleListFilter):
+    """Keyset pagination: show rows older than the given id."""
+    title = 'before'
+    parameter_name = 'before'
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(pk__lt=self.value())
+
+
+class MessageDatabaseFilter(admin.SimpleListFilter):
+    """Messages are listed one shard at a time, the first unless another is picked."""
+    title = 'message shard'
+    parameter_name = 'db'
+
+    def lookups(self, request, model_admin):
+        return [(db, db) for db in message_shards()]
+
+    def value(self):
+        value = super().value()
+        return value if value in message_databases() else message_databases()[0]
+
+    def queryset(self, request, queryset):
+        return queryset.using(self.value())
+
+    def choices(self, changelist):
+        # No "All": paging by id only holds within one shard
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': self.value() == lookup,
+                'query_string': changelist.get_query_string(
+                    {self.parameter_name: lookup}, remove=[BeforeIdFilter.parameter_name, PAGE_VAR]
+                ),
+                'display': title,
+            }
+
+
+class KeysetAdmin(admin.ModelAdmin):
+    change_list_template = 'admin/room/keyset_change_list.html'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-id',)
+    sortable_by = ()
+    list_per_page = 100
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        changelist.result_list = list(changelist.result_list)
+        self.prefetch_results(changelist.result_list)
+        if len(changelist.result_list) >= self.list_per_page:
+            changelist.older_query_string = changelist.get_query_string(
+                {BeforeIdFilter.parameter_name: changelist.result_list[-1].pk}, remove=[PAGE_VAR]
+            )
+        changelist.newest_query_string = changelist.get_query_string(remove=[BeforeIdFilter.parameter_name, PAGE_VAR])
+        return changelist
+
+    def prefetch_results(self, results):
+        pass
+
+
+@admin.register(Room)
+class RoomAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'is_private', 'participant_count', 'created_by', 'last_activity')
+    list_select_related = ('created_by',)
+    list_filter = ('is_private',)
+    search_fields = ('name', 'slug')
+    raw_id_fields = ('created_by', 'participants')
+    ordering = ('-last_activity',)
+
+
+@admin.register(Message)
+class MessageAdmin(KeysetAdmin):
+    list_display = ('id', 'room_link', 'user', 'target_user', 'short_content', 'date_added')
+    list_filter = (MessageDatabaseFilter, BeforeIdFilter)
+    # An empty tuple stops the changelist from joining room and user; they
+    # are prefetched instead
+    list_select_related = ()
+    autocomplete_fields = ('room',)
+    raw_id_fields = ('user', 'target_user', 'read_by_users')
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        if message_shards():
+            changelist.listed_database = changelist.queryset.db
+        return changelist
+
+    def get_object(self, request, object_id, from_field=None):
+        # The change page gets no shard filter, so look in every database
+        for db in message_databases():
+            queryset = self.get_queryset(request).using(db)
+            try:
+                return queryset.get(pk=self.model._meta.pk.to_python(object_id))
+            except (self.model.DoesNotExist, ValueError):
+                continue
+        return None
+
+    def prefetch_results(self, results):
+        prefetch_related_objects(results, 'room', 'user', 'target_user')
+
+    @admin.display(description='room')
+    def room_link(self, message):
+        url = reverse('admin:room_message_changelist')
+        query = f'room__id__exact={message.room_id}'
+        if message_shards():
+            query += f'&{MessageDatabaseFilter.parameter_name}={message_db_for_room(message.room_id)}'
+        return format_html('<a href="{}?{}">{}</a>', url, query, message.room.name)
+
+    @admin.display(description='content')
+    def short_content(self, message):
+        return message.content[:80]
+
+
+@admin.register(Invitation)
+class InvitationAdmin(KeysetAdmin):
+    list_display = ('id', 'room', 'invited_user', 'invited_by', 'status', 'created_at', 'expires_at')
+    list_select_related = ('room', 'invited_user', 'invited_by')
+    list_filter = ('status', BeforeIdFilter)
+    autocomplete_fields = ('room',)
+    raw_id_fields = ('invited_by', 'invited_user')
+
+
+@admin.register(RoomHour)
+class RoomHourAdmin(KeysetAdmin):
+    """Read-only view of the hourly analytics rollup."""
+    list_display = ('hour', 'room', 'message_count', 'sender_count', 'targeted_count', 'dm_ratio')
+    list_select_related = ('room',)
+    list_filter = (BeforeIdFilter,)
+    raw_id_fields = ('room',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description='DM ratio')
+    def dm_ratio(self, row):
+        return f'{row.dm_ratio:.1%}'
@@ -0,0 +1,200 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.utils import timezone
+
+from . import ticks
+from .models import ChatWorker
+
+logger = logging.getLogger(__name__)
+
+# Room affinity: with several ASGI workers, a room's sockets spread over
+# all of them and every group_send crosses processes. With CHAT_WORKER_NAME
+# set, every worker registers itself in the ChatWorker table and rooms are
+# assigned to live workers by consistent hashing of their slug. A worker is
+# reached through the site's own origin, at /workers/<name>/, which the
+# proxy routes to it: the browser then sends the session cookie as for any
+# other socket. The room page connects straight to the room's worker, and
+# a worker asked for a room it does not serve hands the socket off: it
+# sends {"type": "handoff", "url": <path>} and closes, and the client
+# reconnects there. Workers re-read the registry every CHAT_WORKER_REFRESH
+# seconds; when one joins or leaves, only the rooms on its arcs of the ring
+# move, and their open sockets are handed off to the new owner.
+
+WORKER_NAME = getattr(settings, 'CHAT_WORKER_NAME', None)
+if WORKER_NAME is not None and not re.fullmatch(r'[-\w]+', WORKER_NAME):
+    raise ImproperlyConfigured(f'CHAT_WORKER_NAME must be letters, digits, "-" or "_", not {WORKER_NAME!r}.')
+# This worker's path prefix on the site's origin; the registry and the ring hold these
+WORKER_URL = f'/workers/{WORKER_NAME}' if WORKER_NAME else None
+REFRESH = getattr(settings, 'CHAT_WORKER_REFRESH', 5.0)
+# Workers not seen for this many seconds are left out of the ring
+WORKER_TTL = getattr(settings, 'CHAT_WORKER_TTL', 30)
+# Points per worker on the ring; more spread the rooms more evenly
+REPLICAS = 100
+# Close code sent to sockets handed off to another worker
+HANDOFF_CLOSE_CODE = 4001
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes.
+
+    A key belongs to the first node point at or after its hash. Adding or
+    removing a node only moves the keys on that node's arcs.
+    """
+
+    def __init__(self, nodes=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self.nodes = set()
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = ring_hash(f'{node}#{replica}')
+            # On the rare collision the point stays with its first node
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+                self._owners[point] = node
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self._points = [point for point in self._points if self._owners[point] != node]
+        self._owners = {point: self._owners[point] for point in self._points}
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect_left(self._points, ring_hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+_lock = threading.Lock()
+_ring = HashRing()
+_refreshed = None
+# Room slug -> this worker's sockets in the room
+_sockets = {}
+
+
+def enabled():
+    return bool(WORKER_URL)
+
+
+def register(now):
+    """Record that this worker is alive."""
+    connection = connections['default']
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {ChatWorker._meta.db_table} (url, last_seen) VALUES (%s, %s) '
+            f'ON CONFLICT (url) DO UPDATE SET last_seen = excluded.last_seen',
+            [WORKER_URL, connection.ops.adapt_datetimefield_value(now)]
+        )
+
+
+def current_ring():
+    """The ring of live workers, re-read from the registry at most every REFRESH seconds."""
+    global _ring, _refreshed
+    with _lock:
+        now = time.monotonic()
+        if _refreshed is None or now - _refreshed >= REFRESH:
+            _refreshed = now
+            when = timezone.now()
+            register(when)
+            workers = set(ChatWorker.objects.filter(
+                last_seen__gte=when - timezone.timedelta(seconds=WORKER_TTL)
+            ).values_list('url', flat=True))
+            # Readers in other threads keep the ring they have
+            if workers != _ring.nodes:
+                _ring = HashRing(workers)
+        return _ring
+
+
+def expire_ring():
+    """Have the next lookup re-read the worker registry instead of waiting out REFRESH."""
+    global _refreshed
+    with _lock:
+        _refreshed = None
+
+
+def socket_url(room_slug):
+    """The websocket path of the worker serving the room, or None without affinity."""
+    if not enabled():
+        return None
+    return f'{current_ring().node_for(room_slug)}/ws/chat/{room_slug}/'
+
+
+def handoff_url(room_slug):
+    """The path where a socket for the room belongs, if that is not this worker."""
+    if not enabled():
+        return None
+    worker = current_ring().node_for(room_slug)
+    if worker == WORKER_URL:
+        return None
+    return f'{worker}/ws/chat/{room_slug}/'
+
+
+async def ahandoff_url(room_slug):
+    if not enabled():
+        return None
+    return await database_sync_to_async(handoff_url)(room_slug)
+
+
+def handoff_frame(url):
+    return {'type': 'handoff', 'url': url}
+
+
+def add(socket, room_slug):
+    """Track a socket so that it can be handed off if its room moves; sockets need async ``handoff(url)``."""
+    if not enabled():
+        return
+    _sockets.setdefault(room_slug, set()).add(socket)
+    ticks.ensure_periodic('affinity', REFRESH, rebalance)
+
+
+def discard(socket, room_slug):
+    sockets = _sockets.get(room_slug)
+    if sockets is not None:
+        sockets.discard(socket)
+        if not sockets:
+            del _sockets[room_slug]
+
+
+async def rebalance(channel_layer=None):
+    """Hand off this worker's sockets in rooms that the ring has moved elsewhere."""
+    room_slugs = list(_sockets)
+    moved = await database_sync_to_async(
+        lambda: {room_slug: handoff_url(room_slug) for room_slug in room_slugs}
+    )()
+    results = await asyncio.gather(
+        *(
+            socket.handoff(url)
+            for room_slug, url in moved.items() if url is not None
+            for socket in list(_sockets.get(room_slug, ()))
+        ),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning('Handoff failed', exc_info=result)
@@ -0,0 +1,95 @@
+from datetime import timezone as dt_timezone
+
+from django.db import connections, transaction
+
+from .models import Message, RoomHour, RoomHourSender
+
+# Hourly per-room analytics (messages, direct messages, active senders) are
+# rolled up from the message write path: every messages_stored batch turns
+# into one upsert per touched hour and sender, so dashboards never run a
+# GROUP BY over the message table. Pruning old messages leaves the
+# analytics alone; they are history. rebuild() replays the message tables
+# in chunks through the same code for backfills.
+
+BACKFILL_CHUNK_SIZE = 5000
+ANALYTICS_FIELDS = ('id', 'room_id', 'user_id', 'is_targeted', 'date_added')
+
+
+def message_hour(message_date):
+    return message_date.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def messages_added(messages):
+    hours = {}
+    senders = {}
+    for message in messages:
+        key = (message.room_id, message_hour(message.date_added))
+        count, targeted = hours.get(key, (0, 0))
+        hours[key] = (count + 1, targeted + message.is_targeted)
+        sender_key = key + (message.user_id,)
+        senders[sender_key] = senders.get(sender_key, 0) + 1
+    if not hours:
+        return
+
+    connection = connections['default']
+    adapt = connection.ops.adapt_datetimefield_value
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {RoomHourSender._meta.db_table} (room_id, hour, user_id, message_count) '
+            f'VALUES (%s, %s, %s, %s) ON CONFLICT (room_id, hour, user_id) DO UPDATE SET '
+            f'message_count = message_count + excluded.message_count',
+            [(room_id, adapt(hour), user_id, count) for (room_id, hour, user_id), count in senders.items()]
+        )
+        cursor.executemany(
+            f'INSERT INTO {RoomHour._meta.db_table} (room_id, hour, message_count, targeted_count, sender_count) '
+            f'VALUES (%s, %s, %s, %s, 0) ON CONFLICT (room_id, hour) DO UPDATE SET '
+            f'message_count = message_count + excluded.message_count, '
+            f'targeted_count = targeted_count + excluded.targeted_count',
+            [(room_id, adapt(hour), count, targeted) for (room_id, hour), (count, targeted) in hours.items()]
+        )
+        cursor.executemany(
+            f'UPDATE {RoomHour._meta.db_table} SET sender_count = ('
+            f'SELECT COUNT(*) FROM {RoomHourSender._meta.db_table} s '
+            f'WHERE s.room_id = %s AND s.hour = %s) WHERE room_id = %s AND hour = %s',
+            [(room_id, adapt(hour), room_id, adapt(hour)) for room_id, hour in hours]
+        )
+
+
+def room_hours(room_id, start, end):
+    """Rollup rows for a room from ``start`` up to (not including) ``end``."""
+    return RoomHour.objects.filter(room_id=room_id, hour__gte=start, hour__lt=end).order_by('hour')
+
+
+def clear(room_ids=None):
+    for model in (RoomHour, RoomHourSender):
+        rows = model.objects.all()
+        if room_ids is not None:
+            rows = rows.filter(room_id__in=room_ids)
+        rows.delete()
+
+
+def rebuild(using, room_ids=None, chunk_size=BACKFILL_CHUNK_SIZE, progress=None):
+    """Replay one message database into the rollups in id-ordered chunks.
+
+    Clear the rollups first (see clear()). Messages written while this runs
+    are already counted by the write path, so only ids up to the maximum
+    seen at the start are replayed. Returns the number of messages replayed.
+    """
+    messages = Message.objects.using(using).order_by('id')
+    if room_ids is not None:
+        messages = messages.filter(room_id__in=room_ids)
+    last_id = messages.values_list('id', flat=True).last()
+    if last_id is None:
+        return 0
+
+    replayed = 0
+    after = 0
+    while True:
+        chunk = list(messages.filter(id__gt=after, id__lte=last_id).only(*ANALYTICS_FIELDS)[:chunk_size])
+        if not chunk:
+            return replayed
+        messages_added(chunk)
+        replayed += len(chunk)
+        after = chunk[-1].id
+        if progress:
+            progress(replayed)
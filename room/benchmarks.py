@@ -0,0 +1,190 @@
+import asyncio
+import gc
+import random
+import tracemalloc
+from collections import Counter
+
+from channels.layers import get_channel_layer
+
+from . import inbox, receipts, unread
+
+# Memory cost of idle websocket connections. Sockets are opened straight
+# against a consumer's ASGI app, each with a receive queue and a send that
+# drops frames, and left idle once they have been accepted. Python
+# allocations are traced with tracemalloc while they are open, so the
+# figures leave out the server's own per-socket buffers.
+
+SETTLE_ROUNDS = 100
+
+
+class IdleSocket:
+    __slots__ = ('inbox', 'task')
+
+    def __init__(self, inbox, task):
+        self.inbox = inbox
+        self.task = task
+
+
+async def open_socket(app, scope):
+    """Connect to ``app``; returns the IdleSocket, or None if it was rejected."""
+    loop = asyncio.get_running_loop()
+    handshake = loop.create_future()
+    connected = loop.create_future()
+    inbox = asyncio.Queue()
+    receives = 0
+
+    async def receive():
+        nonlocal receives
+        receives += 1
+        # Asked for the next message: done with the connect, which may go on past the accept
+        if receives == 2 and not connected.done():
+            connected.set_result(None)
+        return await inbox.get()
+
+    async def send(message):
+        if not handshake.done():
+            handshake.set_result(message['type'] == 'websocket.accept')
+
+    inbox.put_nowait({'type': 'websocket.connect'})
+    task = loop.create_task(app(scope, receive, send))
+    if not await handshake:
+        inbox.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+        await task
+        return None
+    await asyncio.wait([connected, task], return_when=asyncio.FIRST_COMPLETED)
+    return IdleSocket(inbox, task)
+
+
+async def close_socket(socket):
+    socket.inbox.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+    await socket.task
+
+
+async def settle():
+    """Let queued group events drain until the layer has nothing left to deliver."""
+    channel_layer = get_channel_layer()
+    for _ in range(SETTLE_ROUNDS):
+        await asyncio.sleep(0)
+        if not any(queue.qsize() for queue in getattr(channel_layer, 'channels', {}).values()):
+            return
+
+
+def chat_scope(user, room_slug):
+    return {
+        'type': 'websocket',
+        'path': f'/ws/chat/{room_slug}/',
+        'query_string': b'',
+        'headers': [],
+        'subprotocols': [],
+        'user': user,
+        'url_route': {'args': (), 'kwargs': {'room_name': room_slug}},
+    }
+
+
+async def measure_idle_connections(app, users, room_slugs):
+    """Open one idle chat socket per user, spread over the rooms, and measure them.
+
+    Returns a dict with the number of sockets, the traced bytes and asyncio
+    tasks per socket.
+    """
+    # One-off setup on first use (database connections, caches) is not per socket
+    socket = await open_socket(app, chat_scope(users[0], room_slugs[0]))
+    if socket is not None:
+        await close_socket(socket)
+    # Nor are pushes batched by earlier traffic, which a tick would send mid-measurement
+    channel_layer = get_channel_layer()
+    for module in (unread, receipts, inbox):
+        await module.flush(channel_layer)
+    await settle()
+
+    gc.collect()
+    tasks_before = len(asyncio.all_tasks())
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        sockets = []
+        for index, user in enumerate(users):
+            socket = await open_socket(app, chat_scope(user, room_slugs[index % len(room_slugs)]))
+            if socket is None:
+                raise ValueError(f'{user} was not allowed into {room_slugs[index % len(room_slugs)]}')
+            sockets.append(socket)
+            # Join notices pile up in the layer otherwise
+            await settle()
+        await settle()
+        gc.collect()
+        traced = tracemalloc.get_traced_memory()[0] - before
+        tasks = len(asyncio.all_tasks()) - tasks_before
+    finally:
+        tracemalloc.stop()
+
+    for socket in sockets:
+        await close_socket(socket)
+    await settle()
+    return {
+        'connections': len(sockets),
+        'bytes_per_connection': traced / len(sockets),
+        'tasks_per_connection': tasks / len(sockets),
+    }
+
+
+async def idle_app(scope, receive, send):
+    """The least an ASGI websocket app can hold: accept, then wait for the disconnect."""
+    while True:
+        message = await receive()
+        if message['type'] == 'websocket.connect':
+            await send({'type': 'websocket.accept'})
+        elif message['type'] == 'websocket.disconnect':
+            return
+
+
+def connections_per_worker(bytes_per_connection, memory_budget):
+    return int(memory_budget // bytes_per_connection) if bytes_per_connection > 0 else None
+
+
+# Cross-process fan-out, as a model rather than a measurement: nothing is
+# sent and no worker process runs. Rooms with a fixed number of sockets are
+# placed on workers either at random, as behind a plain load balancer, or
+# all on the worker a HashRing picks for the room (see room/affinity.py).
+# Messages go from a random socket to every socket in the room, the way
+# group_send delivers them, and the model counts which deliveries would
+# cross processes. It says nothing of the channel layer's own cost per hop.
+
+
+def model_fanout(workers, rooms, members, messages, ring=None, seed=0):
+    """Count the modelled deliveries of ``messages`` chat messages that would cross worker processes.
+
+    Returns a dict with the deliveries, those to sockets on another worker
+    than the sender's (one per socket channel, as with ChatConsumer), the
+    other workers reached (one per worker hub, as with LeanChatConsumer),
+    and the busiest worker's share of the sockets.
+    """
+    rng = random.Random(seed)
+    placement = {}
+    for room in rooms:
+        if ring is None:
+            placement[room] = Counter(rng.choice(workers) for _ in range(members))
+        else:
+            placement[room] = Counter({ring.node_for(room): members})
+
+    deliveries = cross_process = worker_hops = 0
+    for _ in range(messages):
+        sockets = placement[rng.choice(rooms)]
+        sender = rng.choices(list(sockets), weights=list(sockets.values()))[0]
+        deliveries += members
+        cross_process += members - sockets[sender]
+        worker_hops += len(sockets) - 1
+
+    load = Counter()
+    for sockets in placement.values():
+        load.update(sockets)
+    return {
+        'deliveries': deliveries,
+        'cross_process': cross_process,
+        'worker_hops': worker_hops,
+        'busiest_worker_share': max(load.values()) / sum(load.values()),
+    }
+
+
+def moved_rooms(rooms, before, after):
+    """The fraction of rooms that ``after`` assigns to another worker than ``before``."""
+    return sum(before(room) != after(room) for room in rooms) / len(rooms)
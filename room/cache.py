@@ -0,0 +1,161 @@
+import time
+
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import Http404
+
+from .models import Message, Room
+
+# Rooms are looked up by slug on every request and websocket connect, and
+# membership is checked on most of them. Both are cached here and kept
+# consistent by the receivers in room/signals.py.
+
+CACHE_TIMEOUT = 60 * 60
+
+# Columns written with queryset.update() bypass post_save, so they are left
+# out of the cached row and load from the database if accessed.
+VOLATILE_FIELDS = ('last_activity', 'participant_count')
+
+RoomMembership = Room.participants.through
+
+
+def _room_key(slug):
+    return f'room:slug:{slug}'
+
+
+def _version_key(room_id, kind):
+    return f'room:{room_id}:{kind}_version'
+
+
+def _member_key(room_id, version, user_id):
+    return f'room:{room_id}:member:{version}:{user_id}'
+
+
+def _cached_field_names():
+    return [
+        field.attname for field in Room._meta.concrete_fields
+        if field.attname not in VOLATILE_FIELDS
+    ]
+
+
+def _room_from_cache_data(data):
+    field_names = _cached_field_names()
+    return Room.from_db(Room.objects.db, field_names, [data[name] for name in field_names])
+
+
+def get_room(slug):
+    """Return the room with the given slug, or None if it does not exist."""
+    key = _room_key(slug)
+    data = cache.get(key)
+    if data is None:
+        data = Room.objects.filter(slug=slug).values(*_cached_field_names()).first()
+        if data is None:
+            return None
+        cache.set(key, data, CACHE_TIMEOUT)
+    return _room_from_cache_data(data)
+
+
+def get_room_or_404(slug):
+    """Cached replacement for get_object_or_404(Room, slug=slug)."""
+    room = get_room(slug)
+    if room is None:
+        raise Http404('No Room matches the given query.')
+    return room
+
+
+def invalidate_room(slug):
+    cache.delete(_room_key(slug))
+
+
+def _version(room_id, kind):
+    key = _version_key(room_id, kind)
+    version = cache.get(key)
+    if version is None:
+        # Seed from the clock so an evicted version never reuses old keys.
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(room_id, kind):
+    key = _version_key(room_id, kind)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = time.time_ns()
+        cache.set(key, version, None)
+        return version
+
+
+# Versions change whenever the corresponding room state changes. They are
+# part of cache keys, so bumping one invalidates every entry built on it,
+# and they double as HTTP validators.
+
+def room_version(room_id):
+    """Changes whenever the room itself is saved (name, privacy, retention...)."""
+    return _version(room_id, 'room')
+
+
+def bump_room_version(room_id):
+    _bump_version(room_id, 'room')
+
+
+def members_version(room_id):
+    """Changes whenever the room's participants change."""
+    return _version(room_id, 'members')
+
+
+def bump_members_version(room_id):
+    return _bump_version(room_id, 'members')
+
+
+def messages_version(room_id):
+    """Changes whenever messages are added to or removed from the room."""
+    return _version(room_id, 'messages')
+
+
+def bump_messages_version(room_id):
+    _bump_version(room_id, 'messages')
+
+
+def reads_version(room_id):
+    """Changes whenever read receipts in the room change."""
+    return _version(room_id, 'reads')
+
+
+def bump_reads_version(room_id):
+    _bump_version(room_id, 'reads')
+
+
+def _last_message_at_key(room_id):
+    return f'room:{room_id}:last_message_at'
+
+
+def note_last_message_at(room_id, when):
+    key = _last_message_at_key(room_id)
+    current = cache.get(key)
+    if current is None or when > current:
+        cache.set(key, when, CACHE_TIMEOUT)
+
+
+def last_message_at(room_id):
+    """Return when the room's newest message was added, or None."""
+    key = _last_message_at_key(room_id)
+    when = cache.get(key)
+    if when is None:
+        when = Message.objects.for_room(room_id).aggregate(latest=Max('date_added'))['latest']
+        if when is not None:
+            cache.set(key, when, CACHE_TIMEOUT)
+    return when
+
+
+def is_member(room_id, user):
+    """Return True if the user is a participant of the room."""
+    if not user.is_authenticated:
+        return False
+    key = _member_key(room_id, members_version(room_id), user.pk)
+    result = cache.get(key)
+    if result is None:
+        result = RoomMembership.objects.filter(room_id=room_id, user_id=user.pk).exists()
+        cache.set(key, result, CACHE_TIMEOUT)
+    return result
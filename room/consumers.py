@@ -1,68 +1,171 @@
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from django.utils import timezone
-from .models import Room, Message
+from . import affinity, heartbeat, hubs, inbox, receipts, unread
+from .cache import get_room, is_member
+from .journal import apost_message
+from .mentions import find_mentions
+from .notifications import mention_event, room_group_name, send_mentions, user_group_name
+from .profiling import profiled_handler
+from .tracing import continue_trace, start_trace
+
+
+async def receive_frame(socket, room, group, text_data):
+    """Handle a client frame on a chat socket; ChatConsumer and LeanChatConsumer share the protocol."""
+    # Frames that are not a JSON object are ignored, like unknown types
+    try:
+        data = json.loads(text_data)
+    except ValueError:
+        return
+    if not isinstance(data, dict):
+        return
+    message_type = data.get('type', 'message')
+    heartbeat.seen(socket, active=message_type != 'pong')
+    channel_layer = get_channel_layer()
+
+    if message_type == 'message':
+        message_content = data.get('message')
+        if not isinstance(message_content, str):
+            return
+        message_content = message_content.strip()
+        if message_content:
+            trace = start_trace()
+
+            # Save message to database
+            with trace.span('save_message'):
+                message = await apost_message(room, socket.user, message_content)
+
+            # Send message to room group
+            with trace.span('group_send'):
+                await channel_layer.group_send(group, {
+                    'type': 'chat_message',
+                    'message': message.content,
+                    'username': message.user.username,
+                    'message_id': message.id,
+                    'seq': message.seq,
+                    'timestamp': message.date_added.isoformat(),
+                    **trace.event_fields()
+                })
+            trace.finish('receive')
+
+            # Notify mentioned members on all of their connections
+            if '@' in message_content:
+                mentioned = await database_sync_to_async(find_mentions)(
+                    room.id, message_content, exclude=socket.user.id
+                )
+                await send_mentions(channel_layer, mentioned, mention_event(
+                    room, message.id, message.user.username, message.content
+                ))
+    elif message_type == 'read':
+        # "Read up to seq"; persisted, up to the room's latest seq, and broadcast in per-tick batches
+        up_to = data.get('up_to')
+        if socket.user.is_authenticated and isinstance(up_to, int) and not isinstance(up_to, bool) and up_to > 0:
+            receipts.record_read(room.id, socket.user.id, up_to)
+    elif message_type == 'inbox_ack':
+        # Delivered; with "more" the next batch follows
+        if socket.user.is_authenticated:
+            await socket.send_inbox(await inbox.handle_ack(socket.user.id, data))
+    elif message_type == 'typing':
+        # Broadcast typing status
+        await channel_layer.group_send(group, {
+            'type': 'typing_status',
+            'username': socket.user.username,
+            'is_typing': data.get('is_typing') is True
+        })
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'chat_{self.room_name}'
+        self.room_group_name = room_group_name(self.room_name)
         self.user = self.scope['user']
+        self.profile_requested = 'profile' in parse_qs(self.scope.get('query_string', b'').decode())
+
+        # Reject unknown rooms and non-members of private rooms
+        self.room = await self.get_room()
+        if self.room is None:
+            await self.close()
+            return
+
+        # Rooms served by another worker (see room/affinity.py)
+        handoff_url = await affinity.ahandoff_url(self.room_name)
+        if handoff_url is not None:
+            self.room = None
+            await self.accept()
+            await self.handoff(handoff_url)
+            return
 
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        if self.user.is_authenticated:
+            await self.channel_layer.group_add(user_group_name(self.user.id), self.channel_name)
 
         await self.accept()
+        unread.ensure_flusher()
+        receipts.ensure_flusher()
+        inbox.ensure_flusher()
+        heartbeat.add(self)
+        affinity.add(self, self.room_name)
 
-        # Add user to online users and notify others
-        await self.add_user_to_online_list()
+        # Direct messages that arrived while the user was away, in one frame
+        if self.user.is_authenticated:
+            await self.send_inbox(await inbox.drain(self.user.id))
+
+        # Tell the others
         await self.notify_user_joined()
 
     async def disconnect(self, close_code):
-        # Remove user from online users and notify others
-        await self.remove_user_from_online_list()
-        await self.notify_user_left()
+        await self.leave()
+
+    async def leave(self):
+        # Runs once, on disconnect or on eviction, whichever comes first
+        if getattr(self, 'room', None) is None:
+            return
+        self.room = None
+        heartbeat.discard(self)
+        affinity.discard(self, self.room_name)
 
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(user_group_name(self.user.id), self.channel_name)
 
-    @database_sync_to_async
-    def save_message(self, content):
-        room = Room.objects.get(slug=self.room_name)
-        message = Message.objects.create(
-            room=room,
-            user=self.user,
-            content=content
-        )
-        return {
-            'id': message.id,
-            'content': message.content,
-            'username': message.user.username,
-            'timestamp': message.date_added.isoformat()
-        }
+        # Tell the others
+        await self.notify_user_left()
 
-    @database_sync_to_async
-    def add_user_to_online_list(self):
-        room = Room.objects.get(slug=self.room_name)
-        if not hasattr(room, '_online_users'):
-            room._online_users = set()
-        room._online_users.add(self.user.username)
-        return list(room._online_users)
+    async def ping(self):
+        await self.send(text_data=json.dumps({'type': 'ping'}))
+
+    async def send_inbox(self, frame):
+        if frame is not None:
+            await self.send(text_data=json.dumps(frame))
+
+    async def evict(self):
+        """Drop a socket that stopped answering heartbeats or went idle."""
+        await self.leave()
+        await self.close(code=heartbeat.EVICTED_CLOSE_CODE)
+
+    async def handoff(self, url):
+        """Send the socket to the worker that serves its room."""
+        await self.send(text_data=json.dumps(affinity.handoff_frame(url)))
+        await self.leave()
+        await self.close(code=affinity.HANDOFF_CLOSE_CODE)
 
     @database_sync_to_async
-    def remove_user_from_online_list(self):
-        room = Room.objects.get(slug=self.room_name)
-        if hasattr(room, '_online_users'):
-            room._online_users.discard(self.user.username)
-            return list(room._online_users)
-        return []
+    def get_room(self):
+        room = get_room(self.room_name)
+        if room is None or (room.is_private and not is_member(room.id, self.user)):
+            return None
+        return room
 
     async def notify_user_joined(self):
         await self.channel_layer.group_send(
@@ -84,48 +187,51 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }
         )
 
+    @profiled_handler
     async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_type = data.get('type', 'message')
-
-        if message_type == 'message':
-            message_content = data.get('message', '').strip()
-            if message_content:
-                # Save message to database
-                message_data = await self.save_message(message_content)
-                
-                # Send message to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': message_data['content'],
-                        'username': message_data['username'],
-                        'message_id': message_data['id'],
-                        'timestamp': message_data['timestamp']
-                    }
-                )
-        elif message_type == 'typing':
-            # Broadcast typing status
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_status',
-                    'username': self.user.username,
-                    'is_typing': data.get('is_typing', False)
-                }
-            )
+        if self.room is None:
+            # Evicted, waiting for the socket to close
+            return
+        await receive_frame(self, self.room, self.room_group_name, text_data)
 
+    @profiled_handler
     async def chat_message(self, event):
+        trace = continue_trace(event)
+
         # Send message to WebSocket
+        with trace.span('chat_message'):
+            await self.send(text_data=json.dumps({
+                'type': 'message',
+                'message': event['message'],
+                'username': event['username'],
+                'message_id': event['message_id'],
+                'seq': event['seq'],
+                'timestamp': event['timestamp']
+            }))
+        trace.finish('delivery')
+
+    async def mention(self, event):
         await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-            'username': event['username'],
+            'type': 'mention',
+            'room': event['room'],
             'message_id': event['message_id'],
-            'timestamp': event['timestamp']
+            'username': event['username'],
+            'message': event['message']
         }))
 
+    async def inbox_messages(self, event):
+        await self.send_inbox(inbox.inbox_frame(event['messages']))
+
+    async def read_receipts(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'read_receipts',
+            'receipts': event['receipts']
+        }))
+
+    async def unread_counts(self, event):
+        # Only the room list shows unread counts
+        pass
+
     async def typing_status(self, event):
         # Send typing status to WebSocket (only to other users)
         if event['username'] != self.user.username:
@@ -149,4 +255,176 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'type': 'user_leave',
             'username': event['username'],
             'message': event['message']
-        }))
\ No newline at end of file
+        }))
+
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    """Per-user stream of unread-count deltas, mentions and direct messages."""
+
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.group_name = user_group_name(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        unread.ensure_flusher()
+        inbox.ensure_flusher()
+        await self.send_inbox(await inbox.drain(self.user.id))
+
+    async def disconnect(self, close_code):
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+        if data.get('type') == 'inbox_ack':
+            await self.send_inbox(await inbox.handle_ack(self.user.id, data))
+
+    async def send_inbox(self, frame):
+        if frame is not None:
+            await self.send(text_data=json.dumps(frame))
+
+    async def inbox_messages(self, event):
+        await self.send_inbox(inbox.inbox_frame(event['messages']))
+
+    async def unread_counts(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'unread',
+            'deltas': event['deltas'],
+            'reset': event['reset']
+        }))
+
+    async def mention(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'mention',
+            'room': event['room'],
+            'message_id': event['message_id'],
+            'username': event['username'],
+            'message': event['message']
+        }))
+
+
+PING_FRAME = json.dumps({'type': 'ping'})
+
+
+class LeanChatConsumer:
+    """ws/chat/ for workers holding many idle sockets (LEAN_CHAT_CONSUMER).
+
+    Speaks the same protocol as ChatConsumer (see receive_frame), but a
+    socket only keeps its send callable, its scope, its user and its hubs
+    (see room/hubs.py): the room and the group subscriptions are shared per
+    worker, and an idle socket has no task besides its own ASGI coroutine
+    waiting on receive().
+    """
+    __slots__ = ('send', 'scope', 'user', 'hub', 'user_hub')
+
+    def __init__(self, send, scope):
+        self.send = send
+        self.scope = scope
+        self.user = scope['user']
+        self.hub = None
+        self.user_hub = None
+
+    @classmethod
+    def as_asgi(cls):
+        async def app(scope, receive, send):
+            await cls(send, scope).run(scope['url_route']['kwargs']['room_name'], receive)
+        return app
+
+    async def run(self, room_name, receive):
+        # However the loop ends, the socket leaves its hubs and the worker's registries
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.connect':
+                    await self.connect(room_name)
+                elif message['type'] == 'websocket.receive':
+                    if self.hub is not None and message.get('text') is not None:
+                        await self.receive(message['text'])
+                elif message['type'] == 'websocket.disconnect':
+                    return
+        finally:
+            await self.disconnect()
+
+    @database_sync_to_async
+    def get_room(self, room_name):
+        room = get_room(room_name)
+        if room is None or (room.is_private and not is_member(room.id, self.user)):
+            return None
+        return room
+
+    async def connect(self, room_name):
+        # Reject unknown rooms and non-members of private rooms
+        room = await self.get_room(room_name)
+        if room is None:
+            await self.send({'type': 'websocket.close', 'code': 1000})
+            return
+
+        handoff_url = await affinity.ahandoff_url(room_name)
+        if handoff_url is not None:
+            await self.send({'type': 'websocket.accept'})
+            await self.handoff(handoff_url)
+            return
+
+        self.hub = await hubs.join(room_group_name(room_name), self, room)
+        if self.user.is_authenticated:
+            self.user_hub = await hubs.join_user(self)
+
+        await self.send({'type': 'websocket.accept'})
+        unread.ensure_flusher()
+        receipts.ensure_flusher()
+        inbox.ensure_flusher()
+        heartbeat.add(self)
+        affinity.add(self, room_name)
+        if self.user.is_authenticated:
+            await self.send_inbox(await inbox.drain(self.user.id))
+
+        await get_channel_layer().group_send(self.hub.group, {
+            'type': 'user_join',
+            'username': self.user.username,
+            'message': f'{self.user.username} joined the chat'
+        })
+
+    async def disconnect(self):
+        # Runs once, on disconnect or on eviction, whichever comes first
+        hub = self.hub
+        if hub is None:
+            return
+        self.hub = None
+        heartbeat.discard(self)
+        affinity.discard(self, hub.room.slug)
+        await hubs.leave(hub, self)
+        if self.user_hub is not None:
+            await hubs.leave_user(self.user_hub, self)
+            self.user_hub = None
+
+        await get_channel_layer().group_send(hub.group, {
+            'type': 'user_leave',
+            'username': self.user.username,
+            'message': f'{self.user.username} left the chat'
+        })
+
+    async def ping(self):
+        await self.send({'type': 'websocket.send', 'text': PING_FRAME})
+
+    async def send_inbox(self, frame):
+        if frame is not None:
+            await self.send({'type': 'websocket.send', 'text': json.dumps(frame)})
+
+    async def evict(self):
+        """Drop a socket that stopped answering heartbeats or went idle."""
+        await self.disconnect()
+        await self.send({'type': 'websocket.close', 'code': heartbeat.EVICTED_CLOSE_CODE})
+
+    async def handoff(self, url):
+        """Send the socket to the worker that serves its room."""
+        await self.send({'type': 'websocket.send', 'text': json.dumps(affinity.handoff_frame(url))})
+        await self.disconnect()
+        await self.send({'type': 'websocket.close', 'code': affinity.HANDOFF_CLOSE_CODE})
+
+    @profiled_handler
+    async def receive(self, text_data):
+        await receive_frame(self, self.hub.room, self.hub.group, text_data)
@@ -0,0 +1,159 @@
+import bisect
+import itertools
+import random
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .membership import add_members
+from .models import Message, Room
+from .routers import message_db_for_room
+from .sequence import number_messages
+from .signals import messages_stored
+
+# Builds a benchmark dataset with the skew seen in production: a few huge
+# rooms and many small ones, and a few very active users. Everything is
+# drawn from one seeded Random and timestamps count from a fixed start
+# date, so the same options always produce the same data on an empty
+# database.
+
+INSERT_BATCH_SIZE = 5000
+DEFAULT_START = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class WeightedChoice:
+    """O(log n) weighted sampling over a fixed population."""
+
+    def __init__(self, rng, population, weights):
+        self.rng = rng
+        self.population = population
+        self.cum_weights = list(itertools.accumulate(weights))
+
+    def pick(self):
+        point = self.rng.random() * self.cum_weights[-1]
+        return self.population[bisect.bisect_right(self.cum_weights, point)]
+
+    def pick_distinct(self, count):
+        count = min(count, len(self.population))
+        chosen = set()
+        while len(chosen) < count:
+            chosen.add(self.pick())
+        return chosen
+
+
+def zipf_weights(count, exponent):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+class DatasetGenerator:
+    def __init__(self, seed=0, prefix='bench', skew=1.1, start=DEFAULT_START, days=90, progress=None):
+        self.rng = random.Random(seed)
+        self.prefix = prefix
+        self.skew = skew
+        self.start = start
+        self.days = days
+        self.progress = progress or (lambda message: None)
+
+    def create_users(self, count):
+        password = make_password(None)
+        User.objects.bulk_create(
+            [User(username=f'{self.prefix}_user{i:07d}', password=password) for i in range(count)],
+            batch_size=INSERT_BATCH_SIZE
+        )
+        user_ids = list(User.objects.filter(
+            username__startswith=f'{self.prefix}_user'
+        ).order_by('username').values_list('id', flat=True))
+        self.progress(f'{len(user_ids)} users')
+        return user_ids
+
+    def create_rooms(self, count, user_ids, private_ratio):
+        Room.objects.bulk_create([
+            Room(
+                name=f'{self.prefix} room {i}',
+                slug=f'{self.prefix}-room-{i:06d}',
+                created_by_id=self.rng.choice(user_ids),
+                is_private=self.rng.random() < private_ratio,
+                created_at=self.start
+            )
+            for i in range(count)
+        ], batch_size=INSERT_BATCH_SIZE)
+        rooms = list(Room.objects.filter(
+            slug__startswith=f'{self.prefix}-room-'
+        ).order_by('slug').only('id', 'created_by_id'))
+        self.progress(f'{len(rooms)} rooms')
+        return rooms
+
+    def create_memberships(self, rooms, user_ids, rooms_per_user):
+        """Give rooms Zipf-distributed sizes; returns room id -> member ids."""
+        users = WeightedChoice(self.rng, user_ids, zipf_weights(len(user_ids), self.skew / 2))
+        weights = zipf_weights(len(rooms), self.skew)
+        scale = len(user_ids) * rooms_per_user / sum(weights)
+        members = {}
+        for room, weight in zip(rooms, weights):
+            size = max(2, min(len(user_ids), round(weight * scale)))
+            members[room.id] = sorted(users.pick_distinct(size - 1) | {room.created_by_id})
+            add_members(room, members[room.id])
+        self.progress(f'{sum(len(ids) for ids in members.values())} memberships')
+        return members
+
+    def create_messages(self, rooms, members, count, targeted_ratio, read_ratio):
+        room_ids = [room.id for room in rooms]
+        room_picker = WeightedChoice(self.rng, room_ids, [len(members[room_id]) for room_id in room_ids])
+        senders = {
+            room_id: WeightedChoice(self.rng, ids, zipf_weights(len(ids), self.skew))
+            for room_id, ids in members.items()
+        }
+        step = timedelta(days=self.days) / max(count, 1)
+
+        created = 0
+        receipts = 0
+        while created < count:
+            batch = {}
+            for index in range(created, min(count, created + INSERT_BATCH_SIZE)):
+                room_id = room_picker.pick()
+                sender = senders[room_id].pick()
+                target = None
+                if self.rng.random() < targeted_ratio:
+                    target = senders[room_id].pick()
+                    if target == sender:
+                        target = None
+                batch.setdefault(message_db_for_room(room_id), []).append(Message(
+                    room_id=room_id,
+                    user_id=sender,
+                    target_user_id=target,
+                    is_targeted=target is not None,
+                    content=f'message {index} from {sender}',
+                    date_added=self.start + step * index
+                ))
+            for using, messages in batch.items():
+                number_messages(messages)
+                with transaction.atomic(using=using):
+                    Message.objects.using(using).bulk_create(messages)
+                    receipts += self.create_read_receipts(messages, members, read_ratio, using)
+                messages_stored.send(sender=Message, messages=messages, using=using, imported=True)
+                created += len(messages)
+            self.progress(f'{created}/{count} messages, {receipts} read receipts')
+
+    def create_read_receipts(self, messages, members, read_ratio, using):
+        ReadReceipt = Message.read_by_users.through
+        rows = []
+        for message in messages:
+            if self.rng.random() >= read_ratio:
+                continue
+            room_members = members[message.room_id]
+            readers = self.rng.sample(room_members, self.rng.randint(1, min(len(room_members), 20)))
+            rows.extend(
+                ReadReceipt(message_id=message.id, user_id=user_id)
+                for user_id in readers if user_id != message.user_id
+            )
+        ReadReceipt.objects.using(using).bulk_create(rows, batch_size=INSERT_BATCH_SIZE)
+        return len(rows)
+
+    def generate(self, users, rooms, messages, rooms_per_user=3, private_ratio=0.5,
+                 targeted_ratio=0.05, read_ratio=0.3):
+        user_ids = self.create_users(users)
+        room_list = self.create_rooms(rooms, user_ids, private_ratio)
+        members = self.create_memberships(room_list, user_ids, rooms_per_user)
+        self.create_messages(room_list, members, messages, targeted_ratio, read_ratio)
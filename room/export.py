@@ -0,0 +1,98 @@
+import csv
+import json
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from django.db.models import Q
+
+from .models import Message
+
+# Transcripts are read in keyset-paginated chunks on (date_added, id), which
+# the (room, date_added) index serves directly, so memory use does not grow
+# with the size of the room.
+
+EXPORT_CHUNK_SIZE = 2000
+USERNAME_CACHE_SIZE = 10000
+EXPORT_FORMATS = ('ndjson', 'csv')
+CSV_COLUMNS = ['id', 'timestamp', 'username', 'target_user', 'is_targeted', 'content']
+
+
+class UsernameCache:
+    """Bounded id -> username map, filled one query per chunk.
+
+    The users of the chunk being loaded are never evicted by that load, even
+    if there are more of them than ``size``.
+    """
+
+    def __init__(self, size=None):
+        self.size = USERNAME_CACHE_SIZE if size is None else size
+        self._names = OrderedDict()
+
+    def load(self, user_ids):
+        needed = {user_id for user_id in user_ids if user_id is not None}
+        for user_id in needed & self._names.keys():
+            self._names.move_to_end(user_id)
+        missing = needed - self._names.keys()
+        if missing:
+            self._names.update(User.objects.filter(id__in=missing).values_list('id', 'username'))
+        # Least recently used first; the chunk's users are the newest entries
+        while len(self._names) > max(self.size, len(needed)):
+            self._names.popitem(last=False)
+
+    def get(self, user_id):
+        if user_id is None:
+            return None
+        if user_id not in self._names:
+            # Not loaded with its chunk, e.g. the user was deleted meanwhile
+            self._names[user_id] = User.objects.filter(id=user_id).values_list('username', flat=True).first()
+        self._names.move_to_end(user_id)
+        return self._names[user_id]
+
+
+def iter_messages(room, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the room's messages oldest first as dicts with usernames resolved."""
+    usernames = UsernameCache()
+    last = None
+    while True:
+        query = Message.objects.for_room(room.id)
+        if last is not None:
+            query = query.filter(
+                Q(date_added__gt=last['date_added']) |
+                Q(date_added=last['date_added'], id__gt=last['id'])
+            )
+        chunk = list(query.order_by('date_added', 'id').values(
+            'id', 'date_added', 'user_id', 'target_user_id', 'is_targeted', 'content'
+        )[:chunk_size])
+        if not chunk:
+            return
+        usernames.load(user_id for row in chunk for user_id in (row['user_id'], row['target_user_id']))
+        for row in chunk:
+            yield {
+                'id': row['id'],
+                'timestamp': row['date_added'].isoformat(),
+                'username': usernames.get(row['user_id']),
+                'target_user': usernames.get(row['target_user_id']),
+                'is_targeted': row['is_targeted'],
+                'content': row['content'],
+            }
+        last = chunk[-1]
+
+
+class _Echo:
+    """File-like object whose write() returns the value, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def iter_transcript(room, export_format='ndjson', chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the room transcript as NDJSON lines or CSV rows."""
+    messages = iter_messages(room, chunk_size)
+    if export_format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(CSV_COLUMNS)
+        for message in messages:
+            yield writer.writerow([message[column] for column in CSV_COLUMNS])
+    else:
+        for message in messages:
+            yield json.dumps(message) + '\n'
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import math
+import time
+
+from django.conf import settings
+
+from . import ticks
+
+logger = logging.getLogger(__name__)
+
+# Chat sockets are pinged with a {"type": "ping"} frame after
+# HEARTBEAT_INTERVAL seconds without hearing from them, and evicted when
+# nothing (usually {"type": "pong"}) arrives within HEARTBEAT_TIMEOUT.
+# With IDLE_TIMEOUT set, sockets that have not sent a chat frame for that
+# long are closed as well. Evicting leaves the groups and tells the room
+# the user left, the same as a disconnect.
+#
+# Every socket has exactly one timer in a hierarchical timer wheel.
+# Frames from the client only record the time they were seen; the timer
+# is checked against it when it fires. A tick therefore costs the same
+# however many sockets are open, plus the work for the timers that are due.
+
+HEARTBEAT_INTERVAL = getattr(settings, 'HEARTBEAT_INTERVAL', 30)
+HEARTBEAT_TIMEOUT = getattr(settings, 'HEARTBEAT_TIMEOUT', 10)
+IDLE_TIMEOUT = getattr(settings, 'IDLE_TIMEOUT', None)
+TICK = getattr(settings, 'HEARTBEAT_TICK', 1.0)
+# Close code sent to evicted sockets
+EVICTED_CLOSE_CODE = 4000
+
+
+class TimerWheel:
+    """Hierarchical timing wheel.
+
+    Level 0 has one slot per tick, and each level above covers ``slots``
+    times the span of the one below. Scheduling and cancelling are O(1);
+    advancing one tick empties one level 0 slot, and every ``slots ** n``
+    ticks moves one slot of level n down.
+    """
+
+    def __init__(self, resolution=1.0, slots=64, levels=4, now=0.0):
+        self.resolution = resolution
+        self.slots = slots
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.current = int(now // resolution)
+        self._slot_of = {}
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, key):
+        return key in self._slot_of
+
+    def schedule(self, key, when):
+        """Fire ``key`` at the first tick at or after ``when``, replacing its previous timer."""
+        self.cancel(key)
+        self._place(key, max(math.ceil(when / self.resolution), self.current + 1))
+
+    def cancel(self, key):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def _place(self, key, tick):
+        delta = max(tick - self.current, 0)
+        level = 0
+        while level < len(self.wheels) - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+        span = self.slots ** level
+        # Past the top level's range: wait in its furthest slot and get placed again from there
+        slot_tick = min(tick, self.current + span * (self.slots - 1))
+        slot = self.wheels[level][(slot_tick // span) % self.slots]
+        slot[key] = tick
+        self._slot_of[key] = slot
+
+    def advance(self, now):
+        """Move time forward to ``now``; returns the keys that are due."""
+        due = []
+        target = int(now // self.resolution)
+        while self.current < target:
+            self.current += 1
+            for level in range(len(self.wheels) - 1, 0, -1):
+                span = self.slots ** level
+                if self.current % span == 0:
+                    index = (self.current // span) % self.slots
+                    timers, self.wheels[level][index] = self.wheels[level][index], {}
+                    for key, tick in timers.items():
+                        self._place(key, tick)
+            index = self.current % self.slots
+            timers, self.wheels[0][index] = self.wheels[0][index], {}
+            for key in timers:
+                del self._slot_of[key]
+            due.extend(timers)
+        return due
+
+
+class Heartbeats:
+    """Heartbeat and idle timers for the sockets of one worker.
+
+    A socket needs async ``ping()`` and ``evict()`` methods.
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 resolution=TICK, clock=time.monotonic):
+        self.interval = interval
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.wheel = TimerWheel(resolution, now=clock())
+        self._seen = {}
+        self._active = {}
+        self._pinged = {}
+
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, socket):
+        now = self.clock()
+        self._seen[socket] = now
+        self._active[socket] = now
+        self._schedule(socket, now + self.interval)
+
+    def seen(self, socket, active=True):
+        """Record a frame from the socket; pongs are not activity for the idle timeout."""
+        if socket in self._seen:
+            now = self.clock()
+            self._seen[socket] = now
+            if active:
+                self._active[socket] = now
+
+    def discard(self, socket):
+        self.wheel.cancel(socket)
+        self._seen.pop(socket, None)
+        self._active.pop(socket, None)
+        self._pinged.pop(socket, None)
+
+    def _schedule(self, socket, when):
+        if self.idle_timeout:
+            when = min(when, self._active[socket] + self.idle_timeout)
+        self.wheel.schedule(socket, when)
+
+    def expire(self):
+        """Advance the wheel; returns the sockets to ping and the sockets to evict."""
+        now = self.clock()
+        to_ping = []
+        to_evict = []
+        for socket in self.wheel.advance(now):
+            seen = self._seen[socket]
+            pinged = self._pinged.get(socket)
+            if self.idle_timeout and now - self._active[socket] >= self.idle_timeout:
+                to_evict.append(socket)
+            elif pinged is not None and seen < pinged:
+                if now - pinged >= self.timeout:
+                    to_evict.append(socket)
+                else:
+                    self._schedule(socket, pinged + self.timeout)
+            elif now - seen >= self.interval:
+                self._pinged[socket] = now
+                self._schedule(socket, now + self.timeout)
+                to_ping.append(socket)
+            else:
+                # Heard from since the timer was set
+                self._pinged.pop(socket, None)
+                self._schedule(socket, seen + self.interval)
+        for socket in to_evict:
+            self.discard(socket)
+        return to_ping, to_evict
+
+    async def tick(self, channel_layer=None):
+        to_ping, to_evict = self.expire()
+        results = await asyncio.gather(
+            *(socket.ping() for socket in to_ping),
+            *(socket.evict() for socket in to_evict),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning('Heartbeat failed', exc_info=result)
+
+
+heartbeats = Heartbeats()
+
+
+def add(socket):
+    heartbeats.add(socket)
+    ticks.ensure_periodic('heartbeat', TICK, heartbeats.tick)
+
+
+def seen(socket, active=True):
+    heartbeats.seen(socket, active)
+
+
+def discard(socket):
+    heartbeats.discard(socket)
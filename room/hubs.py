@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+
+from channels.layers import get_channel_layer
+
+from .inbox import inbox_frame
+from .notifications import user_group_name
+from .tracing import continue_trace
+
+# A generic consumer subscribes every socket to the channel layer on its
+# own: one channel per socket, a task per socket polling it, and every
+# group event decoded and re-encoded once per socket. A Hub does that once
+# per group and worker instead. It joins the group with a single channel,
+# receives with a single task and writes each frame, encoded once, to the
+# worker's sockets in the group (see LeanChatConsumer). User groups are
+# served by one UserHub per worker, whose channel joins the group of every
+# user with a socket on the worker and routes events by their user_id.
+
+# Hub channels carry the events of many sockets; see CHANNEL_LAYERS for
+# their capacity.
+CHANNEL_PREFIX = 'hub'
+
+logger = logging.getLogger(__name__)
+
+
+def event_frame(event):
+    """The websocket frame for a chat group event, or None if sockets do not see it."""
+    event_type = event['type']
+    if event_type == 'chat_message':
+        return {
+            'type': 'message',
+            'message': event['message'],
+            'username': event['username'],
+            'message_id': event['message_id'],
+            'seq': event['seq'],
+            'timestamp': event['timestamp']
+        }
+    if event_type == 'mention':
+        return {
+            'type': 'mention',
+            'room': event['room'],
+            'message_id': event['message_id'],
+            'username': event['username'],
+            'message': event['message']
+        }
+    if event_type == 'inbox_messages':
+        return inbox_frame(event['messages'])
+    if event_type == 'read_receipts':
+        return {'type': 'read_receipts', 'receipts': event['receipts']}
+    if event_type == 'typing_status':
+        return {'type': 'typing_status', 'username': event['username'], 'is_typing': event['is_typing']}
+    if event_type in ('user_join', 'user_leave'):
+        return {'type': event_type, 'username': event['username'], 'message': event['message']}
+    return None
+
+
+class Subscription:
+    """A channel of this worker, shared by sockets; subclasses pick the sockets for each event."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.channel = None
+        self.task = None
+        self.ready = self.loop.create_task(self._subscribe())
+
+    async def _subscribe(self):
+        channel_layer = get_channel_layer()
+        self.channel = await channel_layer.new_channel(prefix=CHANNEL_PREFIX)
+        await self.subscribed(channel_layer)
+        self.task = self.loop.create_task(self._dispatch(channel_layer))
+
+    async def subscribed(self, channel_layer):
+        pass
+
+    def recipients(self, event):
+        raise NotImplementedError
+
+    def drop(self, socket):
+        """Stop writing to a socket whose send failed; it leaves properly on its own disconnect."""
+        raise NotImplementedError
+
+    async def _dispatch(self, channel_layer):
+        while True:
+            event = await channel_layer.receive(self.channel)
+            frame = event_frame(event)
+            if frame is None:
+                continue
+            trace = continue_trace(event)
+            with trace.span('chat_message'):
+                text = json.dumps(frame)
+                # Typing indicators are not echoed to the typist
+                skip = event['username'] if event['type'] == 'typing_status' else None
+                for socket in self.recipients(event):
+                    if socket.user.username == skip:
+                        continue
+                    # One broken socket must not end delivery to the others
+                    try:
+                        await socket.send({'type': 'websocket.send', 'text': text})
+                    except Exception:
+                        logger.warning('Dropping a socket whose send failed', exc_info=True)
+                        self.drop(socket)
+            trace.finish('delivery')
+
+    async def close(self):
+        await self.ready
+        self.task.cancel()
+
+
+class Hub(Subscription):
+    """The worker's subscription to a room group, shared by its sockets in the room."""
+
+    def __init__(self, group, room):
+        self.group = group
+        self.room = room
+        self.sockets = set()
+        super().__init__()
+
+    async def subscribed(self, channel_layer):
+        await channel_layer.group_add(self.group, self.channel)
+
+    def recipients(self, event):
+        return list(self.sockets)
+
+    def drop(self, socket):
+        self.sockets.discard(socket)
+
+    async def close(self):
+        await super().close()
+        await get_channel_layer().group_discard(self.group, self.channel)
+
+
+class UserHub(Subscription):
+    """One channel in the groups of all the worker's users; events name their user_id."""
+
+    def __init__(self):
+        self.sockets = {}
+        super().__init__()
+
+    def recipients(self, event):
+        return list(self.sockets.get(event.get('user_id'), ()))
+
+    def drop(self, socket):
+        self.sockets.get(socket.user.id, set()).discard(socket)
+
+    async def add(self, socket):
+        user_id = socket.user.id
+        first = user_id not in self.sockets
+        self.sockets.setdefault(user_id, set()).add(socket)
+        await self.ready
+        if first:
+            await get_channel_layer().group_add(user_group_name(user_id), self.channel)
+
+    async def discard(self, socket):
+        user_id = socket.user.id
+        sockets = self.sockets.get(user_id, set())
+        sockets.discard(socket)
+        if not sockets and self.sockets.pop(user_id, None) is not None:
+            await get_channel_layer().group_discard(user_group_name(user_id), self.channel)
+
+
+_hubs = {}
+_user_hub = None
+
+
+async def join(group, socket, room):
+    """Add a socket to the worker's hub for a room group, subscribing on first use."""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(group)
+    if hub is None or hub.loop is not loop:
+        hub = _hubs[group] = Hub(group, room)
+    hub.sockets.add(socket)
+    await hub.ready
+    return hub
+
+
+async def leave(hub, socket):
+    """Remove a socket from its hub, unsubscribing when it was the last one."""
+    hub.sockets.discard(socket)
+    if not hub.sockets and _hubs.get(hub.group) is hub:
+        del _hubs[hub.group]
+        await hub.close()
+
+
+async def join_user(socket):
+    """Deliver the events of the socket's user group to it."""
+    global _user_hub
+    if _user_hub is None or _user_hub.loop is not asyncio.get_running_loop():
+        _user_hub = UserHub()
+    await _user_hub.add(socket)
+    return _user_hub
+
+
+async def leave_user(hub, socket):
+    await hub.discard(socket)
@@ -0,0 +1,177 @@
+import json
+import os
+from datetime import datetime, timezone as dt_timezone
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .journal import new_messages, reserve_message_ids
+from .models import Message, Room
+from .routers import message_db_for_room
+from .sequence import number_messages
+from .signals import messages_stored
+
+# Imports NDJSON history, one message per line:
+#
+#   {"room": "general", "user": "alice", "content": "hi",
+#    "timestamp": "2021-03-04T05:06:07Z", "target_user": null}
+#
+# Users and rooms are resolved through in-memory maps filled one query per
+# batch. Malformed lines, records without a valid timestamp or content and
+# records naming unknown users or rooms are skipped and counted. Each batch
+# reserves its message ids and records them in the checkpoint file before
+# inserting, so a batch interrupted by a crash is redone with the same ids
+# on resume and never duplicated.
+
+IMPORT_BATCH_SIZE = 5000
+
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp, UTC unless it says otherwise; None if it is not one."""
+    try:
+        when = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=dt_timezone.utc)
+    return when
+
+
+class HistoryImporter:
+    def __init__(self, checkpoint_path=None, create_users=False, create_rooms=False):
+        self.checkpoint_path = checkpoint_path
+        self.create_users = create_users
+        self.create_rooms = create_rooms
+        self.user_ids = {}
+        self.room_ids = {}
+        self.imported = 0
+        self.skipped = 0
+
+    def read_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return {'offset': 0}
+        with open(self.checkpoint_path) as checkpoint:
+            return json.load(checkpoint)
+
+    def write_checkpoint(self, state):
+        if not self.checkpoint_path:
+            return
+        tmp_path = f'{self.checkpoint_path}.tmp'
+        with open(tmp_path, 'w') as checkpoint:
+            json.dump(state, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def resolve_users(self, usernames):
+        missing = {name for name in usernames if name and name not in self.user_ids}
+        if not missing:
+            return
+        self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+        missing -= set(self.user_ids)
+        if missing and self.create_users:
+            unusable = make_password(None)
+            User.objects.bulk_create(
+                [User(username=name, password=unusable) for name in missing],
+                ignore_conflicts=True
+            )
+            self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+
+    def resolve_rooms(self, slugs):
+        missing = {slug for slug in slugs if slug not in self.room_ids}
+        if not missing:
+            return
+        self.room_ids.update(Room.objects.filter(slug__in=missing).values_list('slug', 'id'))
+        missing -= set(self.room_ids)
+        if missing and self.create_rooms:
+            Room.objects.bulk_create([Room(name=slug, slug=slug) for slug in missing], ignore_conflicts=True)
+            self.room_ids.update(Room.objects.filter(slug__in=missing).values_list('slug', 'id'))
+
+    def build_messages(self, records):
+        self.resolve_users({record.get('user') for record in records} | {record.get('target_user') for record in records})
+        self.resolve_rooms({record.get('room') for record in records})
+
+        by_db = {}
+        for record in records:
+            room_id = self.room_ids.get(record.get('room'))
+            user_id = self.user_ids.get(record.get('user'))
+            target_user_id = self.user_ids.get(record.get('target_user'))
+            content = record.get('content')
+            date_added = parse_timestamp(record.get('timestamp'))
+            if room_id is None or user_id is None or not content or not isinstance(content, str) or date_added is None:
+                self.skipped += 1
+                continue
+            by_db.setdefault(message_db_for_room(room_id), []).append(Message(
+                room_id=room_id,
+                user_id=user_id,
+                content=content,
+                date_added=date_added,
+                target_user_id=target_user_id,
+                is_targeted=target_user_id is not None
+            ))
+        return by_db
+
+    def import_batch(self, records, start, end, reserved=None):
+        by_db = self.build_messages(records)
+        if reserved is None:
+            reserved = {
+                using: reserve_message_ids(using, len(messages))[0]
+                for using, messages in by_db.items()
+            }
+            # Record the ids before inserting so a crash here replays them
+            self.write_checkpoint({'offset': start, 'pending': {'end': end, 'ids': reserved}})
+
+        for using, messages in by_db.items():
+            for offset, message in enumerate(messages):
+                message.id = reserved[using] + offset
+            # A resumed batch may have been stored before the crash
+            messages = new_messages(using, messages)
+            if not messages:
+                continue
+            number_messages(messages)
+            with transaction.atomic(using=using):
+                Message.objects.using(using).bulk_create(messages, ignore_conflicts=True)
+            messages_stored.send(sender=Message, messages=messages, using=using, imported=True)
+            self.imported += len(messages)
+
+        self.write_checkpoint({'offset': end})
+
+    def read_batch(self, source, batch_size=None, end=None):
+        records = []
+        while (batch_size is None or len(records) < batch_size) and (end is None or source.tell() < end):
+            line = source.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if isinstance(record, dict):
+                records.append(record)
+            else:
+                self.skipped += 1
+        return records
+
+    def run(self, source, batch_size=IMPORT_BATCH_SIZE, progress=None):
+        """Import everything after the checkpoint from a binary file object."""
+        state = self.read_checkpoint()
+        source.seek(state['offset'])
+
+        pending = state.get('pending')
+        if pending:
+            records = self.read_batch(source, end=pending['end'])
+            self.import_batch(records, state['offset'], pending['end'], reserved=pending['ids'])
+            if progress:
+                progress(self)
+
+        while True:
+            start = source.tell()
+            records = self.read_batch(source, batch_size)
+            if not records:
+                return
+            self.import_batch(records, start, source.tell())
+            if progress:
+                progress(self)
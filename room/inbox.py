@@ -0,0 +1,141 @@
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from . import ticks
+from .models import InboxEntry, Message, Room
+from .notifications import user_group_name
+from .routers import message_db_for_room
+
+# Targeted messages are indexed per recipient as they are stored
+# (messages_stored), so a user's undelivered direct messages are one
+# indexed read away rather than a scan of every room's history. A socket
+# gets them all in one {"type": "inbox"} frame when it connects, and open
+# sockets get new ones pushed in per-tick batches. Entries stay until the
+# client acknowledges them with {"type": "inbox_ack", "message_ids": [...]}:
+# delivery, not reading, clears them, and anything lost in flight comes
+# again on the next connect. Clients acknowledge only what they showed; to
+# read past the rest they send "more" with "after", the last message id of
+# the batch. Entries of pruned messages are dropped when a drain finds
+# their message gone.
+
+TICK = getattr(settings, 'INBOX_PUSH_TICK', 1.0)
+# Most messages in one frame; the client asks for the rest with "more" in its ack
+BATCH_SIZE = getattr(settings, 'INBOX_BATCH_SIZE', 500)
+
+_lock = threading.Lock()
+_new = {}
+
+
+def messages_added(messages):
+    entries = [
+        InboxEntry(user_id=message.target_user_id, room_id=message.room_id, message_id=message.id)
+        for message in messages
+        if message.is_targeted and message.target_user_id and message.target_user_id != message.user_id
+    ]
+    if not entries:
+        return
+    InboxEntry.objects.bulk_create(entries, ignore_conflicts=True)
+    if ticks.is_running('inbox'):
+        with _lock:
+            for entry in entries:
+                _new.setdefault(entry.user_id, []).append((entry.room_id, entry.message_id))
+
+
+def load_messages(entries):
+    """Frame data of the messages behind (room_id, message_id) pairs, by message id.
+
+    One query per message database, plus one each for the senders and rooms.
+    """
+    by_db = {}
+    for room_id, message_id in entries:
+        by_db.setdefault(message_db_for_room(room_id), []).append(message_id)
+    rows = []
+    for using, message_ids in by_db.items():
+        rows.extend(Message.objects.using(using).filter(id__in=message_ids).values(
+            'id', 'room_id', 'user_id', 'content', 'seq', 'date_added'
+        ))
+    if not rows:
+        return {}
+    usernames = dict(User.objects.filter(id__in={row['user_id'] for row in rows}).values_list('id', 'username'))
+    slugs = dict(Room.objects.filter(id__in={row['room_id'] for row in rows}).values_list('id', 'slug'))
+    return {
+        row['id']: {
+            'message_id': row['id'],
+            'room': slugs.get(row['room_id']),
+            'seq': row['seq'],
+            'message': row['content'],
+            'username': usernames.get(row['user_id']),
+            'timestamp': row['date_added'].isoformat()
+        }
+        for row in rows
+    }
+
+
+def pending(user_id, limit=BATCH_SIZE, after=0):
+    """The user's undelivered messages after message id ``after``, oldest first; returns (messages, more)."""
+    entries = list(InboxEntry.objects.filter(user_id=user_id, message_id__gt=after).order_by('message_id').values_list(
+        'room_id', 'message_id'
+    )[:limit])
+    found = load_messages(entries)
+    gone = [message_id for _, message_id in entries if message_id not in found]
+    if gone:
+        acknowledge(user_id, gone)
+    return [found[message_id] for _, message_id in entries if message_id in found], len(entries) == limit
+
+
+def acknowledge(user_id, message_ids):
+    """Drop delivered messages from the user's inbox. Returns the number dropped."""
+    if not message_ids:
+        return 0
+    return InboxEntry.objects.filter(user_id=user_id, message_id__in=message_ids).delete()[0]
+
+
+def inbox_frame(messages, more=False):
+    return {'type': 'inbox', 'messages': messages, 'more': more}
+
+
+async def drain(user_id, after=0):
+    """The frame with the user's undelivered messages, or None if there are none."""
+    messages, more = await database_sync_to_async(pending)(user_id, after=after)
+    return inbox_frame(messages, more) if messages else None
+
+
+async def handle_ack(user_id, data):
+    """Apply an inbox_ack frame; returns the next batch's frame if the client asked for more."""
+    message_ids = data.get('message_ids')
+    if not isinstance(message_ids, list):
+        return None
+    message_ids = [message_id for message_id in message_ids[:BATCH_SIZE] if isinstance(message_id, int)]
+    await database_sync_to_async(acknowledge)(user_id, message_ids)
+    if data.get('more'):
+        after = data.get('after')
+        return await drain(user_id, after if isinstance(after, int) else 0)
+    return None
+
+
+def _take_events():
+    global _new
+    with _lock:
+        new, _new = _new, {}
+    found = load_messages([entry for entries in new.values() for entry in entries])
+    events = {}
+    for user_id, entries in new.items():
+        messages = [found[message_id] for _, message_id in entries if message_id in found]
+        if messages:
+            events[user_id] = {'type': 'inbox_messages', 'user_id': user_id, 'messages': messages}
+    return events
+
+
+async def flush(channel_layer):
+    if not _new:
+        return
+    events = await database_sync_to_async(_take_events)()
+    for user_id, event in events.items():
+        await channel_layer.group_send(user_group_name(user_id), event)
+
+
+def ensure_flusher():
+    ticks.ensure_periodic('inbox', TICK, flush)
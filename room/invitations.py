@@ -0,0 +1,78 @@
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.utils import timezone
+
+from .cache import RoomMembership
+from .models import Invitation
+
+INVITATION_LIFETIME = timezone.timedelta(days=7)
+MAX_BULK_INVITES = 1000
+EXPIRE_CHUNK_SIZE = 500
+
+
+def not_expired(now):
+    """Filter for invitations still open at ``now``; one without an expiry date never expires."""
+    return Q(expires_at__isnull=True) | Q(expires_at__gt=now)
+
+
+def bulk_invite(room, invited_by, usernames):
+    """Invite many users to a room with a fixed number of queries.
+
+    Returns a dict of username lists: invited, already_member,
+    already_invited and not_found.
+    """
+    usernames = set(usernames)
+    now = timezone.now()
+
+    # Resolve every username in one query
+    users = dict(User.objects.filter(username__in=usernames).values_list('id', 'username'))
+    user_ids = set(users)
+
+    member_ids = set(RoomMembership.objects.filter(
+        room_id=room.id,
+        user_id__in=user_ids
+    ).values_list('user_id', flat=True))
+
+    invited_ids = set(Invitation.objects.filter(
+        not_expired(now),
+        room_id=room.id,
+        invited_user_id__in=user_ids - member_ids,
+        status='pending'
+    ).values_list('invited_user_id', flat=True))
+
+    new_ids = user_ids - member_ids - invited_ids
+    Invitation.objects.bulk_create([
+        Invitation(
+            room_id=room.id,
+            invited_by=invited_by,
+            invited_user_id=user_id,
+            status='pending',
+            expires_at=now + INVITATION_LIFETIME
+        )
+        for user_id in new_ids
+    ])
+
+    return {
+        'invited': sorted(users[user_id] for user_id in new_ids),
+        'already_member': sorted(users[user_id] for user_id in member_ids),
+        'already_invited': sorted(users[user_id] for user_id in invited_ids),
+        'not_found': sorted(usernames - set(users.values())),
+    }
+
+
+def expire_invitations(chunk_size=EXPIRE_CHUNK_SIZE, now=None):
+    """Mark stale pending invitations as expired.
+
+    Works in chunks of ids taken from the (status, expires_at) index so that
+    each UPDATE stays short. Returns the number of invitations expired.
+    """
+    now = now or timezone.now()
+    total = 0
+    while True:
+        ids = list(Invitation.objects.filter(
+            status='pending',
+            expires_at__lte=now
+        ).order_by('status', 'expires_at').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return total
+        total += Invitation.objects.filter(id__in=ids, status='pending').update(status='expired')
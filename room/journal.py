@@ -0,0 +1,404 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+
+from .models import Message
+from .routers import message_db_for_room
+from .sequence import allocator as seq_allocator
+from .signals import messages_stored
+
+logger = logging.getLogger(__name__)
+
+# With MESSAGE_JOURNAL_DIR set, new messages are appended to a per-process
+# journal file and acknowledged once it is fsynced. Writers arriving within
+# MESSAGE_JOURNAL_COMMIT_WINDOW share one fsync (group commit). A background
+# thread then bulk inserts the journaled messages and records how far it
+# got in a checkpoint file. Journals left behind by a crashed process are
+# replayed the next time a process opens the journal directory.
+#
+# Message ids are handed out before the row exists, from blocks reserved
+# in the message database's AUTOINCREMENT sequence, so replays are
+# idempotent and ordinary inserts never reuse a reserved id.
+#
+# A batch that still fails after MESSAGE_JOURNAL_APPLY_ATTEMPTS tries is
+# appended to the process's dead-letter file in the journal directory, to
+# be looked into and applied by hand, and the journal moves on past it.
+
+COMMIT_WINDOW = getattr(settings, 'MESSAGE_JOURNAL_COMMIT_WINDOW', 0.005)
+ID_BLOCK_SIZE = getattr(settings, 'MESSAGE_JOURNAL_ID_BLOCK_SIZE', 1000)
+MAX_JOURNAL_BYTES = getattr(settings, 'MESSAGE_JOURNAL_MAX_BYTES', 64 * 1024 * 1024)
+APPLY_ATTEMPTS = getattr(settings, 'MESSAGE_JOURNAL_APPLY_ATTEMPTS', 5)
+APPLY_RETRY_DELAY = 1
+
+
+def reserve_message_ids(using, count):
+    """Reserve ``count`` message ids in a SQLite message database."""
+    table = Message._meta.db_table
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute('UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s', [count, table])
+        if cursor.rowcount:
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            end = cursor.fetchone()[0]
+        else:
+            cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+            end = cursor.fetchone()[0] + count
+            cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, end])
+    return range(end - count + 1, end + 1)
+
+
+class MessageIdAllocator:
+    def __init__(self, block_size=ID_BLOCK_SIZE):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def next_id_nowait(self, using):
+        """Return the next id, or None if a new block has to be reserved."""
+        with self._lock:
+            block = self._blocks.get(using)
+            if block:
+                return next(block, None)
+            return None
+
+    def next_id(self, using):
+        message_id = self.next_id_nowait(using)
+        while message_id is None:
+            block = iter(reserve_message_ids(using, self.block_size))
+            with self._lock:
+                self._blocks[using] = block
+            message_id = self.next_id_nowait(using)
+        return message_id
+
+
+def message_from_record(record):
+    return Message(
+        id=record['id'],
+        room_id=record['room_id'],
+        user_id=record['user_id'],
+        content=record['content'],
+        target_user_id=record['target_user_id'],
+        is_targeted=record['is_targeted'],
+        seq=record.get('seq'),
+        date_added=datetime.fromisoformat(record['date_added'])
+    )
+
+
+def new_messages(using, messages):
+    """The messages whose preassigned ids are not stored in ``using`` yet."""
+    stored = set(Message.objects.using(using).filter(
+        id__in=[message.id for message in messages]
+    ).values_list('id', flat=True))
+    return [message for message in messages if message.id not in stored]
+
+
+def apply_records(records):
+    """Insert journaled messages, skipping any that are already stored."""
+    by_db = {}
+    for record in records:
+        by_db.setdefault(record['db'], []).append(message_from_record(record))
+    for using, messages in by_db.items():
+        # Retries and replays repeat records that were stored already, and
+        # the rollups count every message they are sent
+        messages = new_messages(using, messages)
+        if not messages:
+            continue
+        with transaction.atomic(using=using):
+            Message.objects.using(using).bulk_create(messages, ignore_conflicts=True)
+        messages_stored.send(sender=Message, messages=messages, using=using)
+
+
+def read_journal(path, after_seq=0):
+    records = []
+    with open(path, 'rb') as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn final write from a crash; nothing after it was acknowledged
+                break
+            if record['journal_seq'] > after_seq:
+                records.append(record)
+    return records
+
+
+def encode_records(records):
+    return b''.join(json.dumps(record, separators=(',', ':')).encode() + b'\n' for record in records)
+
+
+def write_dead_letters(path, records):
+    with open(path, 'ab') as dead_letters:
+        dead_letters.write(encode_records(records))
+        dead_letters.flush()
+        os.fsync(dead_letters.fileno())
+
+
+def read_checkpoint(path):
+    try:
+        return int(path.read_text() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, seq):
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as checkpoint:
+        checkpoint.write(str(seq))
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+    os.replace(tmp_path, path)
+
+
+def replay_orphaned_journals(directory):
+    """Apply and remove journals whose owning process is gone.
+
+    Returns the number of messages replayed.
+    """
+    replayed = 0
+    for path in sorted(Path(directory).glob('journal-*.log')):
+        with open(path, 'rb+') as journal:
+            try:
+                fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # still owned by a live process
+            checkpoint_path = path.with_suffix('.applied')
+            records = read_journal(path, read_checkpoint(checkpoint_path))
+            if records:
+                apply_records(records)
+                replayed += len(records)
+            checkpoint_path.unlink(missing_ok=True)
+            path.unlink()
+    return replayed
+
+
+class MessageJournal:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        replayed = replay_orphaned_journals(self.directory)
+        if replayed:
+            logger.info('Replayed %d journaled message(s)', replayed)
+
+        self.path = self.directory / f'journal-{os.getpid()}.log'
+        self.checkpoint_path = self.path.with_suffix('.applied')
+        self.dead_letter_path = self.directory / f'dead-letter-{os.getpid()}.log'
+        self._file = open(self.path, 'ab')
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self.ids = MessageIdAllocator()
+        self._cond = threading.Condition()
+        self._pending = []
+        self._seq = 0
+        self._written_seq = 0
+        self._applied_seq = 0
+        self._closing = False
+        self._apply_queue = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._commit_loop, name='message-journal-commit', daemon=True),
+            threading.Thread(target=self._apply_loop, name='message-journal-apply', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        """Write and apply everything appended so far, then stop the threads and close the file."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        for thread in self._threads:
+            thread.join()
+        self._file.close()
+
+    def append(self, record):
+        """Queue a record; the returned future resolves once it is on disk."""
+        future = Future()
+        with self._cond:
+            self._seq += 1
+            # 'seq' is the message's sequence number in its room
+            record['journal_seq'] = self._seq
+            self._pending.append((record, future))
+            self._cond.notify()
+        return future
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending:
+                    # Closing, and every batch is with the apply thread
+                    self._apply_queue.put(None)
+                    return
+            # Give concurrent writers a chance to join this fsync
+            time.sleep(COMMIT_WINDOW)
+            with self._cond:
+                batch, self._pending = self._pending, []
+            try:
+                self._maybe_truncate()
+                self._file.write(encode_records(record for record, _ in batch))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError as exc:
+                for _, future in batch:
+                    future.set_exception(exc)
+                continue
+            self._written_seq = batch[-1][0]['journal_seq']
+            for record, future in batch:
+                future.set_result(record)
+            self._apply_queue.put([record for record, _ in batch])
+
+    def _maybe_truncate(self):
+        # Everything written so far is applied, so the file can start over
+        if self._applied_seq == self._written_seq and self._file.tell() > MAX_JOURNAL_BYTES:
+            self._file.truncate(0)
+            self._file.seek(0)
+
+    def _apply_loop(self):
+        while True:
+            records = self._apply_queue.get()
+            if records is None:
+                connections.close_all()
+                return
+            while not self._apply_queue.empty():
+                more = self._apply_queue.get_nowait()
+                if more is None:
+                    # Closing: apply what came before, then stop
+                    self._apply_queue.put(None)
+                    break
+                records.extend(more)
+            for attempt in range(1, APPLY_ATTEMPTS + 1):
+                try:
+                    apply_records(records)
+                    break
+                except Exception as exc:
+                    if attempt == APPLY_ATTEMPTS:
+                        logger.exception('Applying %d journaled message(s) failed %d times', len(records), attempt)
+                    else:
+                        logger.warning(
+                            'Applying %d journaled message(s) failed (attempt %d of %d), retrying: %s',
+                            len(records), attempt, APPLY_ATTEMPTS, exc
+                        )
+                        time.sleep(APPLY_RETRY_DELAY)
+                finally:
+                    close_old_connections()
+            else:
+                # A poison record must not hold back every later message
+                try:
+                    write_dead_letters(self.dead_letter_path, records)
+                except OSError:
+                    logger.exception('Writing %d journaled message(s) to the dead-letter file failed', len(records))
+                    continue
+                logger.error('Moved %d journaled message(s) to %s', len(records), self.dead_letter_path)
+            try:
+                write_checkpoint(self.checkpoint_path, records[-1]['journal_seq'])
+            except OSError:
+                logger.exception('Writing the journal checkpoint failed')
+                continue
+            self._applied_seq = records[-1]['journal_seq']
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """Return this process's journal, or None if journaling is disabled."""
+    global _journal
+    directory = getattr(settings, 'MESSAGE_JOURNAL_DIR', None)
+    if not directory:
+        return None
+    with _journal_lock:
+        if _journal is None:
+            _journal = MessageJournal(directory)
+    return _journal
+
+
+def close_journal():
+    """Close this process's journal, if it is open; the next message opens it again."""
+    global _journal
+    with _journal_lock:
+        message_journal, _journal = _journal, None
+    if message_journal is not None:
+        message_journal.close()
+
+
+def _build_message(room, user, content, target_user, is_targeted, message_id, seq):
+    return Message(
+        id=message_id,
+        room=room,
+        user=user,
+        content=content,
+        target_user=target_user,
+        is_targeted=is_targeted,
+        seq=seq
+    )
+
+
+def _record_for(message, using):
+    return {
+        'id': message.id,
+        'db': using,
+        'room_id': message.room_id,
+        'user_id': message.user_id,
+        'content': message.content,
+        'target_user_id': message.target_user_id,
+        'is_targeted': message.is_targeted,
+        'seq': message.seq,
+        'date_added': message.date_added.isoformat(),
+    }
+
+
+def post_message(room, user, content, target_user=None, is_targeted=False):
+    """Store a new message and return it.
+
+    With journaling enabled the message is durable in the journal when this
+    returns but may not be in the database yet.
+    """
+    using = message_db_for_room(room.id)
+    seq = seq_allocator.next_seq(room.id)
+    journal = get_journal()
+    if journal is None:
+        message = Message.objects.using(using).create(
+            room=room,
+            user=user,
+            content=content,
+            target_user=target_user,
+            is_targeted=is_targeted,
+            seq=seq
+        )
+        messages_stored.send(sender=Message, messages=[message], using=using)
+        return message
+
+    message = _build_message(room, user, content, target_user, is_targeted, journal.ids.next_id(using), seq)
+    journal.append(_record_for(message, using)).result()
+    return message
+
+
+async def apost_message(room, user, content, target_user=None, is_targeted=False):
+    """Async variant of post_message for consumers."""
+    if not getattr(settings, 'MESSAGE_JOURNAL_DIR', None):
+        return await database_sync_to_async(post_message)(room, user, content, target_user, is_targeted)
+    # Opening the journal may replay old journals into the database
+    journal = _journal or await database_sync_to_async(get_journal)()
+
+    using = message_db_for_room(room.id)
+    message_id = journal.ids.next_id_nowait(using)
+    if message_id is None:
+        message_id = await database_sync_to_async(journal.ids.next_id)(using)
+    seq = seq_allocator.next_seq_nowait(room.id)
+    if seq is None:
+        seq = await database_sync_to_async(seq_allocator.next_seq)(room.id)
+    message = _build_message(room, user, content, target_user, is_targeted, message_id, seq)
+    await asyncio.wrap_future(journal.append(_record_for(message, using)))
+    return message
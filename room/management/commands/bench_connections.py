@@ -0,0 +1,54 @@
+import asyncio
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from room.benchmarks import connections_per_worker, idle_app, measure_idle_connections
+from room.consumers import ChatConsumer, LeanChatConsumer
+from room.dataset import DatasetGenerator
+from room.models import Room
+
+CONSUMERS = {
+    'asgi': idle_app,
+    'chat': ChatConsumer.as_asgi(),
+    'lean': LeanChatConsumer.as_asgi(),
+}
+
+
+class Command(BaseCommand):
+    help = 'Measure the memory and tasks each idle chat websocket costs, and how many fit in a worker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=10, help='Rooms to spread the connections over.')
+        parser.add_argument('--memory', type=int, default=1024, help='Worker memory budget in MB.')
+        parser.add_argument(
+            '--consumer', choices=sorted(CONSUMERS), action='append',
+            help='Consumer to measure (repeatable). "asgi" is a bare ASGI app for reference. Default: all.'
+        )
+        parser.add_argument('--prefix', default='connbench', help='Prefix for the temporary users and rooms.')
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if Room.objects.filter(slug__startswith=f'{prefix}-room-').exists():
+            raise CommandError(f'Rooms with prefix "{prefix}" already exist.')
+
+        generator = DatasetGenerator(prefix=prefix)
+        user_ids = generator.create_users(options['connections'])
+        try:
+            rooms = generator.create_rooms(options['rooms'], user_ids, private_ratio=0)
+            users = list(User.objects.filter(id__in=user_ids).order_by('id'))
+            room_slugs = [room.slug for room in Room.objects.filter(id__in=[room.id for room in rooms])]
+
+            memory_budget = options['memory'] * 1024 * 1024
+            for name in options['consumer'] or sorted(CONSUMERS):
+                result = asyncio.run(measure_idle_connections(CONSUMERS[name], users, room_slugs))
+                self.stdout.write(
+                    f'{name:>5}: {result["bytes_per_connection"] / 1024:8.1f} KiB and '
+                    f'{result["tasks_per_connection"]:.2f} tasks per idle connection, '
+                    f'~{connections_per_worker(result["bytes_per_connection"], memory_budget):,} '
+                    f'connections in {options["memory"]} MB'
+                )
+        finally:
+            Room.objects.filter(slug__startswith=f'{prefix}-room-').delete()
+            User.objects.filter(id__in=user_ids).delete()
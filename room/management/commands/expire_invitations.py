@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from room.invitations import EXPIRE_CHUNK_SIZE, expire_invitations
+
+
+class Command(BaseCommand):
+    help = 'Mark pending invitations past their expiry date as expired.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=EXPIRE_CHUNK_SIZE)
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep running and sweep every INTERVAL seconds.'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            expired = expire_invitations(chunk_size=options['chunk_size'])
+            self.stdout.write(f'Expired {expired} invitation(s).')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from room.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, iter_transcript
+from room.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Write the full transcript of a room as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug', help='Slug of the room.')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--output', default='-', help='Output file, or - for stdout.')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            room = Room.objects.get(slug=options['slug'])
+        except Room.DoesNotExist:
+            raise CommandError(f'Room "{options["slug"]}" does not exist.')
+
+        chunks = iter_transcript(room, options['format'], options['chunk_size'])
+        if options['output'] == '-':
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+
+        with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+            for chunk in chunks:
+                output.write(chunk)
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from room.dataset import DatasetGenerator
+from room.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Generate a deterministic synthetic dataset of users, rooms and messages for benchmarks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--rooms-per-user', type=float, default=3, help='Average memberships per user.')
+        parser.add_argument('--private-ratio', type=float, default=0.5)
+        parser.add_argument('--targeted-ratio', type=float, default=0.05, help='Share of targeted messages.')
+        parser.add_argument('--read-ratio', type=float, default=0.3, help='Share of messages with read receipts.')
+        parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent for room size and activity.')
+        parser.add_argument('--days', type=int, default=90, help='Days of history to spread messages over.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='bench', help='Prefix for generated usernames and room slugs.')
+
+    def handle(self, *args, **options):
+        if Room.objects.filter(slug__startswith=f'{options["prefix"]}-room-').exists():
+            raise CommandError(f'A dataset with prefix "{options["prefix"]}" already exists.')
+
+        started = time.monotonic()
+
+        def progress(message):
+            self.stdout.write(f'[{time.monotonic() - started:7.1f}s] {message}')
+
+        DatasetGenerator(
+            seed=options['seed'],
+            prefix=options['prefix'],
+            skew=options['skew'],
+            days=options['days'],
+            progress=progress
+        ).generate(
+            users=options['users'],
+            rooms=options['rooms'],
+            messages=options['messages'],
+            rooms_per_user=options['rooms_per_user'],
+            private_ratio=options['private_ratio'],
+            targeted_ratio=options['targeted_ratio'],
+            read_ratio=options['read_ratio']
+        )
+        self.stdout.write(self.style.SUCCESS(f'Dataset generated in {time.monotonic() - started:.1f}s.'))
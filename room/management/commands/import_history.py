@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from room.importer import IMPORT_BATCH_SIZE, HistoryImporter
+
+
+class Command(BaseCommand):
+    help = 'Import chat history from an NDJSON file, resuming from a checkpoint.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='NDJSON file with one message per line.')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument(
+            '--checkpoint',
+            help='Checkpoint file used to resume an interrupted import (default: FILE.checkpoint).'
+        )
+        parser.add_argument('--create-users', action='store_true', help='Create unknown users.')
+        parser.add_argument('--create-rooms', action='store_true', help='Create unknown rooms.')
+
+    def handle(self, *args, **options):
+        importer = HistoryImporter(
+            checkpoint_path=options['checkpoint'] or f'{options["file"]}.checkpoint',
+            create_users=options['create_users'],
+            create_rooms=options['create_rooms']
+        )
+        started = time.monotonic()
+
+        def progress(importer):
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f'{importer.imported} imported, {importer.skipped} skipped '
+                f'({importer.imported / max(elapsed, 1e-6):.0f} rows/s)'
+            )
+
+        with open(options['file'], 'rb') as source:
+            importer.run(source, options['batch_size'], progress)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {importer.imported} message(s), skipped {importer.skipped} in {elapsed:.1f}s.'
+        ))
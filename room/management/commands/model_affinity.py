@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from room.affinity import HashRing, ring_hash
+from room.benchmarks import moved_rooms, model_fanout
+
+
+class Command(BaseCommand):
+    help = (
+        'Model cross-process chat deliveries with and without room affinity, and how rooms move on rebalance. '
+        'Nothing is sent: the figures come from room/benchmarks.py model_fanout.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--rooms', type=int, default=1000)
+        parser.add_argument('--members', type=int, default=20, help='Open sockets per room.')
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        workers = [f'/workers/{i}' for i in range(options['workers'])]
+        rooms = [f'room-{i}' for i in range(options['rooms'])]
+        ring = HashRing(workers)
+        for name, placement in (('random', None), ('affinity', ring)):
+            result = model_fanout(
+                workers, rooms, options['members'], options['messages'], ring=placement, seed=options['seed']
+            )
+            self.stdout.write(
+                f'{name:>8} (model): {result["cross_process"]:,} of {result["deliveries"]:,} deliveries cross processes '
+                f'({result["cross_process"] / result["deliveries"]:.1%}), '
+                f'{result["worker_hops"] / options["messages"]:.2f} other workers per message, '
+                f'busiest worker has {result["busiest_worker_share"]:.1%} of the sockets'
+            )
+
+        # Rebalancing: the ring moves about 1/n of the rooms, hashing modulo the worker count most of them
+        grown = HashRing(workers + [f'/workers/{len(workers)}'])
+        shrunk = HashRing(workers[1:])
+        modulo = moved_rooms(
+            rooms,
+            lambda room: ring_hash(room) % len(workers),
+            lambda room: ring_hash(room) % (len(workers) + 1)
+        )
+        self.stdout.write(
+            f'Adding a worker moves {moved_rooms(rooms, ring.node_for, grown.node_for):.1%} of the rooms '
+            f'(ideal {1 / (len(workers) + 1):.1%}, modulo hashing {modulo:.1%}); '
+            f'removing one moves {moved_rooms(rooms, ring.node_for, shrunk.node_for):.1%} '
+            f'(ideal {1 / len(workers):.1%})'
+        )
@@ -0,0 +1,77 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from room.retention import (
+    PRUNE_BATCH_SIZE, PRUNE_PAUSE, enable_incremental_vacuum, incremental_vacuum,
+    prune_room, retention_cutoff, rooms_with_retention,
+)
+from room.routers import message_databases
+
+
+class Command(BaseCommand):
+    help = 'Delete messages older than each room\'s retention period in small batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='Only prune the room with this slug.')
+        parser.add_argument('--batch-size', type=int, default=PRUNE_BATCH_SIZE)
+        parser.add_argument(
+            '--pause', type=float, default=PRUNE_PAUSE,
+            help='Seconds to sleep between batches.'
+        )
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep running and prune every INTERVAL seconds.'
+        )
+        parser.add_argument(
+            '--vacuum-pages', type=int, default=0,
+            help='Pages to free with incremental vacuum after pruning (0 frees all).'
+        )
+        parser.add_argument(
+            '--enable-incremental-vacuum', action='store_true',
+            help='Switch the database to incremental auto-vacuum (runs a full VACUUM once).'
+        )
+
+    def handle(self, *args, **options):
+        if options['enable_incremental_vacuum']:
+            for using in message_databases():
+                if not enable_incremental_vacuum(using):
+                    raise CommandError('Incremental vacuum is only supported on SQLite.')
+                self.stdout.write(f'Enabled incremental auto-vacuum on {using}.')
+
+        while True:
+            self.prune(options)
+            for using in message_databases():
+                if incremental_vacuum(using, options['vacuum_pages']):
+                    self.stdout.write(f'Ran incremental vacuum on {using}.')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def prune(self, options):
+        rooms = rooms_with_retention()
+        if options['room']:
+            rooms = rooms.filter(slug=options['room'])
+
+        now = timezone.now()
+        total = 0
+        started = time.monotonic()
+        for room in rooms.iterator():
+            cutoff = retention_cutoff(room, now)
+            if cutoff is None:
+                continue
+            room_started = time.monotonic()
+            deleted = prune_room(room, cutoff, options['batch_size'], options['pause'])
+            if deleted:
+                elapsed = time.monotonic() - room_started
+                self.stdout.write(
+                    f'{room.slug}: pruned {deleted} message(s) in {elapsed:.1f}s '
+                    f'({deleted / max(elapsed, 1e-6):.0f} rows/s)'
+                )
+            total += deleted
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Pruned {total} message(s) in {elapsed:.1f}s ({total / max(elapsed, 1e-6):.0f} rows/s).'
+        ))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from room.analytics import BACKFILL_CHUNK_SIZE, clear, rebuild
+from room.models import Room
+from room.routers import message_databases
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the hourly room analytics from the message tables in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='Only rebuild the room with this slug.')
+        parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        room_ids = None
+        if options['room']:
+            room_ids = list(Room.objects.filter(slug=options['room']).values_list('id', flat=True))
+            if not room_ids:
+                raise CommandError(f'Room "{options["room"]}" does not exist.')
+
+        clear(room_ids)
+        total = 0
+        for using in message_databases():
+            def progress(replayed):
+                self.stdout.write(f'{using}: {replayed} message(s)')
+
+            total += rebuild(using, room_ids, options['chunk_size'], progress if options['verbosity'] > 1 else None)
+        self.stdout.write(self.style.SUCCESS(f'Replayed {total} message(s) into the analytics rollup.'))
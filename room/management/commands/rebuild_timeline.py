@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from room.models import Room
+from room.timeline import rebuild_room
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the per-day message rollup (RoomDay) from the message tables. '
+        'Run it after enabling shards or deleting messages outside the retention tools.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='Only rebuild the room with this slug.')
+
+    def handle(self, *args, **options):
+        rooms = Room.objects.only('id', 'slug').order_by('id')
+        if options['room']:
+            rooms = rooms.filter(slug=options['room'])
+            if not rooms.exists():
+                raise CommandError(f'Room "{options["room"]}" does not exist.')
+
+        total = 0
+        for room in rooms.iterator():
+            days = rebuild_room(room.id)
+            total += days
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{room.slug}: {days} day(s)')
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {total} room day(s).'))
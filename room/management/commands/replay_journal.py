@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from room.journal import replay_orphaned_journals
+
+
+class Command(BaseCommand):
+    help = 'Store messages left in the journal by processes that have exited.'
+
+    def handle(self, *args, **options):
+        directory = getattr(settings, 'MESSAGE_JOURNAL_DIR', None)
+        if not directory:
+            raise CommandError('MESSAGE_JOURNAL_DIR is not set.')
+        replayed = replay_orphaned_journals(directory)
+        self.stdout.write(self.style.SUCCESS(f'Replayed {replayed} message(s).'))
@@ -0,0 +1,62 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from room.membership import MEMBERSHIP_CHUNK_SIZE, add_members, remove_members, resolve_usernames
+from room.models import Room
+
+
+class Command(BaseCommand):
+    help = 'Add or remove room members in bulk from a list of usernames.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug', help='Slug of the room.')
+        parser.add_argument('action', choices=['add', 'remove'])
+        parser.add_argument('file', help='File with one username per line, or - for stdin.')
+        parser.add_argument(
+            '--csv-column',
+            help='Read the file as CSV and take usernames from this column.'
+        )
+        parser.add_argument('--chunk-size', type=int, default=MEMBERSHIP_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            room = Room.objects.get(slug=options['slug'])
+        except Room.DoesNotExist:
+            raise CommandError(f'Room "{options["slug"]}" does not exist.')
+
+        usernames = self.read_usernames(options['file'], options['csv_column'])
+        user_ids = resolve_usernames(usernames, chunk_size=options['chunk_size'])
+        missing = len(usernames) - len(user_ids)
+        if missing:
+            self.stderr.write(f'{missing} username(s) not found, skipping.')
+
+        def progress(processed, total):
+            self.stdout.write(f'{processed}/{total} users processed')
+
+        bulk_action = add_members if options['action'] == 'add' else remove_members
+        changed = bulk_action(
+            room,
+            user_ids.values(),
+            chunk_size=options['chunk_size'],
+            progress=progress
+        )
+        verb = 'Added' if options['action'] == 'add' else 'Removed'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {changed} member(s) in {room.name}.'))
+
+    def read_usernames(self, path, csv_column):
+        handle = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            if csv_column:
+                reader = csv.DictReader(handle)
+                if csv_column not in (reader.fieldnames or []):
+                    raise CommandError(f'Column "{csv_column}" not found.')
+                usernames = {row[csv_column].strip() for row in reader}
+            else:
+                usernames = {line.strip() for line in handle}
+        finally:
+            if handle is not sys.stdin:
+                handle.close()
+        usernames.discard('')
+        return usernames
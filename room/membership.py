@@ -0,0 +1,89 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+
+from . import cache, mentions
+from .cache import RoomMembership
+from .models import Room
+
+# Bulk membership changes write the through table directly, so no
+# m2m_changed signal fires per user. Caches and Room.participant_count are
+# brought up to date here instead, once per chunk.
+
+MEMBERSHIP_CHUNK_SIZE = 1000
+
+
+def refresh_participant_count(room_id):
+    Room.objects.filter(pk=room_id).update(
+        participant_count=RoomMembership.objects.filter(room_id=room_id).count()
+    )
+
+
+def increment_participant_count(room_id, delta):
+    Room.objects.filter(pk=room_id).update(participant_count=F('participant_count') + delta)
+
+
+def _chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def resolve_usernames(usernames, chunk_size=MEMBERSHIP_CHUNK_SIZE):
+    """Map usernames to user ids. Unknown usernames are left out."""
+    user_ids = {}
+    for chunk in _chunks(set(usernames), chunk_size):
+        user_ids.update(User.objects.filter(username__in=chunk).values_list('username', 'id'))
+    return user_ids
+
+
+def add_members(room, user_ids, chunk_size=MEMBERSHIP_CHUNK_SIZE, progress=None):
+    """Add users to a room in chunks. Returns the number of users added.
+
+    ``progress`` is called with (processed, total) after every chunk.
+    """
+    user_ids = set(user_ids)
+    added = 0
+    processed = 0
+    for chunk in _chunks(user_ids, chunk_size):
+        with transaction.atomic():
+            existing = set(RoomMembership.objects.filter(
+                room_id=room.id,
+                user_id__in=chunk
+            ).values_list('user_id', flat=True))
+            new_ids = [user_id for user_id in chunk if user_id not in existing]
+            RoomMembership.objects.bulk_create(
+                [RoomMembership(room_id=room.id, user_id=user_id) for user_id in new_ids],
+                ignore_conflicts=True
+            )
+            if new_ids:
+                increment_participant_count(room.id, len(new_ids))
+        if new_ids:
+            mentions.members_changed(room.id, cache.bump_members_version(room.id), added=new_ids)
+        added += len(new_ids)
+        processed += len(chunk)
+        if progress:
+            progress(processed, len(user_ids))
+    return added
+
+
+def remove_members(room, user_ids, chunk_size=MEMBERSHIP_CHUNK_SIZE, progress=None):
+    """Remove users from a room in chunks. Returns the number of users removed.
+
+    The room creator is never removed.
+    """
+    user_ids = set(user_ids) - {room.created_by_id}
+    removed = 0
+    processed = 0
+    for chunk in _chunks(user_ids, chunk_size):
+        with transaction.atomic():
+            deleted, _ = RoomMembership.objects.filter(room_id=room.id, user_id__in=chunk).delete()
+            if deleted:
+                increment_participant_count(room.id, -deleted)
+        if deleted:
+            mentions.members_changed(room.id, cache.bump_members_version(room.id), removed=chunk)
+        removed += deleted
+        processed += len(chunk)
+        if progress:
+            progress(processed, len(user_ids))
+    return removed
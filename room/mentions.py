@@ -0,0 +1,136 @@
+import threading
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+
+from . import cache
+from .cache import RoomMembership
+
+# @mentions are matched against a per-room trie of participant usernames.
+# Every mention starts with "@", so the scan only walks the trie from each
+# "@" and needs no Aho-Corasick failure links: extraction is linear in the
+# message length, whatever the size of the room. The trie is rebuilt only
+# when the room's members version moved without this process seeing the
+# change. Membership changes made here are applied to it in place.
+
+MATCHER_CACHE_SIZE = 1000
+
+_END = object()
+
+
+def _is_name_char(char):
+    return char.isalnum() or char == '_'
+
+
+class MentionMatcher:
+    def __init__(self, version=None):
+        self.version = version
+        self.root = {}
+        self.usernames = {}
+
+    def add(self, user_id, username):
+        node = self.root
+        for char in username.lower():
+            node = node.setdefault(char, {})
+        node[_END] = user_id
+        self.usernames[user_id] = username
+
+    def remove(self, user_id):
+        username = self.usernames.pop(user_id, None)
+        if username is None:
+            return
+        path = [self.root]
+        for char in username.lower():
+            path.append(path[-1][char])
+        del path[-1][_END]
+        # Prune branches that no longer lead to a username
+        for char, parent in zip(reversed(username.lower()), reversed(path[:-1])):
+            if parent[char]:
+                break
+            del parent[char]
+
+    def find(self, text):
+        """Return the ids of users mentioned in ``text``, in order of appearance."""
+        lowered = text.lower()
+        mentioned = []
+        start = lowered.find('@')
+        while start != -1:
+            if start == 0 or not _is_name_char(lowered[start - 1]):
+                # Longest username that ends at a word boundary
+                node = self.root
+                match = None
+                position = start + 1
+                while position < len(lowered):
+                    node = node.get(lowered[position])
+                    if node is None:
+                        break
+                    position += 1
+                    if _END in node and (position == len(lowered) or not _is_name_char(lowered[position])):
+                        match = node[_END]
+                if match is not None and match not in mentioned:
+                    mentioned.append(match)
+            start = lowered.find('@', start + 1)
+        return mentioned
+
+
+_lock = threading.Lock()
+_matchers = OrderedDict()
+
+
+def _build_matcher(room_id, version):
+    matcher = MentionMatcher(version)
+    for user_id, username in RoomMembership.objects.filter(room_id=room_id).values_list('user_id', 'user__username'):
+        matcher.add(user_id, username)
+    return matcher
+
+
+def get_matcher(room_id):
+    version = cache.members_version(room_id)
+    with _lock:
+        matcher = _matchers.get(room_id)
+        if matcher is not None and matcher.version == version:
+            _matchers.move_to_end(room_id)
+            return matcher
+    matcher = _build_matcher(room_id, version)
+    with _lock:
+        _matchers[room_id] = matcher
+        while len(_matchers) > MATCHER_CACHE_SIZE:
+            _matchers.popitem(last=False)
+    return matcher
+
+
+def room_member_ids(room_id):
+    """Participant ids of a room, from the same cached index as mentions."""
+    matcher = get_matcher(room_id)
+    with _lock:
+        return list(matcher.usernames)
+
+
+def find_mentions(room_id, content, exclude=None):
+    """Ids of room participants mentioned in ``content``."""
+    if '@' not in content:
+        return []
+    return [user_id for user_id in get_matcher(room_id).find(content) if user_id != exclude]
+
+
+def members_changed(room_id, version, added=(), removed=()):
+    """Apply a membership change made by this process to its cached matcher.
+
+    ``version`` is the members version returned by the bump for this change.
+    If anything else bumped it in between, the matcher is left stale and is
+    rebuilt on next use.
+    """
+    with _lock:
+        matcher = _matchers.get(room_id)
+    if matcher is None:
+        return
+    usernames = dict(User.objects.filter(id__in=added).values_list('id', 'username')) if added else {}
+    with _lock:
+        if matcher.version is None or version != matcher.version + 1:
+            _matchers.pop(room_id, None)
+            return
+        for user_id in removed:
+            matcher.remove(user_id)
+        for user_id, username in usernames.items():
+            matcher.add(user_id, username)
+        matcher.version = version
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.3 on 2026-10-19 12:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0007_alter_invitation_options_alter_message_options_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['-last_activity'], name='room_last_activity_idx'),
+        ),
+    ]
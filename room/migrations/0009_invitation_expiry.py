@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-19 12:46
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0008_room_last_activity_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invitation',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('declined', 'Declined'), ('expired', 'Expired')], default='pending', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='invitation',
+            index=models.Index(fields=['status', 'expires_at'], name='invitation_status_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invitation',
+            index=models.Index(fields=['invited_user', 'status'], name='invitation_user_status_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.3 on 2026-10-19 12:46
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_participants(apps, schema_editor):
+    Room = apps.get_model('room', 'Room')
+    for room in Room.objects.annotate(total=Count('participants')):
+        room.participant_count = room.total
+        room.save(update_fields=['participant_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0009_invitation_expiry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_participants, reverse_code=migrations.RunPython.noop),
+    ]
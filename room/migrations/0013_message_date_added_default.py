@@ -0,0 +1,19 @@
+# Generated by Django 5.1.3 on 2026-10-19 12:53
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0012_message_shards'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='date_added',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
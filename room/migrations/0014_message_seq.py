@@ -0,0 +1,44 @@
+# Generated by Django 5.1.3 on 2026-10-19 13:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    # Number existing messages per room in (date_added, id) order
+    Message = apps.get_model('room', 'Message')
+    table = Message._meta.db_table
+    schema_editor.execute(
+        f'UPDATE {table} SET seq = numbered.seq FROM ('
+        f'SELECT id, ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY date_added, id) AS seq FROM {table}'
+        f') AS numbered WHERE {table}.id = numbered.id'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0013_message_date_added_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomSequence',
+            fields=[
+                ('room', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sequence', serialize=False, to='room.room')),
+                ('last_reserved', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'seq'], name='message_room_seq_idx'),
+        ),
+        migrations.RunPython(number_messages, reverse_code=migrations.RunPython.noop, hints={'model_name': 'message'}),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-19 13:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_room_days(apps, schema_editor):
+    # Messages kept in shard databases are rolled up by `manage.py rebuild_timeline`
+    Message = apps.get_model('room', 'Message')
+    RoomDay = apps.get_model('room', 'RoomDay')
+    schema_editor.execute(
+        f'INSERT INTO {RoomDay._meta.db_table} (room_id, day, message_count, first_message_id, last_message_id) '
+        f'SELECT room_id, date(date_added), COUNT(*), MIN(id), MAX(id) FROM {Message._meta.db_table} '
+        f'GROUP BY room_id, date(date_added)'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0015_read_markers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='days', to='room.room')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('room', 'day'), name='room_day_uniq')],
+            },
+        ),
+        migrations.RunPython(build_room_days, reverse_code=migrations.RunPython.noop),
+    ]
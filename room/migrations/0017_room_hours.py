@@ -0,0 +1,43 @@
+# Generated by Django 5.1.3 on 2026-10-19 13:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0016_room_days'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomHour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('targeted_count', models.PositiveIntegerField(default=0)),
+                ('sender_count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hours', to='room.room')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('room', 'hour'), name='room_hour_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RoomHourSender',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='room.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('room', 'hour', 'user'), name='room_hour_sender_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.3 on 2026-10-19 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('room', '0018_inbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatWorker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=200, unique=True)),
+                ('last_seen', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -2,8 +2,11 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils.text import slugify
 from django.utils import timezone
+from django.db.models import Max, prefetch_related_objects
 import uuid
 
+from .routers import message_db_for_room
+
 class Room(models.Model):   
     name = models.CharField(max_length=255)
     slug = models.SlugField(unique=True)
@@ -13,9 +16,15 @@ class Room(models.Model):
     last_activity = models.DateTimeField(auto_now=True)
     is_private = models.BooleanField(default=True)
     description = models.TextField(blank=True)
+    participant_count = models.PositiveIntegerField(default=0, editable=False)
+    # Messages older than this many days are pruned; empty keeps them forever
+    message_retention_days = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         ordering = ['-last_activity']
+        indexes = [
+            models.Index(fields=['-last_activity'], name='room_last_activity_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -30,40 +39,171 @@ class Room(models.Model):
         fifteen_minutes_ago = timezone.now() - timezone.timedelta(minutes=15)
         return self.participants.filter(last_login__gt=fifteen_minutes_ago)
 
+class MessageManager(models.Manager):
+    def for_room(self, room_id):
+        """Messages of one room, read from the database that stores them."""
+        return self.using(message_db_for_room(room_id)).filter(room_id=room_id)
+
+    def latest_for_rooms(self, room_ids):
+        """Map each room id to its most recent message, across all shards."""
+        rooms_by_db = {}
+        for room_id in room_ids:
+            rooms_by_db.setdefault(message_db_for_room(room_id), []).append(room_id)
+
+        latest = []
+        for db, ids in rooms_by_db.items():
+            last_ids = self.using(db).filter(room_id__in=ids).order_by().values('room_id').annotate(
+                last_id=Max('id')
+            ).values_list('last_id', flat=True)
+            latest.extend(self.using(db).filter(id__in=list(last_ids)))
+        prefetch_related_objects(latest, 'user')
+        return {message.room_id: message for message in latest}
+
+
 class Message(models.Model):
-    room = models.ForeignKey(Room, related_name='messages', on_delete=models.CASCADE)
-    user = models.ForeignKey(User, related_name='messages', on_delete=models.CASCADE)
+    # Messages may be stored in a different database from rooms and users
+    # (see room/routers.py), so none of their relations use DB constraints.
+    room = models.ForeignKey(Room, related_name='messages', on_delete=models.CASCADE, db_constraint=False)
+    user = models.ForeignKey(User, related_name='messages', on_delete=models.CASCADE, db_constraint=False)
     content = models.TextField()
-    date_added = models.DateTimeField(auto_now_add=True)
+    date_added = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
-    read_by_users = models.ManyToManyField(User, related_name='read_messages', blank=True)
+    read_by_users = models.ManyToManyField(User, related_name='read_messages', blank=True, db_constraint=False)
     target_user = models.ForeignKey(
         User, 
         related_name='targeted_messages', 
         on_delete=models.CASCADE, 
         null=True, 
-        blank=True
+        blank=True,
+        db_constraint=False
     )
     is_targeted = models.BooleanField(default=False)
+    # Per-room sequence number, increasing with each message (see room/sequence.py)
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+
+    objects = MessageManager()
+
+    def read_receipts(self):
+        """Read receipt rows for this message, without joining the user table."""
+        return Message.read_by_users.through.objects.using(self._state.db).filter(message_id=self.pk)
 
     def mark_as_read(self, user):
-        if user not in self.read_by_users.all():
+        receipts = self.read_receipts()
+        if not receipts.filter(user_id=user.pk).exists():
             self.read_by_users.add(user)
-            if self.read_by_users.count() == self.room.participants.count():
+            if receipts.count() == self.room.participant_count:
                 self.is_read = True
-                self.save()
+                self.save(update_fields=['is_read'])
 
     class Meta:
         ordering = ['-date_added']
+        indexes = [
+            models.Index(fields=['room', 'date_added'], name='message_room_date_idx'),
+            models.Index(fields=['room', 'seq'], name='message_room_seq_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.username}: {self.content[:50]}'
 
+class RoomSequence(models.Model):
+    """High-water mark of the message sequence numbers reserved for a room."""
+    room = models.OneToOneField(Room, primary_key=True, on_delete=models.CASCADE, related_name='sequence')
+    last_reserved = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.room_id}: {self.last_reserved}'
+
+class ReadMarker(models.Model):
+    """How far a user has read in a room, by message sequence number."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='read_markers')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_markers')
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='read_marker_room_user_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} read {self.room_id} up to {self.last_read_seq}'
+
+class RoomDay(models.Model):
+    """Per-room, per-day (UTC) message rollup, kept up to date by room/timeline.py."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='days')
+    day = models.DateField()
+    message_count = models.PositiveIntegerField(default=0)
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'day'], name='room_day_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.room_id} {self.day}: {self.message_count}'
+
+class RoomHour(models.Model):
+    """Hourly (UTC) per-room message analytics, kept up to date by room/analytics.py."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='hours')
+    hour = models.DateTimeField()
+    message_count = models.PositiveIntegerField(default=0)
+    targeted_count = models.PositiveIntegerField(default=0)
+    sender_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'hour'], name='room_hour_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.room_id} {self.hour:%Y-%m-%d %H}:00: {self.message_count}'
+
+    @property
+    def dm_ratio(self):
+        return self.targeted_count / self.message_count if self.message_count else 0
+
+class RoomHourSender(models.Model):
+    """Messages per sender per room hour; RoomHour.sender_count counts these rows."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    hour = models.DateTimeField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'hour', 'user'], name='room_hour_sender_uniq'),
+        ]
+
+class InboxEntry(models.Model):
+    """A targeted message its recipient's client has not acknowledged yet, see room/inbox.py."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inbox_entries')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='+')
+    # The message may live in a shard, so this is not a foreign key
+    message_id = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'message_id'], name='inbox_entry_user_message_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id}: message {self.message_id}'
+
+class ChatWorker(models.Model):
+    """A worker process serving chat websockets, registered by room/affinity.py."""
+    url = models.CharField(max_length=200, unique=True)
+    last_seen = models.DateTimeField()
+
+    def __str__(self):
+        return self.url
+
 class Invitation(models.Model):
     INVITATION_STATUS = (
         ('pending', 'Pending'),
         ('accepted', 'Accepted'),
         ('declined', 'Declined'),
+        ('expired', 'Expired'),
     )
     
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
@@ -75,6 +215,12 @@ class Invitation(models.Model):
     is_email_sent = models.BooleanField(default=False)
     invitation_code = models.CharField(max_length=50, unique=True, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='invitation_status_expiry_idx'),
+            models.Index(fields=['invited_user', 'status'], name='invitation_user_status_idx'),
+        ]
+
     def __str__(self):
         return f'Invitation to {self.room.name} for {self.invited_user.username}'
 
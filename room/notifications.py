@@ -0,0 +1,37 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+# Every websocket connection also joins a group for its user, so events
+# meant for particular users reach all of their connections and nobody
+# else's.
+
+
+def room_group_name(slug):
+    return f'chat_{slug}'
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def mention_event(room, message_id, username, content):
+    return {
+        'type': 'mention',
+        'room': room.slug,
+        'message_id': message_id,
+        'username': username,
+        'message': content
+    }
+
+
+async def send_mentions(channel_layer, user_ids, event):
+    for user_id in user_ids:
+        # A worker may share one channel between the groups of its users (see room/hubs.py)
+        await channel_layer.group_send(user_group_name(user_id), {**event, 'user_id': user_id})
+
+
+def notify_mentions(room, message, user_ids):
+    """Send mention events from synchronous code such as views."""
+    if user_ids:
+        event = mention_event(room, message.id, message.user.username, message.content)
+        async_to_sync(send_mentions)(get_channel_layer(), user_ids, event)
@@ -0,0 +1,176 @@
+import gc
+import json
+import time
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from unittest import skipUnless
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+# Helpers for the performance regression tests (room/tests.py and
+# core/tests.py). Query counts are captured on every configured database,
+# since messages may live in shards. Wall-clock timings depend on the
+# machine and its load, so they only run with DJANGO_PERF_TIMINGS=1, and
+# are compared with baselines kept in a local JSON file: the first run of
+# a benchmark records its best time, later runs fail when it is slower than
+# the baseline by more than the threshold. Set
+# DJANGO_PERF_UPDATE_BASELINES=1 to record new baselines after an intended
+# change.
+
+PERF_TIMINGS = getattr(settings, 'PERF_TIMINGS', False)
+PERF_BASELINE_FILE = getattr(settings, 'PERF_BASELINE_FILE', None)
+PERF_REGRESSION_THRESHOLD = getattr(settings, 'PERF_REGRESSION_THRESHOLD', 0.5)
+PERF_UPDATE_BASELINES = getattr(settings, 'PERF_UPDATE_BASELINES', False)
+# Slowdowns smaller than this are timer noise, whatever the ratio
+PERF_MIN_REGRESSION = 0.002
+
+
+class QueryCount:
+    def __init__(self, contexts):
+        self.contexts = contexts
+
+    @property
+    def queries(self):
+        return [query for context in self.contexts for query in context.captured_queries]
+
+    def __len__(self):
+        return sum(len(context) for context in self.contexts)
+
+    def __str__(self):
+        return '\n'.join(query['sql'] for query in self.queries)
+
+
+@contextmanager
+def count_queries():
+    """Capture the queries run on every database inside the block."""
+    with ExitStack() as stack:
+        contexts = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+        yield QueryCount(contexts)
+
+
+@asynccontextmanager
+async def acount_queries():
+    """count_queries() for async code, such as a consumer driven by a communicator."""
+    # Captured on the connections of the thread database_sync_to_async runs in
+    context = count_queries()
+    queries = await sync_to_async(context.__enter__)()
+    try:
+        yield queries
+    finally:
+        await sync_to_async(context.__exit__)(None, None, None)
+
+
+def best_time(func, repeat=7, setup=None):
+    """Fastest of ``repeat`` timed calls of ``func`` after one warm-up call.
+
+    ``setup`` runs untimed before each call. Like timeit, the garbage
+    collector is off while timing, and the minimum is reported since slower
+    runs measure other load on the machine.
+    """
+    times = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for attempt in range(repeat + 1):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            func()
+            if attempt:
+                times.append(time.perf_counter() - start)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return min(times)
+
+
+class TimingBaselines:
+    def __init__(self, path=PERF_BASELINE_FILE, threshold=PERF_REGRESSION_THRESHOLD, update=PERF_UPDATE_BASELINES):
+        self.path = path
+        self.threshold = threshold
+        self.update = update
+        self._baselines = None
+
+    @property
+    def baselines(self):
+        if self._baselines is None:
+            try:
+                with open(self.path) as f:
+                    self._baselines = json.load(f)
+            except (FileNotFoundError, TypeError, ValueError):
+                self._baselines = {}
+        return self._baselines
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path, 'w') as f:
+            json.dump(self.baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def check(self, name, seconds):
+        """Compare a timing with its baseline, recording it if there is none.
+
+        Returns an error message when it regressed beyond the threshold,
+        otherwise None.
+        """
+        baseline = self.baselines.get(name)
+        if baseline is None or self.update:
+            self.baselines[name] = round(seconds, 6)
+            self.save()
+            return None
+        limit = max(baseline * (1 + self.threshold), baseline + PERF_MIN_REGRESSION)
+        if seconds > limit:
+            return (
+                f'{name} took {seconds * 1000:.2f}ms, baseline {baseline * 1000:.2f}ms '
+                f'(limit {limit * 1000:.2f}ms, see {self.path})'
+            )
+        return None
+
+
+baselines = TimingBaselines()
+
+# Decorates tests that measure wall-clock time
+timing_test = skipUnless(PERF_TIMINGS, 'wall-clock timings run with DJANGO_PERF_TIMINGS=1')
+
+
+class PerformanceTestCase(TestCase):
+    """Query budgets checked at every size in ``sizes``, and timing baselines."""
+    databases = '__all__'
+    sizes = ()
+
+    def assertQueryBudget(self, name, budget, run, setup=None):
+        """``run(size)`` must run the same number of queries at every size, and at most ``budget``.
+
+        ``setup(size)`` runs first, unmeasured, and the cache is cleared so
+        the cold path is measured.
+        """
+        counts = {}
+        for size in self.sizes:
+            if setup:
+                setup(size)
+            cache.clear()
+            with count_queries() as counts[size]:
+                run(size)
+        self.assertQueryCounts(name, budget, counts)
+
+    def assertQueryCounts(self, name, budget, counts):
+        """Check ``{size: QueryCount}`` against the budget."""
+        for size, queries in counts.items():
+            self.assertLessEqual(
+                len(queries), budget,
+                f'{name} ran {len(queries)} queries at size {size}, budget {budget}:\n{queries}'
+            )
+        self.assertEqual(
+            len({len(queries) for queries in counts.values()}), 1,
+            f'{name} queries grow with the data: { {size: len(queries) for size, queries in counts.items()} }'
+        )
+
+    def assertTimingBaseline(self, name, run, setup=None, repeat=7):
+        error = baselines.check(name, best_time(run, repeat=repeat, setup=setup))
+        if error:
+            self.fail(error)
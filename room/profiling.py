@@ -0,0 +1,105 @@
+import cProfile
+import functools
+import os
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+# Opt-in cProfile sampling for views and websocket events. Nothing is
+# installed unless PROFILING_DIR is set. A request or event is profiled
+# when a staff user asks for it (X-Profile header, or ?profile=1 on the
+# websocket URL), when the user is listed in PROFILING_USERS, or at random
+# with probability PROFILING_SAMPLE_RATE. Only one profile runs at a time
+# and at most one starts per PROFILING_MIN_INTERVAL seconds, which bounds
+# the overhead. Profiles are pstats files, readable with
+# `python -m pstats` or snakeviz.
+#
+# A profiled websocket handler runs on the event loop, so the profile also
+# covers whatever other coroutines run while it awaits; ORM work done in
+# the database thread pool does not show up.
+
+PROFILING_DIR = getattr(settings, 'PROFILING_DIR', None)
+SAMPLE_RATE = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+PROFILING_USERS = frozenset(getattr(settings, 'PROFILING_USERS', ()))
+MIN_INTERVAL = getattr(settings, 'PROFILING_MIN_INTERVAL', 1.0)
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+_lock = threading.Lock()
+_last_started = 0.0
+
+
+def should_profile(user, requested=False):
+    if requested and user.is_staff:
+        return True
+    if user.is_authenticated and user.username in PROFILING_USERS:
+        return True
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+def _start():
+    """Return a running profiler, or None if one is already running or the rate limit is hit."""
+    global _last_started
+    if not _lock.acquire(blocking=False):
+        return None
+    now = time.monotonic()
+    if now - _last_started < MIN_INTERVAL:
+        _lock.release()
+        return None
+    _last_started = now
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop(profiler, label):
+    profiler.disable()
+    try:
+        directory = Path(PROFILING_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = re.sub(r'[^\w.-]+', '_', label)[:100]
+        profiler.dump_stats(directory / f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{name}.prof')
+    finally:
+        _lock.release()
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not PROFILING_DIR:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profiler = None
+        if should_profile(request.user, PROFILE_HEADER in request.META):
+            profiler = _start()
+        if profiler is None:
+            return self.get_response(request)
+        try:
+            return self.get_response(request)
+        finally:
+            _stop(profiler, f'{request.method}-{request.path}')
+
+
+def profiled_handler(handler):
+    """Sample-profile an async consumer handler; a no-op unless profiling is enabled."""
+    if not PROFILING_DIR:
+        return handler
+
+    @functools.wraps(handler)
+    async def wrapper(self, *args, **kwargs):
+        profiler = None
+        if should_profile(self.scope['user'], getattr(self, 'profile_requested', False)):
+            profiler = _start()
+        if profiler is None:
+            return await handler(self, *args, **kwargs)
+        try:
+            return await handler(self, *args, **kwargs)
+        finally:
+            _stop(profiler, f'ws-{handler.__name__}-{self.scope["path"]}')
+
+    return wrapper
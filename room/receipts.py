@@ -0,0 +1,136 @@
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Max
+
+from . import cache, ticks
+from .models import Message, ReadMarker, Room
+from .notifications import room_group_name
+
+# Clients report "read up to <seq>" over the websocket. Reports are kept in
+# memory, latest per reader, and once per tick each room's batch is
+# persisted and broadcast as a single read_receipts event. A reader's
+# receipts for the whole newly read range are written with one
+# INSERT ... SELECT, and ReadMarker keeps each reader's high-water mark so
+# the next range starts where the last one ended.
+
+TICK = getattr(settings, 'READ_RECEIPT_TICK', 1.0)
+
+_lock = threading.Lock()
+_pending = {}
+
+
+def record_read(room_id, user_id, up_to):
+    if not ticks.is_running('receipts'):
+        return
+    with _lock:
+        readers = _pending.setdefault(room_id, {})
+        if up_to > readers.get(user_id, 0):
+            readers[user_id] = up_to
+
+
+def persist_reads(room, reads):
+    """Store read receipts for ``{user_id: up_to_seq}``; returns the readers that advanced."""
+    room_id = room.pk
+    # Clients report any number they like; nobody reads past the latest message
+    latest = Message.objects.for_room(room_id).aggregate(seq=Max('seq'))['seq'] or 0
+    reads = {user_id: min(up_to, latest) for user_id, up_to in reads.items()}
+    markers = dict(ReadMarker.objects.filter(
+        room_id=room_id, user_id__in=list(reads)
+    ).values_list('user_id', 'last_read_seq'))
+    advanced = {user_id: up_to for user_id, up_to in reads.items() if up_to > markers.get(user_id, 0)}
+    if not advanced:
+        return {}
+
+    table = Message._meta.db_table
+    receipts = Message.read_by_users.through._meta.db_table
+    using = Message.objects.for_room(room_id).db
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        for user_id, up_to in advanced.items():
+            cursor.execute(
+                f'INSERT OR IGNORE INTO {receipts} (message_id, user_id) '
+                f'SELECT id, %s FROM {table} WHERE room_id = %s AND seq > %s AND seq <= %s AND user_id != %s '
+                f'AND (target_user_id IS NULL OR target_user_id = %s)',
+                [user_id, room_id, markers.get(user_id, 0), up_to, user_id, user_id]
+            )
+        # Read by everyone except the author, or by its target
+        cursor.execute(
+            f'UPDATE {table} SET is_read = 1 WHERE room_id = %s AND is_read = 0 AND seq > %s AND seq <= %s '
+            f'AND (SELECT COUNT(*) FROM {receipts} WHERE message_id = {table}.id) '
+            f'>= CASE WHEN is_targeted THEN 1 ELSE %s END',
+            [room_id, min(markers.get(user_id, 0) for user_id in advanced), max(advanced.values()),
+             max(room.participant_count - 1, 1)]
+        )
+    with connections['default'].cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {ReadMarker._meta.db_table} (room_id, user_id, last_read_seq) VALUES (%s, %s, %s) '
+            f'ON CONFLICT (room_id, user_id) DO UPDATE SET last_read_seq = MAX(last_read_seq, excluded.last_read_seq)',
+            [(room_id, user_id, up_to) for user_id, up_to in advanced.items()]
+        )
+    cache.bump_reads_version(room_id)
+    return advanced
+
+
+def mark_all_read(room, user_id):
+    """Store the user's receipts for every unread message they can see in the room.
+
+    Runs the same two statements whatever the number of unread messages.
+    Returns the number of receipts added.
+    """
+    room_id = room.pk
+    table = Message._meta.db_table
+    receipts = Message.read_by_users.through._meta.db_table
+    using = Message.objects.for_room(room_id).db
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(
+            f'INSERT OR IGNORE INTO {receipts} (message_id, user_id) '
+            f'SELECT id, %s FROM {table} WHERE room_id = %s AND is_read = 0 AND user_id != %s '
+            f'AND (target_user_id IS NULL OR target_user_id = %s)',
+            [user_id, room_id, user_id, user_id]
+        )
+        added = cursor.rowcount
+        if not added:
+            return 0
+        cursor.execute(
+            f'UPDATE {table} SET is_read = 1 WHERE room_id = %s AND is_read = 0 '
+            f'AND (SELECT COUNT(*) FROM {receipts} WHERE message_id = {table}.id) '
+            f'>= CASE WHEN is_targeted THEN 1 ELSE %s END',
+            [room_id, max(room.participant_count - 1, 1)]
+        )
+    cache.bump_reads_version(room_id)
+    return added
+
+
+def _take_events():
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+
+    events = {}
+    rooms = Room.objects.only('slug', 'participant_count').in_bulk(list(pending))
+    for room_id, reads in pending.items():
+        if room_id not in rooms:
+            continue
+        advanced = persist_reads(rooms[room_id], reads)
+        if advanced:
+            usernames = dict(User.objects.filter(id__in=list(advanced)).values_list('id', 'username'))
+            events[room_group_name(rooms[room_id].slug)] = {
+                'type': 'read_receipts',
+                'receipts': {usernames[user_id]: up_to for user_id, up_to in advanced.items() if user_id in usernames}
+            }
+    return events
+
+
+async def flush(channel_layer):
+    if not _pending:
+        return
+    events = await database_sync_to_async(_take_events)()
+    for group, event in events.items():
+        await channel_layer.group_send(group, event)
+
+
+def ensure_flusher():
+    ticks.ensure_periodic('receipts', TICK, flush)
@@ -0,0 +1,135 @@
+import time
+
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.utils import timezone
+
+from . import cache, timeline
+from .models import Message, Room
+from .routers import message_db_for_room
+
+# Old messages are deleted in small batches picked from the
+# (room, date_added) index, with a pause between batches so that writers
+# are not locked out. Read receipts are removed with raw SQL in the same
+# transaction instead of letting the ORM collect and cascade them.
+
+PRUNE_BATCH_SIZE = 500
+PRUNE_PAUSE = 0.05
+
+
+def retention_cutoff(room, now=None):
+    """Return the datetime before which the room's messages expire, or None."""
+    days = room.message_retention_days or getattr(settings, 'MESSAGE_RETENTION_DAYS', None)
+    if not days:
+        return None
+    return (now or timezone.now()) - timezone.timedelta(days=days)
+
+
+def delete_messages(message_ids, using):
+    """Delete messages and their read receipts. Returns the number of messages deleted."""
+    if not message_ids:
+        return 0
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    read_by = Message.read_by_users.through._meta
+    placeholders = ', '.join(['%s'] * len(message_ids))
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {qn(read_by.db_table)} '
+            f'WHERE {qn(read_by.get_field("message").column)} IN ({placeholders})',
+            message_ids
+        )
+        cursor.execute(
+            f'DELETE FROM {qn(Message._meta.db_table)} WHERE {qn("id")} IN ({placeholders})',
+            message_ids
+        )
+        return cursor.rowcount
+
+
+def delete_room_messages(room_id, using, batch_size=PRUNE_BATCH_SIZE):
+    """Delete every message of a room in batches. Returns the number deleted."""
+    deleted = 0
+    while True:
+        message_ids = list(Message.objects.using(using).filter(
+            room_id=room_id
+        ).values_list('id', flat=True)[:batch_size])
+        if not message_ids:
+            return deleted
+        deleted += delete_messages(message_ids, using)
+
+
+def delete_user_messages(user_id, using, batch_size=PRUNE_BATCH_SIZE):
+    """Delete messages sent by or targeted at a user, and the user's read receipts."""
+    deleted = 0
+    while True:
+        rows = list(Message.objects.using(using).filter(
+            models.Q(user_id=user_id) | models.Q(target_user_id=user_id)
+        ).values_list('id', 'room_id', 'date_added')[:batch_size])
+        if not rows:
+            break
+        deleted += delete_messages([message_id for message_id, _, _ in rows], using)
+        timeline.messages_deleted([(room_id, date_added) for _, room_id, date_added in rows])
+    Message.read_by_users.through.objects.using(using).filter(user_id=user_id).delete()
+    return deleted
+
+
+def prune_room(room, cutoff, batch_size=PRUNE_BATCH_SIZE, pause=PRUNE_PAUSE):
+    """Delete the room's messages older than cutoff. Returns the number deleted."""
+    using = message_db_for_room(room.id)
+    deleted = 0
+    while True:
+        rows = list(Message.objects.using(using).filter(
+            room_id=room.id,
+            date_added__lt=cutoff
+        ).order_by('date_added').values_list('id', 'date_added')[:batch_size])
+        if not rows:
+            return deleted
+        deleted += delete_messages([message_id for message_id, _ in rows], using)
+        timeline.messages_deleted([(room.id, date_added) for _, date_added in rows])
+        cache.bump_messages_version(room.id)
+        if len(rows) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+
+def rooms_with_retention():
+    if getattr(settings, 'MESSAGE_RETENTION_DAYS', None):
+        return Room.objects.all()
+    return Room.objects.filter(message_retention_days__isnull=False)
+
+
+def incremental_vacuum(using, pages=None):
+    """Return free pages to the filesystem if the SQLite database allows it.
+
+    Returns False when the database is not SQLite or was not created with
+    auto_vacuum=INCREMENTAL (see enable_incremental_vacuum).
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            return False
+        if pages:
+            cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+        else:
+            cursor.execute('PRAGMA incremental_vacuum')
+        cursor.fetchall()
+    return True
+
+
+def enable_incremental_vacuum(using):
+    """Switch a SQLite database to incremental auto-vacuum.
+
+    This rewrites the whole file with VACUUM, so run it once during a
+    maintenance window.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+    return True
@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.db import connections
+
+# With MESSAGE_SHARDS > 0, messages and their read receipts live in
+# separate SQLite files (messages_0, messages_1, ...) picked by room id, so
+# that writes to different rooms do not contend for one database lock.
+# Everything else stays in the default database.
+
+MESSAGE_MODELS = {'message', 'message_read_by_users'}
+
+# Each shard allocates message ids from its own block so ids stay unique
+# across the deployment.
+SHARD_ID_BLOCK = 10 ** 12
+
+
+def message_shards():
+    return [f'messages_{shard}' for shard in range(getattr(settings, 'MESSAGE_SHARDS', 0))]
+
+
+def message_databases():
+    """Every database alias that stores messages."""
+    return message_shards() or ['default']
+
+
+def message_db_for_room(room_id):
+    """Return the database alias holding the messages of a room."""
+    shards = message_shards()
+    if not shards:
+        return 'default'
+    return shards[room_id % len(shards)]
+
+
+def seed_message_ids(using):
+    """Start a shard's message id sequence at the beginning of its block."""
+    shards = message_shards()
+    if using not in shards:
+        return
+    from .models import Message
+    table = Message._meta.db_table
+    start = shards.index(using) * SHARD_ID_BLOCK
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+        elif row[0] < start:
+            cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start, table])
+
+
+def is_message_model(model):
+    return model._meta.app_label == 'room' and model._meta.model_name in MESSAGE_MODELS
+
+
+class MessageShardRouter:
+    def _db_for_message(self, hints):
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._meta.model_name == 'room':
+            return message_db_for_room(instance.pk)
+        if getattr(instance, 'room_id', None) is not None:
+            return message_db_for_room(instance.room_id)
+        return instance._state.db
+
+    def db_for_read(self, model, **hints):
+        if is_message_model(model):
+            return self._db_for_message(hints)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        if is_message_model(model):
+            return self._db_for_message(hints)
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_message_model(obj1) or is_message_model(obj2):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Message tables also exist, empty, in the default database so that
+        # ORM cascades from Room and User deletes find nothing to do there.
+        if db in message_shards():
+            return app_label == 'room' and model_name in MESSAGE_MODELS
+        return None
@@ -1,6 +1,12 @@
+from django.conf import settings
 from django.urls import re_path
 from . import consumers
 
+# See LeanChatConsumer
+chat_consumer = consumers.LeanChatConsumer if getattr(settings, 'LEAN_CHAT_CONSUMER', False) else consumers.ChatConsumer
+
 websocket_urlpatterns = [
-    re_path(r'ws/chat/(?P<room_name>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    # With room affinity the proxy routes /workers/<name>/ to that worker (see room/affinity.py)
+    re_path(r'^(?:workers/[-\w]+/)?ws/chat/(?P<room_name>[-\w]+)/$', chat_consumer.as_asgi()),
+    re_path(r'ws/notifications/$', consumers.NotificationConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,80 @@
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max
+from django.db.models.functions import Greatest
+
+from .models import Message, RoomSequence
+
+# Messages get a per-room sequence number so clients can spot gaps. Every
+# number is taken from the room's high-water mark in RoomSequence, bumped
+# and read back in one transaction, so numbers are unique per room and
+# increase in the order they are handed out, whichever process asks. A
+# message may still be stored or delivered just after a later one, so a
+# gap only means "possibly missing", and fetching that range may return
+# nothing.
+#
+# MESSAGE_SEQ_BLOCK_SIZE above 1 has a process reserve that many numbers
+# at once and hand them out from memory, saving a query per message. The
+# numbers then only increase within each process, so use it only with a
+# single worker process; numbers left in a block when a process exits are
+# never used.
+
+SEQ_BLOCK_SIZE = getattr(settings, 'MESSAGE_SEQ_BLOCK_SIZE', 1)
+
+
+def reserve_sequence(room_id, count):
+    """Reserve ``count`` sequence numbers for a room and return them as a range."""
+    with transaction.atomic():
+        updated = RoomSequence.objects.filter(room_id=room_id).update(last_reserved=F('last_reserved') + count)
+        if not updated:
+            # First reservation: continue after any numbered messages
+            floor = Message.objects.for_room(room_id).aggregate(seq=Max('seq'))['seq'] or 0
+            RoomSequence.objects.bulk_create([RoomSequence(room_id=room_id, last_reserved=floor)], ignore_conflicts=True)
+            RoomSequence.objects.filter(room_id=room_id).update(
+                last_reserved=Greatest(F('last_reserved'), floor) + count
+            )
+        end = RoomSequence.objects.filter(room_id=room_id).values_list('last_reserved', flat=True).get()
+    return range(end - count + 1, end + 1)
+
+
+class SequenceAllocator:
+    def __init__(self, block_size=SEQ_BLOCK_SIZE):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def next_seq_nowait(self, room_id):
+        """Return the next number, or None if a new block has to be reserved."""
+        with self._lock:
+            block = self._blocks.get(room_id)
+            if block:
+                return next(block, None)
+            return None
+
+    def next_seq(self, room_id):
+        seq = self.next_seq_nowait(room_id)
+        while seq is None:
+            block = iter(reserve_sequence(room_id, self.block_size))
+            with self._lock:
+                self._blocks[room_id] = block
+            seq = self.next_seq_nowait(room_id)
+        return seq
+
+    def forget(self, room_id):
+        with self._lock:
+            self._blocks.pop(room_id, None)
+
+
+allocator = SequenceAllocator()
+
+
+def number_messages(messages):
+    """Give bulk-inserted messages sequence numbers, one reservation per room."""
+    by_room = {}
+    for message in messages:
+        by_room.setdefault(message.room_id, []).append(message)
+    for room_id, room_messages in by_room.items():
+        for message, seq in zip(room_messages, reserve_sequence(room_id, len(room_messages))):
+            message.seq = seq
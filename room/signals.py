@@ -0,0 +1,135 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from . import activity, analytics, cache, inbox, mentions, timeline, unread
+from .membership import increment_participant_count, refresh_participant_count
+from .models import Message, Room
+from .retention import delete_room_messages, delete_user_messages
+from .routers import message_db_for_room, message_shards, seed_message_ids
+from .sequence import allocator as seq_allocator
+
+# Sent with messages=[...] and using=<db alias> after new messages are
+# written. Journal replays and bulk inserts do not send post_save, so
+# bookkeeping that follows every new message hangs off this signal. Each
+# message is sent once: retries and resumed imports leave out the messages
+# they find already stored.
+messages_stored = Signal()
+
+
+@receiver(pre_save, sender=Room)
+def room_saving(sender, instance, update_fields=None, **kwargs):
+    # The cached room is keyed by slug, so a rename must drop the old key too
+    if instance.pk is not None and (update_fields is None or 'slug' in update_fields):
+        instance._saved_slug = Room.objects.filter(pk=instance.pk).values_list('slug', flat=True).first()
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, **kwargs):
+    cache.invalidate_room(instance.slug)
+    saved_slug = instance.__dict__.pop('_saved_slug', None)
+    if saved_slug is not None and saved_slug != instance.slug:
+        cache.invalidate_room(saved_slug)
+    cache.bump_room_version(instance.pk)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    cache.invalidate_room(instance.slug)
+    cache.bump_members_version(instance.pk)
+    seq_allocator.forget(instance.pk)
+    # The ORM cascade only reaches the default database
+    using = message_db_for_room(instance.pk)
+    if using != 'default':
+        delete_room_messages(instance.pk, using)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    for using in message_shards():
+        delete_user_messages(instance.pk, using)
+
+
+@receiver(messages_stored)
+def record_activity(sender, messages, **kwargs):
+    latest = {}
+    for message in messages:
+        if message.room_id not in latest or message.date_added > latest[message.room_id]:
+            latest[message.room_id] = message.date_added
+    for room_id, when in latest.items():
+        activity.touch(room_id, when)
+        cache.note_last_message_at(room_id, when)
+        cache.bump_messages_version(room_id)
+
+
+@receiver(messages_stored)
+def roll_up_days(sender, messages, **kwargs):
+    timeline.messages_added(messages)
+
+
+@receiver(messages_stored)
+def roll_up_hours(sender, messages, **kwargs):
+    analytics.messages_added(messages)
+
+
+@receiver(messages_stored)
+def push_unread_counts(sender, messages, imported=False, **kwargs):
+    if not imported:
+        unread.record_messages(messages)
+
+
+@receiver(messages_stored)
+def index_targeted_messages(sender, messages, imported=False, **kwargs):
+    # Imported history is not news to anyone
+    if not imported:
+        inbox.messages_added(messages)
+
+
+@receiver(m2m_changed, sender=Message.read_by_users.through)
+def read_receipts_changed(sender, instance, action, reverse, **kwargs):
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        cache.bump_reads_version(instance.room_id)
+
+
+@receiver(post_migrate)
+def shard_migrated(sender, using, **kwargs):
+    if sender.name == 'room':
+        seed_message_ids(using)
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # user.chat_rooms.add(...) - instance is the user, pk_set holds room ids
+        if action == 'pre_clear':
+            instance._cleared_room_ids = list(instance.chat_rooms.values_list('id', flat=True))
+            return
+        if action == 'post_clear':
+            room_ids = getattr(instance, '_cleared_room_ids', [])
+        elif action in ('post_add', 'post_remove'):
+            room_ids = pk_set or []
+        else:
+            return
+        for room_id in room_ids:
+            if action == 'post_add':
+                increment_participant_count(room_id, 1)
+            else:
+                refresh_participant_count(room_id)
+            version = cache.bump_members_version(room_id)
+            if action == 'post_add':
+                mentions.members_changed(room_id, version, added=[instance.pk])
+            else:
+                mentions.members_changed(room_id, version, removed=[instance.pk])
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        # post_add only reports rows that were actually inserted
+        if action == 'post_add':
+            if pk_set:
+                increment_participant_count(instance.pk, len(pk_set))
+        else:
+            refresh_participant_count(instance.pk)
+        version = cache.bump_members_version(instance.pk)
+        if action == 'post_add':
+            mentions.members_changed(instance.pk, version, added=pk_set or ())
+        elif action == 'post_remove':
+            mentions.members_changed(instance.pk, version, removed=pk_set or ())
+        # post_clear leaves the matcher stale, so it is rebuilt on next use
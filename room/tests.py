@@ -1,3 +1,1436 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import pstats
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from djangochat.asgi import application as asgi_application
+
+from . import activity, affinity, export, hubs, inbox, journal, profiling, receipts, retention, sequence, tracing, unread
+from .affinity import HashRing
+from .benchmarks import chat_scope, idle_app, measure_idle_connections, moved_rooms, model_fanout
+from .cache import RoomMembership, bump_members_version, get_room, is_member, members_version
+from .consumers import ChatConsumer, LeanChatConsumer
+from .dataset import DatasetGenerator
+from .heartbeat import Heartbeats
+from .importer import HistoryImporter
+from .invitations import INVITATION_LIFETIME, bulk_invite
+from .journal import post_message
+from .membership import add_members, remove_members
+from .mentions import find_mentions
+from .models import ChatWorker, Invitation, Message, ReadMarker, Room, RoomDay, RoomHour, RoomHourSender
+from .notifications import user_group_name
+from .perf import PerformanceTestCase, acount_queries, best_time, count_queries, timing_test
+from .routers import (
+    SHARD_ID_BLOCK, MessageShardRouter, message_databases, message_db_for_room, message_shards, seed_message_ids
+)
+from .signals import messages_stored
+
+# Performance regression tests. Every size seeds its own fixed dataset in
+# which users, rooms, members and messages all grow linearly with the size,
+# and the sizes are an order of magnitude apart. Views and consumer events
+# must run the same number of queries at each size, within their budget.
+
+DATASET_SIZES = (4, 40, 400)
+# Members of the rooms other than the measured one
+SMALL_ROOM_MEMBERS = 5
+
+
+def seed_dataset(size):
+    """Seed ``2 * size`` users, ``size`` rooms and ``20 * size`` messages.
+
+    Returns a user who is a member of every room, and a private room that
+    every user is a member of and that gets most of the messages.
+    """
+    generator = DatasetGenerator(seed=size, prefix=f'perf{size}')
+    user_ids = generator.create_users(size * 2)
+    rooms = generator.create_rooms(size, user_ids, private_ratio=0.5)
+    room = Room.objects.filter(id__in=[room.id for room in rooms], is_private=True).order_by('id').first()
+    members = {
+        other.id: user_ids if other.id == room.id else user_ids[:SMALL_ROOM_MEMBERS]
+        for other in rooms
+    }
+    for other in rooms:
+        add_members(other, members[other.id])
+    generator.create_messages(rooms, members, size * 20, targeted_ratio=0.2, read_ratio=0.3)
+    return User.objects.get(id=user_ids[0]), room
+
+
+class ActivityFlushMixin:
+    """Write room activity out in tearDown only.
+
+    Not from a timer thread, which would find the test database locked, nor
+    when a message happens to arrive after the flush interval, which would
+    make query counts depend on how long the tests took so far.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.enterClassContext(mock.patch.object(activity, '_schedule'))
+        cls.enterClassContext(mock.patch.object(activity, 'FLUSH_INTERVAL', float('inf')))
+        super().setUpClass()
+
+    def tearDown(self):
+        activity.flush()
+        super().tearDown()
+
+
+class SeededTestCase(ActivityFlushMixin, PerformanceTestCase):
+    sizes = DATASET_SIZES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.datasets = {size: seed_dataset(size) for size in cls.sizes}
+
+    def setUp(self):
+        # One logged in client per dataset, so that logging in is not measured
+        self.clients = {}
+        for size, (user, room) in self.datasets.items():
+            self.clients[size] = Client()
+            self.clients[size].force_login(user)
+            # Measure sends that reserve their sequence number, as with the default block size
+            sequence.allocator.forget(room.id)
+
+    def get(self, size, name, **params):
+        user, room = self.datasets[size]
+        url = reverse(name) if name == 'rooms' else reverse(name, args=[room.slug])
+        response = self.clients[size].get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def send(self, size):
+        user, room = self.datasets[size]
+        response = self.clients[size].post(
+            reverse('send_message', args=[room.slug]),
+            json.dumps({'message': 'hello'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class ViewQueryTests(SeededTestCase):
+    def test_rooms(self):
+        # Last message previews take two queries per message database
+        self.assertQueryBudget('rooms', 4 + 2 * len(message_databases()), lambda size: self.get(size, 'rooms'))
+
+    def test_room(self):
+        self.assertQueryBudget('room', 14, lambda size: self.get(size, 'room'))
+
+    def test_room_not_modified(self):
+        etags = {size: self.get(size, 'room')['ETag'] for size in self.sizes}
+
+        def revisit(size):
+            user, room = self.datasets[size]
+            response = self.clients[size].get(reverse('room', args=[room.slug]), HTTP_IF_NONE_MATCH=etags[size])
+            self.assertEqual(response.status_code, 304)
+
+        # Served from the cached versions, without clearing the cache
+        counts = {}
+        for size in self.sizes:
+            with count_queries() as counts[size]:
+                revisit(size)
+        self.assertQueryCounts('room (not modified)', 2, counts)
+
+    def test_get_messages(self):
+        self.assertQueryBudget('get_messages', 6, lambda size: self.get(size, 'get_messages'))
+
+    def test_get_messages_conversation(self):
+        others = {}
+        for size, (user, room) in self.datasets.items():
+            others[size] = room.participants.exclude(id=user.id).order_by('id').first()
+            post_message(room, user, 'hello', target_user=others[size], is_targeted=True)
+        self.assertQueryBudget(
+            'get_messages (conversation)', 7,
+            lambda size: self.get(size, 'get_messages', target_user=others[size].username)
+        )
+
+    def test_send_message(self):
+        self.assertQueryBudget('send_message', 14, self.send)
+
+@timing_test
+class ViewTimingTests(SeededTestCase):
+    def test_timings(self):
+        size = max(self.sizes)
+        self.assertTimingBaseline('rooms', lambda: self.get(size, 'rooms'), setup=cache.clear)
+        self.assertTimingBaseline('room', lambda: self.get(size, 'room'), setup=cache.clear)
+        self.assertTimingBaseline('get_messages', lambda: self.get(size, 'get_messages'), setup=cache.clear)
+        self.assertTimingBaseline('send_message', lambda: self.send(size))
+
+
+CHAT_CONSUMERS = {
+    'ChatConsumer': ChatConsumer.as_asgi(),
+    'LeanChatConsumer': LeanChatConsumer.as_asgi(),
+}
+
+
+async def connect(app, user, room):
+    communicator = ApplicationCommunicator(app, chat_scope(user, room.slug))
+    await communicator.send_input({'type': 'websocket.connect'})
+    return communicator
+
+
+async def receive_frames(communicator, count):
+    frames = []
+    for _ in range(count):
+        output = await communicator.receive_output(2)
+        if output['type'] == 'websocket.send':
+            frames.append(json.loads(output['text']))
+    return frames
+
+
+async def chat_session(app, user, room, counts=None):
+    """Connect, send a message, report typing and disconnect.
+
+    Fills ``counts`` with the queries each step ran.
+    """
+    counts = {} if counts is None else counts
+    async with acount_queries() as counts['connect']:
+        communicator = await connect(app, user, room)
+        # websocket.accept, then the user's own join notice
+        await receive_frames(communicator, 2)
+
+    async with acount_queries() as counts['message']:
+        await communicator.send_input({
+            'type': 'websocket.receive',
+            'text': json.dumps({'type': 'message', 'message': f'hello @{user.username}'})
+        })
+        frames = await receive_frames(communicator, 1)
+    assert frames[0]['type'] == 'message', frames
+
+    async with acount_queries() as counts['typing']:
+        await communicator.send_input({
+            'type': 'websocket.receive',
+            'text': json.dumps({'type': 'typing', 'is_typing': True})
+        })
+        await communicator.receive_nothing()
+
+    async with acount_queries() as counts['disconnect']:
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(2)
+    return counts
+
+
+class ConsumerQueryTests(SeededTestCase):
+    BUDGETS = {
+        'ChatConsumer': {'connect': 4, 'message': 12, 'typing': 0, 'disconnect': 1},
+        'LeanChatConsumer': {'connect': 3, 'message': 12, 'typing': 0, 'disconnect': 0},
+    }
+
+    def test_chat_consumers(self):
+        for name, app in CHAT_CONSUMERS.items():
+            counts = {}
+            for size, (user, room) in self.datasets.items():
+                cache.clear()
+                sequence.allocator.forget(room.id)
+                counts[size] = async_to_sync(chat_session)(app, user, room)
+            for step, budget in self.BUDGETS[name].items():
+                self.assertQueryCounts(f'{name} {step}', budget, {
+                    size: steps[step] for size, steps in counts.items()
+                })
+
+    def test_inbox_drain(self):
+        # Direct messages waiting in every room of the user come out in one batch
+        counts = {}
+        for size, (user, room) in self.datasets.items():
+            rooms = list(user.chat_rooms.all())
+            for other_room in rooms:
+                sender = other_room.participants.exclude(id=user.id).first()
+                post_message(other_room, sender, 'psst', target_user=user, is_targeted=True)
+            with count_queries() as counts[size]:
+                messages, more = inbox.pending(user.id)
+            self.assertEqual((len(messages), more), (len(rooms), False))
+        # Entries, then the messages of each database, their senders and rooms
+        self.assertQueryCounts('inbox drain', 3 + len(message_databases()), counts)
+
+    @timing_test
+    def test_chat_consumer_timings(self):
+        user, room = self.datasets[max(self.sizes)]
+        for name, app in CHAT_CONSUMERS.items():
+            self.assertTimingBaseline(f'{name} session', lambda: async_to_sync(chat_session)(app, user, room))
+
+
+class IdleConnectionMemoryTests(SeededTestCase):
+    # Traced Python memory an idle LeanChatConsumer socket may add to the
+    # bare ASGI connection, and the asyncio tasks it may need
+    LEAN_BYTES_PER_CONNECTION = 3 * 1024
+    LEAN_TASKS_PER_CONNECTION = 1.1
+    CONNECTIONS = 80
+
+    def measure(self, app):
+        user, room = self.datasets[max(self.sizes)]
+        users = list(room.participants.order_by('id')[:self.CONNECTIONS])
+        return async_to_sync(measure_idle_connections)(app, users, [room.slug])
+
+    def test_lean_consumer(self):
+        bare = self.measure(idle_app)
+        lean = self.measure(CHAT_CONSUMERS['LeanChatConsumer'])
+        chat = self.measure(CHAT_CONSUMERS['ChatConsumer'])
+        self.assertLessEqual(
+            lean['bytes_per_connection'] - bare['bytes_per_connection'], self.LEAN_BYTES_PER_CONNECTION,
+            f'idle LeanChatConsumer: {lean}, bare ASGI app: {bare}'
+        )
+        self.assertLessEqual(lean['tasks_per_connection'], self.LEAN_TASKS_PER_CONNECTION)
+        self.assertLess(lean['bytes_per_connection'], chat['bytes_per_connection'])
+
+
+@timing_test
+class HeartbeatTests(SimpleTestCase):
+    def tick_time(self, sockets):
+        """Time 1000 one-second ticks with ``sockets`` registered and none of them due."""
+        clock = [0.0]
+        heartbeats = Heartbeats(interval=3600, timeout=10, clock=lambda: clock[0])
+        for socket in range(sockets):
+            heartbeats.add(socket)
+
+        def run():
+            for _ in range(1000):
+                clock[0] += 1
+                heartbeats.expire()
+
+        return best_time(run, repeat=1)
+
+    def test_tick_cost_is_independent_of_connections(self):
+        few = self.tick_time(10)
+        many = self.tick_time(100000)
+        self.assertLess(many, few * 5 + 0.005, f'1000 ticks: {few * 1000:.2f}ms for 10 sockets, {many * 1000:.2f}ms for 100000')
+
+
+class LeanConsumerTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.app = CHAT_CONSUMERS['LeanChatConsumer']
+        self.users = [User.objects.create_user(username) for username in ('ann', 'bob')]
+        self.room = Room.objects.create(name='Lean', slug='lean', is_private=False)
+
+    def test_bad_frames_are_ignored(self):
+        async def session():
+            communicator = await connect(self.app, self.users[0], self.room)
+            await receive_frames(communicator, 2)
+            for text in ('not json', '[1]', '{"message": 123}', '{"type": "read", "up_to": "all"}', '{"message": "hi"}'):
+                await communicator.send_input({'type': 'websocket.receive', 'text': text})
+            frames = await receive_frames(communicator, 1)
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(2)
+            return frames
+
+        frames = async_to_sync(session)()
+        self.assertEqual([(frame['type'], frame['message']) for frame in frames], [('message', 'hi')])
+        self.assertEqual(Message.objects.for_room(self.room.id).count(), 1)
+
+    def test_failed_frame_still_leaves_the_room(self):
+        async def session():
+            watcher = await connect(self.app, self.users[1], self.room)
+            await receive_frames(watcher, 2)
+            failing = await connect(self.app, self.users[0], self.room)
+            await receive_frames(failing, 2)
+            await receive_frames(watcher, 1)
+            with mock.patch('room.consumers.apost_message', side_effect=RuntimeError('database went away')):
+                await failing.send_input({'type': 'websocket.receive', 'text': json.dumps({'message': 'hi'})})
+                with self.assertRaises(RuntimeError):
+                    await failing.wait(2)
+            frames = await receive_frames(watcher, 1)
+            await watcher.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await watcher.wait(2)
+            return frames
+
+        self.assertEqual(async_to_sync(session)(), [
+            {'type': 'user_leave', 'username': 'ann', 'message': 'ann left the chat'}
+        ])
+
+
+class FrameRecorder:
+    """Stands in for a LeanChatConsumer in a hub: keeps the frames it is sent, or fails every send."""
+
+    def __init__(self, username, broken=False):
+        self.user = SimpleNamespace(id=None, username=username)
+        self.broken = broken
+        self.frames = []
+
+    async def send(self, message):
+        if self.broken:
+            raise ConnectionResetError('socket went away')
+        self.frames.append(json.loads(message['text']))
+
+
+class HubTests(SimpleTestCase):
+    def test_failed_send_drops_only_that_socket(self):
+        sockets = [FrameRecorder('broken', broken=True), FrameRecorder('first'), FrameRecorder('second')]
+
+        async def deliver():
+            for socket in sockets:
+                hub = await hubs.join('chat_hub-tests', socket, None)
+            for username in ('ann', 'bob'):
+                await get_channel_layer().group_send(hub.group, {
+                    'type': 'user_join', 'username': username, 'message': f'{username} joined the chat'
+                })
+            for _ in range(200):
+                if len(sockets[-1].frames) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            for socket in sockets:
+                await hubs.leave(hub, socket)
+
+        with self.assertLogs('room.hubs', 'WARNING') as logs:
+            async_to_sync(deliver)()
+        # The hub kept delivering, and stopped trying the broken socket after its first failure
+        for socket in sockets[1:]:
+            self.assertEqual([frame['username'] for frame in socket.frames], ['ann', 'bob'])
+        self.assertEqual(len(logs.records), 1)
+
+
+class AffinityTests(SimpleTestCase):
+    WORKERS = [f'/workers/{i}' for i in range(4)]
+    ROOMS = [f'room-{i}' for i in range(1000)]
+
+    def test_ring_spreads_rooms(self):
+        # In the model, most deliveries cross processes without affinity; with it, rooms
+        # must still spread evenly over the workers
+        random = model_fanout(self.WORKERS, self.ROOMS, 20, 10000)
+        affinity = model_fanout(self.WORKERS, self.ROOMS, 20, 10000, ring=HashRing(self.WORKERS))
+        self.assertGreater(random['cross_process'], random['deliveries'] / 2, random)
+        self.assertLess(affinity['busiest_worker_share'], 1.5 / len(self.WORKERS), affinity)
+
+    def test_rebalance_moves_few_rooms(self):
+        ring = HashRing(self.WORKERS)
+        for changed in (HashRing(self.WORKERS + ['/workers/4']), HashRing(self.WORKERS[1:])):
+            ideal = 1 / max(len(changed), len(ring))
+            self.assertLess(moved_rooms(self.ROOMS, ring.node_for, changed.node_for), ideal * 1.5)
+
+
+class HandoffRecorder:
+    """Stands in for a chat socket in affinity's registry, the way consumers use it."""
+
+    def __init__(self, room_slug):
+        self.room_slug = room_slug
+        self.handoffs = []
+
+    async def handoff(self, url):
+        self.handoffs.append(url)
+        affinity.discard(self, self.room_slug)
+
+
+async def handoff_session(app, user, room, move_room):
+    """Connect to a room this worker serves, then rebalance after ``move_room()`` moves it.
+
+    Also reports whether a further rebalance leaves the handed off socket alone.
+    """
+    communicator = await connect(app, user, room)
+    # websocket.accept, then the user's own join notice
+    await receive_frames(communicator, 2)
+    await database_sync_to_async(move_room)()
+    await affinity.rebalance()
+    frames = [json.loads((await communicator.receive_output(2))['text'])]
+    close = await communicator.receive_output(2)
+    await affinity.rebalance()
+    untracked = await communicator.receive_nothing()
+    await communicator.send_input({'type': 'websocket.disconnect', 'code': close['code']})
+    await communicator.wait(2)
+    return frames, close, untracked
+
+
+async def rejected_session(app, user, room):
+    communicator = await connect(app, user, room)
+    outputs = [await communicator.receive_output(2) for _ in range(3)]
+    await communicator.send_input({'type': 'websocket.disconnect', 'code': outputs[-1].get('code')})
+    await communicator.wait(2)
+    return outputs
+
+
+class WorkerAffinityTests(TestCase):
+    databases = '__all__'
+    WORKERS = ['/workers/0', '/workers/1']
+    NEW_WORKER = '/workers/2'
+    ROOMS = [f'room-{i}' for i in range(200)]
+
+    def setUp(self):
+        # This process is worker0
+        self.enterContext(mock.patch.object(affinity, 'WORKER_URL', self.WORKERS[0]))
+        self.addCleanup(affinity.expire_ring)
+        self.seen(self.WORKERS[1])
+
+    def seen(self, url, seconds_ago=0):
+        """Register a worker as last seen that long ago, and have the ring re-read."""
+        ChatWorker.objects.update_or_create(
+            url=url, defaults={'last_seen': timezone.now() - timedelta(seconds=seconds_ago)}
+        )
+        affinity.expire_ring()
+
+    def test_handoff_url_names_the_room_owner(self):
+        self.seen(self.NEW_WORKER, seconds_ago=affinity.WORKER_TTL + 1)
+        ring = HashRing(self.WORKERS)
+        self.assertEqual(affinity.current_ring().nodes, set(self.WORKERS))
+
+        urls = {}
+        for room_slug in self.ROOMS:
+            owner = ring.node_for(room_slug)
+            urls[room_slug] = affinity.handoff_url(room_slug)
+            self.assertEqual(urls[room_slug], None if owner == self.WORKERS[0] else f'{owner}/ws/chat/{room_slug}/')
+            self.assertEqual(affinity.socket_url(room_slug), f'{owner}/ws/chat/{room_slug}/')
+        self.assertIn(None, urls.values())
+        self.assertTrue(any(urls.values()))
+
+    def test_rebalance_hands_off_only_the_rooms_that_moved(self):
+        ours = [room_slug for room_slug in self.ROOMS if HashRing(self.WORKERS).node_for(room_slug) == self.WORKERS[0]]
+        sockets = {room_slug: HandoffRecorder(room_slug) for room_slug in ours}
+
+        async def track():
+            for room_slug, socket in sockets.items():
+                affinity.add(socket, room_slug)
+                self.addCleanup(affinity.discard, socket, room_slug)
+
+        async_to_sync(track)()
+
+        async_to_sync(affinity.rebalance)()
+        self.assertEqual([socket for socket in sockets.values() if socket.handoffs], [])
+
+        # A worker joins: the rooms it takes over go there, the rest stay
+        self.seen(self.NEW_WORKER)
+        async_to_sync(affinity.rebalance)()
+        ring = HashRing(self.WORKERS + [self.NEW_WORKER])
+        moved = {room_slug for room_slug in ours if ring.node_for(room_slug) != self.WORKERS[0]}
+        self.assertTrue(0 < len(moved) < len(ours))
+        for room_slug, socket in sockets.items():
+            expected = [f'{self.NEW_WORKER}/ws/chat/{room_slug}/'] if room_slug in moved else []
+            self.assertEqual(socket.handoffs, expected, room_slug)
+
+        # A worker leaves: only its own rooms move, this worker has none of
+        # them, and the sockets handed off already are not handed off again
+        self.seen(self.WORKERS[1], seconds_ago=affinity.WORKER_TTL + 1)
+        async_to_sync(affinity.rebalance)()
+        self.assertEqual(affinity.current_ring().nodes, {self.WORKERS[0], self.NEW_WORKER})
+        self.assertEqual(sum(len(socket.handoffs) for socket in sockets.values()), len(moved))
+
+    def test_consumers_hand_off_and_close(self):
+        user = User.objects.create_user('traveller')
+        before, after = HashRing(self.WORKERS), HashRing(self.WORKERS + [self.NEW_WORKER])
+        elsewhere = next(slug for slug in self.ROOMS if before.node_for(slug) == self.WORKERS[1])
+        moving = next(
+            slug for slug in self.ROOMS
+            if before.node_for(slug) == self.WORKERS[0] and after.node_for(slug) == self.NEW_WORKER
+        )
+        rooms = {slug: Room.objects.create(name=slug, slug=slug, is_private=False) for slug in (elsewhere, moving)}
+
+        for name, app in CHAT_CONSUMERS.items():
+            ChatWorker.objects.filter(url=self.NEW_WORKER).delete()
+            self.seen(self.WORKERS[1])
+            # Connecting to a room served elsewhere: accepted, told where to go, closed
+            accept, frame, close = async_to_sync(rejected_session)(app, user, rooms[elsewhere])
+            self.assertEqual(accept['type'], 'websocket.accept', name)
+            self.assertEqual(json.loads(frame['text']), affinity.handoff_frame(f'{self.WORKERS[1]}/ws/chat/{elsewhere}/'))
+            self.assertEqual((close['type'], close['code']), ('websocket.close', affinity.HANDOFF_CLOSE_CODE), name)
+
+            # An open socket whose room moves to a new worker
+            frames, close, untracked = async_to_sync(handoff_session)(
+                app, user, rooms[moving], lambda: self.seen(self.NEW_WORKER)
+            )
+            self.assertEqual(frames, [affinity.handoff_frame(f'{self.NEW_WORKER}/ws/chat/{moving}/')], name)
+            self.assertEqual((close['type'], close['code']), ('websocket.close', affinity.HANDOFF_CLOSE_CODE), name)
+            self.assertTrue(untracked, name)
+
+    def test_handed_off_socket_stays_authenticated(self):
+        user = User.objects.create_user('member')
+        slug = next(slug for slug in self.ROOMS if HashRing(self.WORKERS).node_for(slug) == self.WORKERS[1])
+        room = Room.objects.create(name=slug, slug=slug, is_private=True, created_by=user)
+        room.participants.add(user)
+        self.client.force_login(user)
+        session_cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        # What a browser sends to the site's own origin, whichever worker it reaches
+        headers = [(b'origin', b'http://testserver'), (b'cookie', session_cookie.encode())]
+
+        async def session(path, message=None):
+            communicator = ApplicationCommunicator(asgi_application, {
+                'type': 'websocket', 'path': path, 'query_string': b'', 'headers': headers, 'subprotocols': [],
+            })
+            await communicator.send_input({'type': 'websocket.connect'})
+            accept = await communicator.receive_output(2)
+            frames = await receive_frames(communicator, 1)
+            if message is not None:
+                await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps({'message': message})})
+                while frames[-1].get('message') != message:
+                    frames += await receive_frames(communicator, 1)
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(2)
+            return accept['type'] == 'websocket.accept', frames
+
+        # The room page's socket reaches worker0, which sends it on within the origin
+        connected, frames = async_to_sync(session)(f'/ws/chat/{slug}/')
+        self.assertTrue(connected)
+        self.assertEqual(frames, [affinity.handoff_frame(f'{self.WORKERS[1]}/ws/chat/{slug}/')])
+
+        # The proxy routes that path to worker1, and the browser sends the same cookie there
+        self.seen(self.WORKERS[0])
+        with mock.patch.object(affinity, 'WORKER_URL', self.WORKERS[1]):
+            connected, frames = async_to_sync(session)(frames[0]['url'], 'still me')
+        self.assertTrue(connected)
+        self.assertEqual(frames[-1]['username'], 'member')
+        self.assertEqual(Message.objects.for_room(room.id).get().user, user)
+
+
+class SequenceTests(TestCase):
+    databases = '__all__'
+
+    def test_numbers_increase_across_processes(self):
+        room = Room.objects.create(name='Sequence', slug='sequence')
+        processes = [sequence.SequenceAllocator(), sequence.SequenceAllocator()]
+        self.assertEqual([processes[i % 2].next_seq(room.id) for i in range(6)], [1, 2, 3, 4, 5, 6])
+
+
+class JournalTests(ActivityFlushMixin, TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.enterContext(override_settings(MESSAGE_JOURNAL_DIR=directory.name))
+        # Retries are warnings; nothing the journal threads do may fail for good, up to and including close()
+        self.enterContext(self.assertNoLogs('room.journal', 'ERROR'))
+
+    def tearDown(self):
+        journal.close_journal()
+        self.assertEqual([thread.name for thread in threading.enumerate() if thread.name.startswith('message-journal')], [])
+        super().tearDown()
+
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def post_all(self, user, posts):
+        """Post before the apply thread stores anything: the shared in-memory test database
+        takes one writer at a time and, unlike a database file, does not wait for the lock."""
+        posted = threading.Event()
+        apply_records = journal.apply_records
+
+        def apply_once_posted(records):
+            posted.wait(5)
+            apply_records(records)
+
+        with mock.patch.object(journal, 'apply_records', apply_once_posted):
+            for room, content in posts:
+                post_message(room, user, content)
+            posted.set()
+
+    def test_journaled_messages_keep_their_room_sequence(self):
+        user = User.objects.create_user('writer')
+        rooms = [Room.objects.create(name=f'Journal {i}', slug=f'journal-{i}') for i in range(2)]
+        for room in rooms:
+            sequence.allocator.forget(room.id)
+        self.post_all(user, [(room, 'hello') for room in (rooms[0], rooms[0], rooms[1], rooms[0])])
+
+        journal.close_journal()
+        for room, expected in zip(rooms, ([1, 2, 3], [1])):
+            self.assertEqual(
+                sorted(Message.objects.for_room(room.id).values_list('seq', flat=True)), expected
+            )
+
+    def test_failing_batch_moves_to_dead_letters(self):
+        user = User.objects.create_user('writer')
+        room = Room.objects.create(name='Journal', slug='journal')
+        apply_records = journal.apply_records
+
+        def apply_unless_poisoned(records):
+            if any(record['content'] == 'poison' for record in records):
+                raise ValueError('cannot store this one')
+            apply_records(records)
+
+        self.enterContext(mock.patch.object(journal, 'apply_records', apply_unless_poisoned))
+        self.enterContext(mock.patch.object(journal, 'APPLY_RETRY_DELAY', 0))
+        with self.assertLogs('room.journal', 'ERROR'):
+            post_message(room, user, 'poison')
+            self.wait_until(lambda: any(self.directory.glob('dead-letter-*.log')))
+        # Later messages are stored; the failed one waits in the dead-letter file
+        post_message(room, user, 'fine')
+        journal.close_journal()
+        self.assertEqual(list(Message.objects.for_room(room.id).values_list('content', flat=True)), ['fine'])
+        dead_letters, = self.directory.glob('dead-letter-*.log')
+        self.assertEqual([record['content'] for record in journal.read_journal(dead_letters)], ['poison'])
+
+    def test_reapplied_records_are_counted_once(self):
+        user = User.objects.create_user('writer')
+        room = Room.objects.create(name='Journal', slug='journal')
+        self.post_all(user, [(room, f'line {i}') for i in range(3)])
+        # Closing applies everything; then replay the journal as after a crash, twice
+        journal.close_journal()
+        journal_file, = self.directory.glob('journal-*.log')
+        records = journal.read_journal(journal_file)
+        journal.apply_records(records[:2])
+        journal.apply_records(records)
+
+        self.assertEqual(Message.objects.for_room(room.id).count(), 3)
+        self.assertEqual(RoomDay.objects.get(room=room).message_count, 3)
+        self.assertEqual(sum(RoomHour.objects.filter(room=room).values_list('message_count', flat=True)), 3)
+
+
+class RoomCacheTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('member')
+        self.room = Room.objects.create(name='Cached', slug='cached')
+
+    def test_saved_room_is_read_again(self):
+        get_room('cached')
+        self.room.name = 'Renamed'
+        self.room.save()
+        self.assertEqual(get_room('cached').name, 'Renamed')
+
+    def test_new_slug_leaves_nothing_under_the_old_one(self):
+        get_room('cached')
+        self.room.slug = 'moved'
+        self.room.save()
+        self.assertIsNone(get_room('cached'))
+        self.assertEqual(get_room('moved').pk, self.room.pk)
+
+    def test_deleted_room_is_gone(self):
+        get_room('cached')
+        self.room.delete()
+        self.assertIsNone(get_room('cached'))
+
+    def test_membership_changes_are_seen(self):
+        other = User.objects.create_user('other')
+        self.assertFalse(is_member(self.room.id, self.user))
+        add_members(self.room, [self.user.id])
+        self.assertTrue(is_member(self.room.id, self.user))
+        remove_members(self.room, [self.user.id])
+        self.assertFalse(is_member(self.room.id, self.user))
+        # Through the ORM, from either side
+        self.assertFalse(is_member(self.room.id, other))
+        self.room.participants.add(other)
+        self.assertTrue(is_member(self.room.id, other))
+        other.chat_rooms.remove(self.room)
+        self.assertFalse(is_member(self.room.id, other))
+
+
+class RoomPageTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader')
+        self.room = Room.objects.create(name='Page', slug='page', created_by=self.user, is_private=False)
+        self.room.participants.add(self.user)
+        self.client.force_login(self.user)
+
+    def etag(self):
+        response = self.client.get(reverse('room', args=[self.room.slug]))
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    @mock.patch('room.views.time.time', return_value=1_000_000.0)
+    def test_etag_follows_room_changes(self, _time):
+        etag = self.etag()
+        self.assertEqual(self.etag(), etag)
+        for field, value in (('name', 'Renamed'), ('is_private', True), ('message_retention_days', 7)):
+            setattr(self.room, field, value)
+            self.room.save()
+            self.assertNotEqual(self.etag(), etag, field)
+            etag = self.etag()
+
+    def test_etag_expires_with_the_online_list(self):
+        with mock.patch('room.views.time.time', return_value=1_000_000.0):
+            etag = self.etag()
+        with mock.patch('room.views.time.time', return_value=1_000_000.0 + 60):
+            self.assertNotEqual(self.etag(), etag)
+
+    def test_get_messages_rejects_bad_cursors(self):
+        url = reverse('get_messages', args=[self.room.slug])
+        for name in ('before_id', 'after_seq', 'before_seq', 'after_id', 'after_date'):
+            response = self.client.get(url, {name: 'abc'})
+            self.assertEqual(response.status_code, 400, name)
+            self.assertEqual(response.json()['status'], 'error')
+        self.assertEqual(self.client.get(url, {'after_id': '1'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'after_seq': '0'}).status_code, 200)
+
+    def test_jump_to_date_pages_in_date_order(self):
+        def history(stamps):
+            return io.BytesIO(''.join(json.dumps({
+                'room': 'page', 'user': 'reader', 'content': stamp, 'timestamp': f'2021-03-{stamp}Z'
+            }) + '\n' for stamp in stamps).encode())
+
+        later = [f'04T10:00:{second:02}' for second in range(21)]
+        HistoryImporter().run(history(later))
+        # Imported after them, so with higher ids, but earlier in the day and the day before
+        HistoryImporter().run(history(['04T01:00:00', '03T23:59:59']))
+
+        jump = self.client.get(reverse('jump_to_date', args=[self.room.slug]), {'date': '2021-03-04'}).json()
+        url = reverse('get_messages', args=[self.room.slug])
+        first_page = self.client.get(url, {'after_date': jump['after_date']}).json()['messages']
+        last = first_page[-1]
+        second_page = self.client.get(url, {'after_date': last['timestamp'], 'after_id': last['id']}).json()['messages']
+        self.assertEqual(
+            [message['content'] for message in first_page + second_page], ['04T01:00:00'] + later
+        )
+
+
+class ReceiptTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.author, self.reader, self.other = (User.objects.create_user(name) for name in ('author', 'reader', 'other'))
+        self.room = Room.objects.create(name='Receipts', slug='receipts', is_private=False)
+        add_members(self.room, [self.author.id, self.reader.id, self.other.id])
+        self.room.refresh_from_db()
+
+    def post_messages(self):
+        # One for the room, one for each of two readers
+        return [
+            post_message(self.room, self.author, 'everyone'),
+            post_message(self.room, self.author, 'for you', target_user=self.reader, is_targeted=True),
+            post_message(self.room, self.author, 'not for you', target_user=self.other, is_targeted=True),
+        ]
+
+    def read_state(self, messages):
+        names = {user.id: user.username for user in (self.author, self.reader, self.other)}
+        return [
+            (message.is_read, sorted(names[user_id] for user_id in message.read_receipts().values_list('user_id', flat=True)))
+            for message in Message.objects.for_room(self.room.id).filter(pk__in=[m.pk for m in messages]).order_by('seq')
+        ]
+
+    def test_read_frames_stop_at_the_latest_message(self):
+        for name, app in CHAT_CONSUMERS.items():
+            ReadMarker.objects.all().delete()
+            sequence.allocator.forget(self.room.id)
+            latest = [post_message(self.room, self.author, 'hello') for _ in range(2)][-1].seq
+
+            async def session():
+                communicator = await connect(app, self.reader, self.room)
+                await receive_frames(communicator, 2)
+                markers = []
+                for up_to in (True, 0, latest + 10 ** 6):
+                    await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps({'type': 'read', 'up_to': up_to})})
+                    # Read frames get no reply; give the consumer a moment to take it
+                    await asyncio.sleep(0.05)
+                    await receipts.flush(get_channel_layer())
+                    markers.append(await database_sync_to_async(
+                        lambda: list(ReadMarker.objects.filter(room=self.room).values_list('last_read_seq', flat=True))
+                    )())
+                frames = await receive_frames(communicator, 1)
+                await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+                await communicator.wait(2)
+                return markers, frames
+
+            markers, frames = async_to_sync(session)()
+            self.assertEqual(markers, [[], [], [latest]], name)
+            self.assertEqual(frames, [{'type': 'read_receipts', 'receipts': {'reader': latest}}], name)
+
+    def test_record_read_keeps_each_readers_furthest_seq(self):
+        messages = self.post_messages()
+        # Without a running flusher nothing would store the read, so it is dropped
+        receipts.record_read(self.room.id, self.reader.id, messages[-1].seq)
+        with mock.patch.object(receipts.ticks, 'is_running', return_value=True):
+            receipts.record_read(self.room.id, self.reader.id, messages[1].seq)
+            receipts.record_read(self.room.id, self.reader.id, messages[0].seq)
+        async_to_sync(receipts.flush)(get_channel_layer())
+
+        self.assertEqual(
+            list(ReadMarker.objects.filter(room=self.room).values_list('user__username', 'last_read_seq')),
+            [('reader', messages[1].seq)]
+        )
+        # A targeted message is read once its target has read it; the room's message needs both readers
+        self.assertEqual(self.read_state(messages), [(False, ['reader']), (True, ['reader']), (False, [])])
+
+    def test_mark_all_read_covers_what_the_reader_can_see(self):
+        messages = self.post_messages()
+
+        self.assertEqual(receipts.mark_all_read(self.room, self.reader.id), 2)
+        self.assertEqual(receipts.mark_all_read(self.room, self.reader.id), 0)
+        self.assertEqual(self.read_state(messages), [(False, ['reader']), (True, ['reader']), (False, [])])
+        self.assertEqual(receipts.mark_all_read(self.room, self.other.id), 2)
+        self.assertEqual(
+            self.read_state(messages), [(True, ['other', 'reader']), (True, ['reader']), (True, ['other'])]
+        )
+
+
+class InboxTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def test_unshown_messages_stay_while_the_client_reads_past_them(self):
+        sender, recipient = User.objects.create_user('sender'), User.objects.create_user('recipient')
+        rooms = [Room.objects.create(name=f'Inbox {i}', slug=f'inbox-{i}') for i in range(2)]
+        # The inbox is ordered by message id, which with shards is not posting order
+        sent = sorted(
+            post_message(rooms[i % 2], sender, f'dm {i}', target_user=recipient, is_targeted=True).id
+            for i in range(5)
+        )
+
+        messages, more = inbox.pending(recipient.id, limit=2)
+        self.assertEqual(([message['message_id'] for message in messages], more), (sent[:2], True))
+        # A room page acknowledges only the message of its room that it showed
+        frame = async_to_sync(inbox.handle_ack)(recipient.id, {
+            'message_ids': [sent[0]], 'more': True, 'after': sent[1]
+        })
+        self.assertEqual([message['message_id'] for message in frame['messages']], sent[2:])
+
+        self.assertEqual(
+            [message['message_id'] for message in inbox.pending(recipient.id)[0]], sent[1:]
+        )
+
+
+class ExportTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    @mock.patch.object(export, 'USERNAME_CACHE_SIZE', 2)
+    def test_small_username_cache_over_many_chunks(self):
+        users = [User.objects.create_user(f'exporter{i}') for i in range(6)]
+        room = Room.objects.create(name='Export', slug='export')
+        expected = []
+        for i in range(20):
+            sender, target = users[i % 6], users[(i * 5 + 1) % 6] if i % 3 else None
+            post_message(room, sender, f'line {i}', target_user=target, is_targeted=target is not None)
+            expected.append((sender.username, target.username if target else None))
+
+        exported = [(row['username'], row['target_user']) for row in export.iter_messages(room, chunk_size=3)]
+        self.assertEqual(exported, expected)
+
+
+class ImportTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def history(self, lines):
+        return io.BytesIO(''.join(f'{line}\n' for line in lines).encode())
+
+    def record(self, i, **fields):
+        return json.dumps({
+            'room': 'imported', 'user': 'importer', 'content': f'line {i}',
+            'timestamp': f'2021-03-04T05:06:{i:02}Z', **fields
+        })
+
+    def test_bad_lines_and_records_are_skipped_and_counted(self):
+        importer = HistoryImporter(create_users=True, create_rooms=True)
+        importer.run(self.history([
+            self.record(1),
+            '{"room": "imported", "user": ',
+            '[1, 2]',
+            json.dumps({'room': 'imported', 'user': 'importer', 'content': 'no timestamp'}),
+            self.record(2, timestamp='yesterday'),
+            self.record(3, content=''),
+            self.record(4, user=None),
+            self.record(5),
+        ]), batch_size=3)
+
+        self.assertEqual((importer.imported, importer.skipped), (2, 6))
+        room = Room.objects.get(slug='imported')
+        self.assertEqual(
+            sorted(Message.objects.for_room(room.id).values_list('content', flat=True)), ['line 1', 'line 5']
+        )
+
+    def test_resumed_import_counts_each_message_once(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        checkpoint_path = f'{directory.name}/checkpoint.json'
+        history = self.history(
+            self.record(i, user=f'importer{i % 2}', target_user='importer0' if i % 3 == 0 else None)
+            for i in range(10)
+        )
+
+        # Crash after the second batch is stored but before it is checkpointed
+        write_checkpoint = HistoryImporter.write_checkpoint
+        checkpoints = []
+
+        def crash_on_second_batch(importer, state):
+            if 'pending' not in state:
+                checkpoints.append(state)
+                if len(checkpoints) == 2:
+                    raise RuntimeError('crashed')
+            write_checkpoint(importer, state)
+
+        with mock.patch.object(HistoryImporter, 'write_checkpoint', crash_on_second_batch):
+            with self.assertRaises(RuntimeError):
+                HistoryImporter(checkpoint_path, create_users=True, create_rooms=True).run(history, batch_size=4)
+        history.seek(0)
+        HistoryImporter(checkpoint_path).run(history, batch_size=4)
+
+        room = Room.objects.get(slug='imported')
+        self.assertEqual(Message.objects.for_room(room.id).count(), 10)
+        self.assertEqual(RoomDay.objects.get(room=room).message_count, 10)
+        hour = RoomHour.objects.get(room=room)
+        self.assertEqual((hour.message_count, hour.targeted_count, hour.sender_count), (10, 4, 2))
+        self.assertEqual(
+            sorted(RoomHourSender.objects.filter(room=room).values_list('message_count', flat=True)), [5, 5]
+        )
+
+
+class RoomSettingsTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.room = Room.objects.create(name='Settings', slug='settings', created_by=self.owner, message_retention_days=30)
+        self.client.force_login(self.owner)
+
+    def post(self, **data):
+        response = self.client.post(reverse('room_settings', args=[self.room.slug]), {'name': 'Settings', **data})
+        self.room.refresh_from_db()
+        return response
+
+    def test_retention_changes_only_when_sent(self):
+        self.assertEqual(self.post(is_private='on').status_code, 302)
+        self.assertEqual(self.room.message_retention_days, 30)
+        self.post(message_retention_days=' 7 ')
+        self.assertEqual(self.room.message_retention_days, 7)
+        self.post(message_retention_days='')
+        self.assertIsNone(self.room.message_retention_days)
+
+    def test_bad_retention_is_rejected(self):
+        for value in ('week', '-3', '1.5'):
+            self.assertEqual(self.post(message_retention_days=value).status_code, 400, value)
+        self.assertEqual(self.room.message_retention_days, 30)
+
+
+class RetentionTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('reader')
+        self.room = Room.objects.create(name='Retention', slug='retention')
+
+    def store(self, room, *dates):
+        messages = [
+            Message.objects.for_room(room.id).create(room=room, user=self.user, content='news', date_added=date)
+            for date in dates
+        ]
+        messages_stored.send(sender=Message, messages=messages, using=messages[0]._state.db)
+        return messages
+
+    def test_prune_room_deletes_before_the_cutoff(self):
+        cutoff = datetime(2026, 3, 10, 12, tzinfo=dt_timezone.utc)
+        old, just_before, at_cutoff, newer = self.store(
+            self.room, cutoff - timedelta(days=2), cutoff - timedelta(microseconds=1), cutoff, cutoff + timedelta(days=1)
+        )
+        for message in (old, at_cutoff):
+            message.read_by_users.add(self.user)
+
+        self.assertEqual(retention.prune_room(self.room, cutoff, batch_size=1, pause=0), 2)
+        self.assertEqual(
+            sorted(Message.objects.for_room(self.room.id).values_list('id', flat=True)), [at_cutoff.id, newer.id]
+        )
+        self.assertEqual(
+            list(Message.read_by_users.through.objects.using(at_cutoff._state.db).values_list('message_id', flat=True)),
+            [at_cutoff.id]
+        )
+        # The emptied day is gone and the cutoff's day is recounted
+        self.assertEqual(
+            dict(RoomDay.objects.filter(room=self.room).values_list('day', 'message_count')),
+            {cutoff.date(): 1, (cutoff + timedelta(days=1)).date(): 1}
+        )
+
+    def test_prune_messages_command_keeps_rooms_without_retention(self):
+        short_memory = Room.objects.create(name='Short memory', slug='short-memory', message_retention_days=7)
+        now = timezone.now()
+        self.store(short_memory, now - timedelta(days=8), now - timedelta(days=6))
+        self.store(self.room, now - timedelta(days=400))
+
+        out = io.StringIO()
+        call_command('prune_messages', pause=0, stdout=out)
+        self.assertIn('short-memory: pruned 1 message(s)', out.getvalue())
+        self.assertEqual(Message.objects.for_room(short_memory.id).count(), 1)
+        self.assertEqual(Message.objects.for_room(self.room.id).count(), 1)
+
+
+class InvitationTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.room = Room.objects.create(name='Invites', slug='invites', created_by=self.owner)
+        self.now = timezone.now()
+
+    def invite(self, username, expires_in, status='pending'):
+        return Invitation.objects.create(
+            room=self.room, invited_by=self.owner, invited_user=User.objects.create_user(username), status=status,
+            expires_at=None if expires_in is None else self.now + expires_in
+        )
+
+    def test_bulk_invite_sorts_every_username(self):
+        add_members(self.room, [User.objects.create_user('member').id])
+        self.invite('invited', timedelta(days=1))
+        self.invite('open-ended', None)
+        self.invite('lapsed', -timedelta(days=1))
+        User.objects.create_user('newcomer')
+
+        with self.assertNumQueries(4):
+            result = bulk_invite(self.room, self.owner, ['member', 'invited', 'open-ended', 'lapsed', 'newcomer', 'nobody'])
+        self.assertEqual(result, {
+            'invited': ['lapsed', 'newcomer'],
+            'already_member': ['member'],
+            'already_invited': ['invited', 'open-ended'],
+            'not_found': ['nobody'],
+        })
+        self.assertEqual(
+            Invitation.objects.filter(invited_user__username='newcomer').get().expires_at.date(),
+            (self.now + INVITATION_LIFETIME).date()
+        )
+
+    def test_expire_invitations_marks_only_lapsed_pending_ones(self):
+        lapsed = [self.invite(f'lapsed-{i}', -timedelta(minutes=i + 1)) for i in range(3)]
+        kept = [
+            self.invite('invited', timedelta(days=1)),
+            self.invite('open-ended', None),
+            self.invite('accepted', -timedelta(days=1), status='accepted'),
+        ]
+        out = io.StringIO()
+        call_command('expire_invitations', chunk_size=2, stdout=out)
+
+        self.assertEqual(out.getvalue(), 'Expired 3 invitation(s).\n')
+        statuses = dict(Invitation.objects.values_list('id', 'status'))
+        self.assertEqual([statuses[invitation.id] for invitation in lapsed], ['expired'] * 3)
+        self.assertEqual([statuses[invitation.id] for invitation in kept], ['pending', 'pending', 'accepted'])
+
+
+class ManageMembersTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.room = Room.objects.create(name='Members', slug='members', created_by=self.owner)
+        add_members(self.room, [self.owner.id])
+        self.users = [User.objects.create_user(f'user-{i}') for i in range(5)]
+        self.client.force_login(self.owner)
+
+    def post(self, body):
+        return self.client.post(reverse('manage_members', args=[self.room.slug]), body, content_type='application/json')
+
+    def members(self):
+        return sorted(self.room.participants.values_list('username', flat=True))
+
+    def test_bad_bodies_are_rejected(self):
+        for body in ('[]', '"user-0"', '{"add": "user-0"}', '{"add": [1]}', '{"remove": [null]}', '{"add": [["user-0"]]}'):
+            self.assertEqual(self.post(body).status_code, 400, body)
+        self.assertEqual(self.members(), ['owner'])
+
+    def test_members_change_through_the_view(self):
+        version = members_version(self.room.id)
+        response = self.post({'add': ['user-0', 'user-1', 'ghost'], 'remove': ['owner']}).json()
+
+        self.assertEqual((response['added'], response['removed'], response['not_found']), (2, 0, ['ghost']))
+        self.assertEqual(self.members(), ['owner', 'user-0', 'user-1'])
+        self.assertNotEqual(members_version(self.room.id), version)
+        self.assertEqual(self.post({'remove': ['user-1']}).json()['removed'], 1)
+        self.assertEqual(self.members(), ['owner', 'user-0'])
+
+    def test_members_change_in_chunks(self):
+        user_ids = [user.id for user in self.users]
+        progress = []
+        versions = [members_version(self.room.id)]
+
+        def record(processed, total):
+            progress.append((processed, total))
+            versions.append(members_version(self.room.id))
+
+        self.assertEqual(add_members(self.room, user_ids, chunk_size=2, progress=record), 5)
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        # Each chunk that changed something bumps the version once
+        self.assertEqual(len(set(versions)), 4)
+        self.assertEqual(self.room.participants.count(), 6)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.participant_count, 6)
+
+        # Nothing new, nothing bumped
+        self.assertEqual(add_members(self.room, user_ids[:2], chunk_size=2), 0)
+        self.assertEqual(members_version(self.room.id), versions[-1])
+
+        self.assertEqual(remove_members(self.room, user_ids[:3] + [self.owner.id], chunk_size=2), 3)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.participant_count, 3)
+        self.assertNotEqual(members_version(self.room.id), versions[-1])
+
+
+class MessageAdminTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        admin = User.objects.create_superuser('admin')
+        self.client.force_login(admin)
+        self.rooms = [Room.objects.create(name=f'Admin {i}', slug=f'admin-{i}') for i in range(3)]
+        self.posted = {room.id: [post_message(room, admin, 'hello').id for _ in range(2)] for room in self.rooms}
+
+    def changelist(self, **params):
+        response = self.client.get(reverse('admin:room_message_changelist'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def expected(self, db):
+        return sorted(
+            (message_id for room_id, ids in self.posted.items() if message_db_for_room(room_id) == db for message_id in ids),
+            reverse=True
+        )
+
+    def test_lists_one_database_at_a_time(self):
+        first = message_databases()[0]
+        response = self.changelist()
+        self.assertEqual([message.id for message in response.context['cl'].result_list], self.expected(first))
+        for db in message_databases():
+            response = self.changelist(db=db)
+            self.assertEqual([message.id for message in response.context['cl'].result_list], self.expected(db), db)
+            if message_shards():
+                changelist = response.context['cl']
+                shard_filter, = changelist.filter_specs
+                self.assertEqual([choice['display'] for choice in shard_filter.choices(changelist) if choice['selected']], [db])
+                self.assertContains(response, f' in {db}')
+
+
+class UnreadTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def test_targeted_messages_count_only_for_their_target(self):
+        author, target, bystander = (User.objects.create_user(name) for name in ('author', 'target', 'bystander'))
+        room = Room.objects.create(name='Unread', slug='unread')
+        add_members(room, [author.id, target.id, bystander.id])
+        users = (author, target, bystander)
+        self.enterContext(mock.patch.object(unread.ticks, 'is_running', side_effect=lambda name: name == 'unread'))
+
+        async def session():
+            layer = get_channel_layer()
+            # Counts batched by earlier tests' sockets go to nobody here
+            await unread.flush(layer)
+            channels = {}
+            for user in users:
+                channels[user.username] = await layer.new_channel()
+                await layer.group_add(user_group_name(user.id), channels[user.username])
+            for content, target_user in (('everyone', None), ('everyone', None), ('just you', target), ('note to self', author)):
+                await database_sync_to_async(post_message)(
+                    room, author, content, target_user=target_user, is_targeted=target_user is not None
+                )
+            await unread.flush(layer)
+            events = {}
+            for name, channel in channels.items():
+                try:
+                    events[name] = (await asyncio.wait_for(layer.receive(channel), 1))['deltas']
+                except asyncio.TimeoutError:
+                    events[name] = None
+            return events
+
+        self.assertEqual(async_to_sync(session)(), {
+            'author': None,
+            'target': {str(room.id): 3},
+            'bystander': {str(room.id): 2},
+        })
+
+
+class ActivityTests(ActivityFlushMixin, TestCase):
+    def test_activity_is_written_once_per_interval(self):
+        room = Room.objects.create(name='Busy', slug='busy')
+        clock = mock.Mock(return_value=10.0 ** 9)
+        self.enterContext(mock.patch.object(activity.time, 'monotonic', clock))
+        self.enterContext(mock.patch.object(activity, 'FLUSH_INTERVAL', 60))
+        start = timezone.now() + timedelta(minutes=1)
+
+        with count_queries() as queries:
+            activity.touch(room.id, start)
+        # One column, and never backwards
+        update, = queries.queries
+        self.assertRegex(update['sql'], r'^UPDATE "room_room" SET "last_activity" = \'[^\']*\' WHERE .*"last_activity" < ')
+
+        with count_queries() as queries:
+            for seconds in (1, 2):
+                clock.return_value += 1
+                activity.touch(room.id, start + timedelta(seconds=seconds))
+            clock.return_value += 30
+            self.assertEqual(activity.flush(force=False), 0)
+        self.assertEqual(len(queries), 0, queries)
+        room.refresh_from_db()
+        self.assertEqual(room.last_activity, start)
+
+        clock.return_value += 30
+        with count_queries() as queries:
+            self.assertEqual(activity.flush(force=False), 1)
+        self.assertEqual(len(queries), 1, queries)
+        room.refresh_from_db()
+        self.assertEqual(room.last_activity, start + timedelta(seconds=2))
+
+
+class RouterTests(TestCase):
+    databases = '__all__'
+
+    def test_messages_follow_their_room_id(self):
+        router = MessageShardRouter()
+        with override_settings(MESSAGE_SHARDS=3):
+            self.assertEqual(
+                [message_db_for_room(room_id) for room_id in range(1, 6)],
+                ['messages_1', 'messages_2', 'messages_0', 'messages_1', 'messages_2']
+            )
+            self.assertEqual(router.db_for_read(Message, instance=Message(room_id=4)), 'messages_1')
+            self.assertEqual(router.db_for_write(Message, instance=Room(pk=5)), 'messages_2')
+            # Without a room to go by the router does not guess
+            self.assertIsNone(router.db_for_read(Message))
+            self.assertEqual(router.db_for_write(Room, instance=Room(pk=5)), 'default')
+        with override_settings(MESSAGE_SHARDS=0):
+            self.assertEqual(message_db_for_room(5), 'default')
+            self.assertEqual(message_databases(), ['default'])
+
+    def test_shards_only_take_message_tables(self):
+        router = MessageShardRouter()
+        with override_settings(MESSAGE_SHARDS=2):
+            self.assertTrue(router.allow_migrate('messages_1', 'room', 'message'))
+            self.assertTrue(router.allow_migrate('messages_1', 'room', 'message_read_by_users'))
+            self.assertFalse(router.allow_migrate('messages_1', 'room', 'room'))
+            self.assertFalse(router.allow_migrate('messages_1', 'auth', 'user'))
+            # The default database keeps everything, message tables included
+            self.assertIsNone(router.allow_migrate('default', 'room', 'message'))
+            self.assertIsNone(router.allow_migrate('default', 'room', 'room'))
+
+    @skipUnless(message_shards(), 'needs DJANGO_MESSAGE_SHARDS')
+    def test_each_shard_allocates_ids_from_its_own_block(self):
+        user = User.objects.create_user('writer')
+        shards = message_shards()
+        rooms = [Room.objects.create(name=f'Shard {i}', slug=f'shard-{i}') for i in range(len(shards))]
+        for room in rooms:
+            message = post_message(room, user, 'hello')
+            block = shards.index(message._state.db)
+            self.assertGreater(message.id, block * SHARD_ID_BLOCK)
+            self.assertLess(message.id, (block + 1) * SHARD_ID_BLOCK)
+            # Seeding again, as another migrate would, leaves a used block alone
+            seed_message_ids(message._state.db)
+            self.assertEqual(post_message(room, user, 'again').id, message.id + 1)
+
+
+class ProfilingTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.user = User.objects.create_user('profiled')
+        self.room = Room.objects.create(name='Profiled', slug='profiled', is_private=False)
+
+    def test_handlers_are_sampled_only_when_profiling_is_on(self):
+        # PROFILING_DIR is unset in tests, so the consumers' handlers are left undecorated
+        self.assertIs(profiling.profiled_handler(ChatConsumer.receive), ChatConsumer.receive)
+
+        self.enterContext(mock.patch.object(profiling, 'PROFILING_DIR', str(self.directory)))
+        self.enterContext(mock.patch.object(profiling, 'MIN_INTERVAL', 0))
+        for consumer in (ChatConsumer, LeanChatConsumer):
+            self.enterContext(mock.patch.object(consumer, 'receive', profiling.profiled_handler(consumer.receive)))
+        for name, app in CHAT_CONSUMERS.items():
+            async_to_sync(chat_session)(app, self.user, self.room)
+            self.assertEqual(list(self.directory.iterdir()), [], name)
+            with mock.patch.object(profiling, 'PROFILING_USERS', frozenset({'profiled'})):
+                async_to_sync(chat_session)(app, self.user, self.room)
+            # Files are named to the second, so the message and typing frames may share one
+            profiles = list(self.directory.glob('*-ws-receive-_ws_chat_profiled_.prof'))
+            self.assertTrue(profiles, name)
+            self.assertIn('receive_frame', str(pstats.Stats(str(profiles[0])).stats))
+            for profile in profiles:
+                profile.unlink()
+
+
+class TracingTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def test_message_trace_reaches_the_delivery_log(self):
+        user = User.objects.create_user('traced')
+        room = Room.objects.create(name='Traced', slug='traced', is_private=False)
+        self.enterContext(mock.patch.object(tracing, 'TRACING_ENABLED', True))
+        # Every trace counts as slow, so each one is logged with its spans
+        self.enterContext(mock.patch.object(tracing, 'SLOW_THRESHOLD', 0))
+        self.enterContext(mock.patch.object(tracing, 'SLOW_SAMPLE_RATE', 1.0))
+        for name, app in CHAT_CONSUMERS.items():
+            tracing.reset()
+            with self.assertLogs('room.tracing', 'WARNING') as logs:
+                async_to_sync(chat_session)(app, user, room)
+
+            # The sender's trace, then the recipient's, whichever was logged first
+            (sent_id, sent_spans), (delivered_id, delivered_spans) = sorted(
+                (re.fullmatch(r'WARNING:room.tracing:Slow message trace (\w+): (.*)', line).groups() for line in logs.output),
+                key=lambda trace: trace[1].startswith('layer=')
+            )
+            self.assertEqual(delivered_id, sent_id, name)
+            self.assertEqual(re.findall(r'(\w+)=', sent_spans), ['save_message', 'group_send', 'receive'], name)
+            self.assertEqual(re.findall(r'(\w+)=', delivered_spans), ['layer', 'chat_message', 'delivery'], name)
+            self.assertEqual(
+                {stage: summary['count'] for stage, summary in tracing.snapshot().items()},
+                dict.fromkeys(['save_message', 'group_send', 'receive', 'layer', 'chat_message', 'delivery'], 1), name
+            )
+
+
+class MentionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.ann, self.anna, self.bob = (User.objects.create_user(name) for name in ('ann', 'anna', 'bob'))
+        self.room = Room.objects.create(name='Mentions', slug='mentions')
+        add_members(self.room, [self.ann.id, self.anna.id])
+
+    def mentioned(self):
+        return find_mentions(self.room.id, 'hi @ann, @anna and @bob')
+
+    def test_member_changes_update_the_matcher_in_place(self):
+        self.assertEqual(self.mentioned(), [self.ann.id, self.anna.id])
+        changes = [
+            (lambda: add_members(self.room, [self.bob.id]), [self.ann.id, self.anna.id, self.bob.id]),
+            # Dropping "anna" leaves "ann", which shares its branch
+            (lambda: remove_members(self.room, [self.anna.id]), [self.ann.id, self.bob.id]),
+            (lambda: self.room.participants.add(self.anna), [self.ann.id, self.anna.id, self.bob.id]),
+            (lambda: self.bob.chat_rooms.remove(self.room), [self.ann.id, self.anna.id]),
+        ]
+        for change, expected in changes:
+            change()
+            # Not rebuilt from the database
+            with self.assertNumQueries(0):
+                self.assertEqual(self.mentioned(), expected)
+
+    def test_changes_made_elsewhere_rebuild_the_matcher(self):
+        self.assertEqual(self.mentioned(), [self.ann.id, self.anna.id])
+        # As another process would: the row and a version bump this process did not see
+        RoomMembership.objects.create(room=self.room, user=self.bob)
+        bump_members_version(self.room.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.mentioned(), [self.ann.id, self.anna.id, self.bob.id])
+
+
+class RoomAnalyticsTests(ActivityFlushMixin, TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.owner, self.member = User.objects.create_user('owner'), User.objects.create_user('member')
+        self.room = Room.objects.create(name='Analytics', slug='analytics', created_by=self.owner)
+        add_members(self.room, [self.owner.id, self.member.id])
+
+    def get(self, user, **params):
+        self.client.force_login(user)
+        return self.client.get(reverse('room_analytics', args=[self.room.slug]), params)
+
+    def test_only_the_creator_and_staff_see_analytics(self):
+        self.assertEqual(self.get(self.member).status_code, 403)
+        self.assertEqual(self.get(User.objects.create_user('staff', is_staff=True)).status_code, 200)
+        self.assertEqual(self.get(self.owner).status_code, 200)
+
+    def test_hourly_totals(self):
+        this_hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        sent = [
+            # Outside a three-hour window
+            (self.owner, None, this_hour - timedelta(hours=3, minutes=-10)),
+            (self.owner, None, this_hour - timedelta(hours=2, minutes=-10)),
+            (self.member, self.owner, this_hour - timedelta(hours=2, minutes=-20)),
+            (self.member, None, this_hour - timedelta(hours=2, minutes=-30)),
+            (self.member, None, this_hour),
+        ]
+        messages = [
+            Message.objects.for_room(self.room.id).create(
+                room=self.room, user=user, target_user=target, is_targeted=target is not None, content='hi', date_added=when
+            )
+            for user, target, when in sent
+        ]
+        messages_stored.send(sender=Message, messages=messages, using=messages[0]._state.db)
+
+        self.assertEqual(self.get(self.owner, hours=3).json()['hours'], [
+            {'hour': (this_hour - timedelta(hours=2)).isoformat(), 'messages': 3, 'senders': 2, 'dm_ratio': 0.3333},
+            {'hour': this_hour.isoformat(), 'messages': 1, 'senders': 1, 'dm_ratio': 0.0},
+        ])
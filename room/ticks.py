@@ -0,0 +1,31 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+
+# Periodic tasks that batch websocket pushes. They run on the process's
+# event loop and are started by the first websocket connection; processes
+# without an event loop (management commands, WSGI workers) have none, and
+# modules check is_running() before buffering anything for them.
+
+_tasks = {}
+
+
+async def _run(interval, callback):
+    channel_layer = get_channel_layer()
+    while True:
+        await asyncio.sleep(interval)
+        await callback(channel_layer)
+
+
+def ensure_periodic(name, interval, callback):
+    """Run ``await callback(channel_layer)`` every ``interval`` seconds on the running loop."""
+    loop = asyncio.get_running_loop()
+    task = _tasks.get(name)
+    if task is None or task.done() or task.get_loop() is not loop:
+        _tasks[name] = loop.create_task(_run(interval, callback))
+
+
+def is_running(name):
+    # A task whose loop has finished is done, and nothing will flush for it
+    task = _tasks.get(name)
+    return task is not None and not task.done()
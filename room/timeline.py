@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connections, transaction
+from django.db.models import Count, Max, Min
+from django.db.models.functions import TruncDate
+
+from .models import Message, RoomDay
+
+# RoomDay holds one row per room and UTC day with the message count and the
+# first and last message ids. New messages are added with one upsert per
+# batch (messages_stored), and deletions recount the days they touched, so
+# jumping to a date or drawing an activity histogram is a lookup on the
+# (room, day) index instead of a scan of the message table.
+
+
+def message_day(message_date):
+    return message_date.astimezone(dt_timezone.utc).date()
+
+
+def messages_added(messages):
+    days = {}
+    for message in messages:
+        key = (message.room_id, message_day(message.date_added))
+        count, first, last = days.get(key, (0, message.id, message.id))
+        days[key] = (count + 1, min(first, message.id), max(last, message.id))
+    if not days:
+        return
+    with connections['default'].cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {RoomDay._meta.db_table} (room_id, day, message_count, first_message_id, last_message_id) '
+            f'VALUES (%s, %s, %s, %s, %s) ON CONFLICT (room_id, day) DO UPDATE SET '
+            f'message_count = message_count + excluded.message_count, '
+            f'first_message_id = MIN(first_message_id, excluded.first_message_id), '
+            f'last_message_id = MAX(last_message_id, excluded.last_message_id)',
+            [(room_id, day.isoformat(), count, first, last) for (room_id, day), (count, first, last) in days.items()]
+        )
+
+
+def refresh_day(room_id, day):
+    """Recount one room day from the message table, served by the (room, date_added) index."""
+    start = datetime(day.year, day.month, day.day, tzinfo=dt_timezone.utc)
+    totals = Message.objects.for_room(room_id).filter(
+        date_added__gte=start,
+        date_added__lt=start + timedelta(days=1)
+    ).aggregate(count=Count('id'), first=Min('id'), last=Max('id'))
+    if totals['count']:
+        RoomDay.objects.filter(room_id=room_id, day=day).update(
+            message_count=totals['count'],
+            first_message_id=totals['first'],
+            last_message_id=totals['last']
+        )
+    else:
+        RoomDay.objects.filter(room_id=room_id, day=day).delete()
+
+
+def messages_deleted(rows):
+    """Update the rollup after deleting messages given as (room_id, date_added) pairs."""
+    for room_id, day in {(room_id, message_day(date_added)) for room_id, date_added in rows}:
+        refresh_day(room_id, day)
+
+
+def rebuild_room(room_id):
+    """Recompute every day of a room from its messages. Returns the number of days."""
+    days = Message.objects.for_room(room_id).order_by().annotate(
+        day=TruncDate('date_added', tzinfo=dt_timezone.utc)
+    ).values('day').annotate(count=Count('id'), first=Min('id'), last=Max('id'))
+    with transaction.atomic():
+        RoomDay.objects.filter(room_id=room_id).delete()
+        RoomDay.objects.bulk_create([
+            RoomDay(
+                room_id=room_id,
+                day=row['day'],
+                message_count=row['count'],
+                first_message_id=row['first'],
+                last_message_id=row['last']
+            )
+            for row in days
+        ])
+    return len(days)
+
+
+def find_day(room_id, day):
+    """The first day with messages on or after ``day``, or None."""
+    return RoomDay.objects.filter(room_id=room_id, day__gte=day).order_by('day').first()
+
+
+def activity_histogram(room_id, start, end):
+    """Message counts per day from start to end inclusive, with empty days as 0."""
+    counts = dict(RoomDay.objects.filter(
+        room_id=room_id, day__gte=start, day__lte=end
+    ).values_list('day', 'message_count'))
+    return [
+        {'day': (start + timedelta(days=offset)).isoformat(), 'count': counts.get(start + timedelta(days=offset), 0)}
+        for offset in range((end - start).days + 1)
+    ]
@@ -0,0 +1,151 @@
+import bisect
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Latency tracing for chat messages. With MESSAGE_TRACING on, the sending
+# consumer times `save_message` and `group_send`, and puts a trace id plus
+# wall-clock timestamps in the channel layer event. Each recipient then
+# records time spent in the layer, its own `chat_message` send, and total
+# delivery latency since the sender's receive() started.
+#
+# Per-stage histograms are kept in memory and logged every
+# MESSAGE_TRACING_REPORT_INTERVAL seconds. Traces slower than
+# MESSAGE_TRACING_SLOW_THRESHOLD are logged with their spans, sampled at
+# MESSAGE_TRACING_SLOW_SAMPLE_RATE.
+
+TRACING_ENABLED = getattr(settings, 'MESSAGE_TRACING', False)
+SLOW_THRESHOLD = getattr(settings, 'MESSAGE_TRACING_SLOW_THRESHOLD', 0.5)
+SLOW_SAMPLE_RATE = getattr(settings, 'MESSAGE_TRACING_SLOW_SAMPLE_RATE', 1.0)
+REPORT_INTERVAL = getattr(settings, 'MESSAGE_TRACING_REPORT_INTERVAL', 60)
+
+# Upper bucket bounds in milliseconds; the last bucket is unbounded
+BUCKET_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, fraction):
+        """Upper bound in ms of the bucket holding the given percentile."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 2) if self.count else None,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+        }
+
+
+_lock = threading.Lock()
+_histograms = {}
+_last_report = time.monotonic()
+
+
+def record(stage, seconds):
+    global _last_report
+    with _lock:
+        _histograms.setdefault(stage, Histogram()).record(seconds)
+        now = time.monotonic()
+        if now - _last_report < REPORT_INTERVAL:
+            return
+        _last_report = now
+        report = {stage: histogram.summary() for stage, histogram in _histograms.items()}
+    logger.info('Message latency by stage: %s', report)
+
+
+def snapshot():
+    """Return a summary of every stage recorded so far."""
+    with _lock:
+        return {stage: histogram.summary() for stage, histogram in _histograms.items()}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+class Trace:
+    def __init__(self, trace_id=None, started_at=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.started_at = started_at or time.time()
+        self.spans = []
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(stage, time.perf_counter() - started)
+
+    def _add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+        record(stage, seconds)
+
+    def event_fields(self):
+        """Fields to carry the trace through a channel layer event."""
+        return {'trace_id': self.trace_id, 'trace_started_at': self.started_at, 'trace_sent_at': time.time()}
+
+    def finish(self, stage):
+        """Record the time since the trace started, logging it if slow."""
+        elapsed = max(time.time() - self.started_at, 0)
+        self._add(stage, elapsed)
+        if elapsed >= SLOW_THRESHOLD and random.random() < SLOW_SAMPLE_RATE:
+            logger.warning(
+                'Slow message trace %s: %s', self.trace_id,
+                ', '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in self.spans)
+            )
+
+
+class _NullTrace:
+    def span(self, stage):
+        return nullcontext()
+
+    def event_fields(self):
+        return {}
+
+    def finish(self, stage):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+def start_trace():
+    return Trace() if TRACING_ENABLED else NULL_TRACE
+
+
+def continue_trace(event):
+    """Pick up a trace from a channel layer event, recording time spent in the layer."""
+    if 'trace_id' not in event:
+        return NULL_TRACE
+    trace = Trace(event['trace_id'], event['trace_started_at'])
+    trace._add('layer', max(time.time() - event['trace_sent_at'], 0))
+    return trace
@@ -0,0 +1,85 @@
+import threading
+from collections import Counter
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import ticks
+from .mentions import room_member_ids
+from .notifications import user_group_name
+
+# Unread counts are pushed to users' notification groups as deltas, in at
+# most one event per user per tick. New messages are only counted per room
+# (and per sender, so nobody is told about their own messages); they are
+# expanded to per-user deltas when the tick fires, so a busy room costs one
+# pass over its members per tick rather than per message. A targeted
+# message is counted for its target alone. The flush runs as a periodic
+# task (see room/ticks.py).
+
+TICK = getattr(settings, 'UNREAD_PUSH_TICK', 1.0)
+
+_lock = threading.Lock()
+_new = Counter()
+_own = {}
+_targeted = {}
+_reset = {}
+
+
+def record_messages(messages):
+    if not ticks.is_running('unread'):
+        return
+    with _lock:
+        for message in messages:
+            if message.target_user_id is None:
+                _new[message.room_id] += 1
+                _own.setdefault(message.room_id, Counter())[message.user_id] += 1
+            elif message.target_user_id != message.user_id:
+                _targeted.setdefault(message.room_id, Counter())[message.target_user_id] += 1
+
+
+def mark_room_read(user_id, room_id):
+    """Tell the user's other pages that a room's unread count is now zero."""
+    if not ticks.is_running('unread'):
+        return
+    with _lock:
+        _reset.setdefault(user_id, set()).add(room_id)
+
+
+def _take_events():
+    global _new, _own, _targeted, _reset
+    with _lock:
+        new, own, targeted, reset = _new, _own, _targeted, _reset
+        _new, _own, _targeted, _reset = Counter(), {}, {}, {}
+
+    deltas = {}
+    for room_id, count in new.items():
+        senders = own.get(room_id, {})
+        for user_id in room_member_ids(room_id):
+            delta = count - senders.get(user_id, 0)
+            if delta:
+                deltas.setdefault(user_id, {})[str(room_id)] = delta
+    for room_id, targets in targeted.items():
+        for user_id, count in targets.items():
+            room_deltas = deltas.setdefault(user_id, {})
+            room_deltas[str(room_id)] = room_deltas.get(str(room_id), 0) + count
+
+    events = {}
+    for user_id in deltas.keys() | reset.keys():
+        events[user_id] = {
+            'type': 'unread_counts',
+            'deltas': deltas.get(user_id, {}),
+            'reset': sorted(reset.get(user_id, ()))
+        }
+    return events
+
+
+async def flush(channel_layer):
+    if not _new and not _targeted and not _reset:
+        return
+    events = await database_sync_to_async(_take_events)()
+    for user_id, event in events.items():
+        await channel_layer.group_send(user_group_name(user_id), event)
+
+
+def ensure_flusher():
+    ticks.ensure_periodic('unread', TICK, flush)
@@ -7,11 +7,17 @@ urlpatterns = [
     path('<slug:slug>/', views.room, name='room'),
     path('<slug:slug>/messages/', views.get_messages, name='get_messages'),
     path('<slug:slug>/send/', views.send_message, name='send_message'),
+    path('<slug:slug>/export/', views.export_transcript, name='export_transcript'),
+    path('<slug:slug>/jump/', views.jump_to_date, name='jump_to_date'),
+    path('<slug:slug>/activity/', views.room_activity, name='room_activity'),
+    path('<slug:slug>/analytics/', views.room_analytics, name='room_analytics'),
     path('<slug:slug>/settings/', views.room_settings, name='room_settings'),
+    path('<slug:slug>/members/', views.manage_members, name='manage_members'),
     path('<slug:slug>/leave/', views.leave_room, name='leave_room'),
     path('<slug:slug>/delete/', views.delete_room, name='delete_room'),
     path('search_users/', views.search_users, name='search_users'),
     path('my_invitations/', views.my_invitations, name='my_invitations'),
     path('<slug:room_slug>/invite_username/', views.invite_by_username, name='invite_by_username'),
+    path('<slug:room_slug>/invite_bulk/', views.bulk_invite_by_username, name='bulk_invite_by_username'),
     path('invitation/<uuid:code>/handle/', views.handle_invitation, name='handle_invitation'),
 ]
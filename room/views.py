@@ -1,17 +1,35 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
-from django.db.models import Q
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db.models import Count, Q
 from django.utils.text import slugify
 from .models import Room, Message, Invitation
+from .cache import (
+    get_room, get_room_or_404, is_member, members_version, messages_version, reads_version, room_version
+)
+from .journal import post_message
+from .export import EXPORT_FORMATS, iter_transcript
+from .invitations import INVITATION_LIFETIME, MAX_BULK_INVITES, bulk_invite, not_expired
+from .membership import add_members, remove_members, resolve_usernames
+from .mentions import find_mentions
+from .notifications import notify_mentions
+from .receipts import mark_all_read
+from .unread import mark_room_read
+from .timeline import activity_histogram, find_day
+from .analytics import room_hours
+from .affinity import socket_url
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.contrib import messages
 import json
-from datetime import timedelta
+from datetime import date, datetime, time as dt_time, timedelta, timezone as dt_timezone
 from django.core.mail import send_mail
 from django.conf import settings
 from django.urls import reverse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+import hashlib
+import time
 
 def generate_unique_slug(name):
     """Generate a unique slug for a room name."""
@@ -28,9 +46,14 @@ def generate_unique_slug(name):
 @login_required
 def rooms(request):
     """View for listing all rooms the user is part of."""
-    rooms = Room.objects.filter(
+    rooms = list(Room.objects.filter(
         Q(participants=request.user) | Q(is_private=False)
-    ).distinct()
+    ).distinct().select_related('created_by'))
+    
+    # Last message previews, gathered from whichever database holds each room
+    latest = Message.objects.latest_for_rooms([room.id for room in rooms])
+    for room in rooms:
+        room.last_message = latest.get(room.id)
     
     return render(request, 'room/rooms.html', {
         'rooms': rooms
@@ -58,19 +81,51 @@ def create_room(request):
             
             participant_usernames = request.POST.getlist('participants')
             if participant_usernames:
-                participants = User.objects.filter(username__in=participant_usernames)
-                room.participants.add(*participants)
+                add_members(room, resolve_usernames(participant_usernames).values())
             
             return redirect('room', slug=room.slug)
     
     users = User.objects.exclude(id=request.user.id).order_by('username')
     return render(request, 'room/create_room.html', {'users': users})
 
+# The room page's online list is cached for this many seconds
+ONLINE_USERS_TIMEOUT = 60
+
+def room_etag(request, slug):
+    """ETag for the room page: changes with the room, its messages and membership.
+
+    The online list may be ONLINE_USERS_TIMEOUT seconds stale, like its
+    cached fragment, and the chat socket URL changes when the room moves
+    to another worker.
+    """
+    room = get_room(slug)
+    if room is None:
+        return None
+    state = (
+        f'{room.id}-{room_version(room.id)}-{members_version(room.id)}-{messages_version(room.id)}-'
+        f'{int(time.time() // ONLINE_USERS_TIMEOUT)}-{socket_url(room.slug)}-{request.user.pk}'
+    )
+    return hashlib.md5(state.encode()).hexdigest()
+
+def messages_etag(request, slug):
+    """ETag for a get_messages page: also changes with read receipts and the query."""
+    room = get_room(slug)
+    if room is None:
+        return None
+    state = (
+        f'{room.id}-{members_version(room.id)}-{messages_version(room.id)}-'
+        f'{reads_version(room.id)}-{request.user.pk}-{request.GET.urlencode()}'
+    )
+    return hashlib.md5(state.encode()).hexdigest()
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=room_etag)
 def room(request, slug):
-    room = get_object_or_404(Room, slug=slug)
+    room = get_room_or_404(slug)
+    is_participant = is_member(room.id, request.user)
     
-    if room.is_private and request.user not in room.participants.all():
+    if room.is_private and not is_participant:
         invitation = Invitation.objects.filter(
             room=room,
             invited_user=request.user,
@@ -87,44 +142,37 @@ def room(request, slug):
         return redirect('rooms')
     
     # Get messages for this room
-    room_messages = Message.objects.filter(room=room).order_by('-date_added')[:50]
+    room_messages = Message.objects.for_room(room.id).prefetch_related('user').order_by('-date_added')[:50]
     
     # Get all participants in the room
     participants = room.participants.all()
     
-    # Get targeted message counts for each participant
-    participants_with_messages = []
-    for participant in participants.exclude(id=request.user.id):
-        unread_count = Message.objects.filter(
-            room=room,
-            user=participant,
-            target_user=request.user,
-        ).exclude(read_by_users=request.user).count()
-        
-        participants_with_messages.append({
-            'user': participant,
-            'unread_count': unread_count
-        })
+    # Get targeted message counts for each participant in one grouped query
+    unread_counts = dict(Message.objects.for_room(room.id).filter(
+        target_user=request.user,
+    ).exclude(read_by_users=request.user).values_list('user_id').annotate(count=Count('id')))
     
-    # Mark unread messages as read
-    unread_messages = Message.objects.filter(
-        room=room,
-        is_read=False
-    ).filter(
-        Q(target_user=request.user) | Q(target_user__isnull=True)
-    ).exclude(user=request.user)
+    participants_with_messages = [{
+        'user': participant,
+        'unread_count': unread_counts.get(participant.id, 0)
+    } for participant in participants.exclude(id=request.user.id)]
     
-    for message in unread_messages:
-        message.mark_as_read(request.user)
+    # Mark unread messages as read
+    mark_all_read(room, request.user.id)
+    mark_room_read(request.user.id, room.id)
     
     return render(request, 'room/room.html', {
         'room': room,
         'messages': room_messages,
         'participants': participants_with_messages,
         'online_users': room.get_online_participants(),
-        'is_room_admin': room.created_by == request.user,
-        'can_invite': room.created_by == request.user or (
-            room.is_private and request.user in room.participants.all()
+        'online_users_timeout': ONLINE_USERS_TIMEOUT,
+        'members_version': members_version(room.id),
+        'messages_version': messages_version(room.id),
+        'chat_socket_url': socket_url(room.slug),
+        'is_room_admin': room.created_by_id == request.user.id,
+        'can_invite': room.created_by_id == request.user.id or (
+            room.is_private and is_participant
         ),
     })
 
@@ -138,7 +186,7 @@ def send_message(request, slug):
             target_username = data.get('target_user')  # Username of targeted user
             
             if content:
-                room = get_object_or_404(Room, slug=slug)
+                room = get_room_or_404(slug)
                 target_user = None
                 is_targeted = False
 
@@ -153,23 +201,21 @@ def send_message(request, slug):
                     except User.DoesNotExist:
                         pass
 
-                message = Message.objects.create(
-                    room=room,
-                    user=request.user,
-                    content=content,
+                message = post_message(
+                    room,
+                    request.user,
+                    content,
                     target_user=target_user,
                     is_targeted=is_targeted
                 )
-                
-                # Update room's last activity
-                room.last_activity = timezone.now()
-                room.save()
+                notify_mentions(room, message, find_mentions(room.id, content, exclude=request.user.id))
                 
                 # Return the created message data
                 return JsonResponse({
                     'status': 'success',
                     'message': {
                         'id': message.id,
+                        'seq': message.seq,
                         'content': message.content,
                         'username': message.user.username,
                         'timestamp': message.date_added.isoformat(),
@@ -184,15 +230,59 @@ def send_message(request, slug):
             
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'}, status=400)
 
+def _int_param(request, name):
+    """An optional integer query parameter; raises ValueError if it is not one."""
+    value = request.GET.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a number.') from None
+
+def _datetime_param(request, name):
+    """An optional ISO 8601 query parameter, UTC unless it says otherwise; raises ValueError if it is not one."""
+    value = request.GET.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO 8601 timestamp.') from None
+    return when if when.tzinfo else when.replace(tzinfo=dt_timezone.utc)
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=messages_etag)
 def get_messages(request, slug):
-    room = get_object_or_404(Room, slug=slug)
-    before_id = request.GET.get('before_id')
+    room = get_room_or_404(slug)
     target_user = request.GET.get('target_user')
-    
-    messages_query = Message.objects.filter(room=room)
-    if before_id:
+    try:
+        before_id = _int_param(request, 'before_id')
+        # Gap fill: after_seq/before_seq return that range oldest first
+        after_seq = _int_param(request, 'after_seq')
+        before_seq = _int_param(request, 'before_seq')
+        # Read forward, oldest first, from a (date_added, id) cursor: a
+        # jump-to-date start, then the last message of the previous page.
+        # Ids follow insertion order, not dates, across shards and imports.
+        after_date = _datetime_param(request, 'after_date')
+        after_id = _int_param(request, 'after_id')
+    except ValueError as exc:
+        return JsonResponse({'status': 'error', 'message': str(exc)}, status=400)
+    if after_id is not None and after_date is None:
+        return JsonResponse({'status': 'error', 'message': 'after_id needs after_date.'}, status=400)
+    
+    messages_query = Message.objects.for_room(room.id)
+    if before_id is not None:
         messages_query = messages_query.filter(id__lt=before_id)
+    if after_seq is not None:
+        messages_query = messages_query.filter(seq__gt=after_seq)
+    if before_seq is not None:
+        messages_query = messages_query.filter(seq__lt=before_seq)
+    if after_date is not None:
+        messages_query = messages_query.filter(
+            Q(date_added__gt=after_date) | Q(date_added=after_date, id__gt=after_id or 0)
+        )
         
     # Filter for targeted conversations if requested
     if target_user:
@@ -206,21 +296,116 @@ def get_messages(request, slug):
         except User.DoesNotExist:
             pass
     
-    messages = messages_query.order_by('-date_added')[:20]
+    messages = messages_query.annotate(
+        read_by_count=Count('read_by_users')
+    ).prefetch_related('user', 'target_user')
+    if after_seq is not None:
+        messages = messages.order_by('seq')[:100]
+    elif after_date is not None:
+        messages = messages.order_by('date_added', 'id')[:20]
+    else:
+        messages = messages.order_by('-date_added')[:20]
     
     messages_data = [{
         'id': msg.id,
+        'seq': msg.seq,
         'content': msg.content,
         'username': msg.user.username,
         'timestamp': msg.date_added.isoformat(),
         'is_read': msg.is_read,
-        'read_by_count': msg.read_by_users.count(),
+        'read_by_count': msg.read_by_count,
         'target_user': msg.target_user.username if msg.target_user else None,
         'is_targeted': msg.is_targeted
     } for msg in messages]
     
     return JsonResponse({'messages': messages_data})
 
+def _room_for_reader(request, slug):
+    """The room, or None if it is private and the user is not a participant."""
+    room = get_room_or_404(slug)
+    if room.is_private and not is_member(room.id, request.user):
+        return None
+    return room
+
+@login_required
+def jump_to_date(request, slug):
+    """Resolve ?date=YYYY-MM-DD to a cursor for the first day with messages on or after it."""
+    room = _room_for_reader(request, slug)
+    if room is None:
+        return JsonResponse({'status': 'error', 'message': "You don't have access to this room."}, status=403)
+    try:
+        day = date.fromisoformat(request.GET.get('date', ''))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Expected date=YYYY-MM-DD.'}, status=400)
+    
+    room_day = find_day(room.id, day)
+    if room_day is None:
+        return JsonResponse({'status': 'error', 'message': 'No messages on or after this date.'}, status=404)
+    return JsonResponse({
+        'status': 'success',
+        'day': room_day.day.isoformat(),
+        'message_count': room_day.message_count,
+        'first_message_id': room_day.first_message_id,
+        'last_message_id': room_day.last_message_id,
+        # Pass to get_messages as after_date to read the day from its start
+        'after_date': datetime.combine(room_day.day, dt_time.min, tzinfo=dt_timezone.utc).isoformat()
+    })
+
+@login_required
+def room_activity(request, slug):
+    """Messages per day over the last ?days=N days (default 30, at most 366)."""
+    room = _room_for_reader(request, slug)
+    if room is None:
+        return JsonResponse({'status': 'error', 'message': "You don't have access to this room."}, status=403)
+    try:
+        days = min(max(int(request.GET.get('days', 30)), 1), 366)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'days must be a number.'}, status=400)
+    
+    end = timezone.now().date()
+    return JsonResponse({
+        'status': 'success',
+        'days': activity_histogram(room.id, end - timedelta(days=days - 1), end)
+    })
+
+@login_required
+def room_analytics(request, slug):
+    """Hourly messages, active senders and DM ratio over the last ?hours=N hours (room creator or staff)."""
+    room = get_room_or_404(slug)
+    if request.user.id != room.created_by_id and not request.user.is_staff:
+        return JsonResponse({'status': 'error', 'message': 'You do not have permission to view analytics for this room.'}, status=403)
+    try:
+        hours = min(max(int(request.GET.get('hours', 24)), 1), 24 * 90)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'hours must be a number.'}, status=400)
+    
+    end = timezone.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return JsonResponse({
+        'status': 'success',
+        'hours': [{
+            'hour': row.hour.isoformat(),
+            'messages': row.message_count,
+            'senders': row.sender_count,
+            'dm_ratio': round(row.dm_ratio, 4)
+        } for row in room_hours(room.id, end - timedelta(hours=hours), end)]
+    })
+
+@login_required
+def export_transcript(request, slug):
+    """Stream the full room transcript as NDJSON or CSV (room creator or staff)."""
+    room = get_room_or_404(slug)
+    if request.user.id != room.created_by_id and not request.user.is_staff:
+        return JsonResponse({'status': 'error', 'message': 'You do not have permission to export this room.'}, status=403)
+    
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'status': 'error', 'message': 'Unsupported export format.'}, status=400)
+    
+    content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(iter_transcript(room, export_format), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{room.slug}.{export_format}"'
+    return response
+
 @login_required
 def handle_invitation(request, code):
     invitation = get_object_or_404(Invitation, code=code)
@@ -278,8 +463,8 @@ def handle_invitation(request, code):
 @login_required
 def invite_by_username(request, room_slug):
     if request.method == 'POST':
-        room = get_object_or_404(Room, slug=room_slug)
-        if request.user != room.created_by and not room.participants.filter(id=request.user.id).exists():
+        room = get_room_or_404(room_slug)
+        if request.user.id != room.created_by_id and not is_member(room.id, request.user):
             return JsonResponse({'status': 'error', 'message': 'You do not have permission to invite users to this room.'})
 
         data = json.loads(request.body)
@@ -290,7 +475,7 @@ def invite_by_username(request, room_slug):
                 room=room,
                 invited_by=request.user,
                 status='pending',
-                expires_at=timezone.now() + timezone.timedelta(days=7)
+                expires_at=timezone.now() + INVITATION_LIFETIME
             )
             
             invite_url = reverse('handle_invitation', kwargs={'code': str(invitation.code)})
@@ -308,7 +493,7 @@ def invite_by_username(request, room_slug):
         try:
             invited_user = User.objects.get(username=username)
             
-            if room.participants.filter(id=invited_user.id).exists():
+            if is_member(room.id, invited_user):
                 return JsonResponse({'status': 'error', 'message': f'{username} is already in this room.'})
             
             if Invitation.objects.filter(room=room, invited_user=invited_user, status='pending').exists():
@@ -319,7 +504,7 @@ def invite_by_username(request, room_slug):
                 invited_by=request.user,
                 invited_user=invited_user,
                 status='pending',
-                expires_at=timezone.now() + timezone.timedelta(days=7)
+                expires_at=timezone.now() + INVITATION_LIFETIME
             )
 
             return JsonResponse({
@@ -337,15 +522,79 @@ def invite_by_username(request, room_slug):
 
     return JsonResponse({'status': 'error', 'message': 'Invalid request method.'})
 
+@login_required
+def bulk_invite_by_username(request, room_slug):
+    """View for inviting a list of usernames to a room in one request."""
+    if request.method == 'POST':
+        room = get_room_or_404(room_slug)
+        if request.user.id != room.created_by_id and not is_member(room.id, request.user):
+            return JsonResponse({'status': 'error', 'message': 'You do not have permission to invite users to this room.'}, status=403)
+
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
+
+        usernames = data.get('usernames')
+        if not isinstance(usernames, list) or not usernames:
+            return JsonResponse({'status': 'error', 'message': 'A list of usernames is required.'}, status=400)
+        if len(usernames) > MAX_BULK_INVITES:
+            return JsonResponse({'status': 'error', 'message': f'At most {MAX_BULK_INVITES} usernames per request.'}, status=400)
+
+        result = bulk_invite(room, request.user, [str(username) for username in usernames])
+        return JsonResponse({
+            'status': 'success',
+            'message': f'Invitations sent to {len(result["invited"])} user(s).',
+            **result
+        })
+
+    return JsonResponse({'status': 'error', 'message': 'Invalid request method.'}, status=400)
+
+@login_required
+def manage_members(request, slug):
+    """View for adding and removing room members in bulk (room creator only)."""
+    if request.method == 'POST':
+        room = get_room_or_404(slug)
+        if request.user.id != room.created_by_id:
+            return JsonResponse({'status': 'error', 'message': 'Only room creator can manage members.'}, status=403)
+
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
+
+        if not isinstance(data, dict):
+            return JsonResponse({'status': 'error', 'message': 'Expected a JSON object.'}, status=400)
+        add_usernames = data.get('add', [])
+        remove_usernames = data.get('remove', [])
+        if not all(
+            isinstance(usernames, list) and all(isinstance(username, str) for username in usernames)
+            for usernames in (add_usernames, remove_usernames)
+        ):
+            return JsonResponse({'status': 'error', 'message': 'add and remove must be lists of usernames.'}, status=400)
+
+        user_ids = resolve_usernames(add_usernames + remove_usernames)
+        added = add_members(room, [user_ids[name] for name in add_usernames if name in user_ids])
+        removed = remove_members(room, [user_ids[name] for name in remove_usernames if name in user_ids])
+
+        return JsonResponse({
+            'status': 'success',
+            'added': added,
+            'removed': removed,
+            'not_found': sorted(set(add_usernames + remove_usernames) - set(user_ids))
+        })
+
+    return JsonResponse({'status': 'error', 'message': 'Invalid request method.'}, status=400)
+
 @login_required
 def leave_room(request, slug):
-    room = get_object_or_404(Room, slug=slug)
+    room = get_room_or_404(slug)
     
-    if request.user == room.created_by:
+    if request.user.id == room.created_by_id:
         messages.error(request, 'Room creator cannot leave the room.')
         return redirect('room', slug=slug)
     
-    if request.user in room.participants.all():
+    if is_member(room.id, request.user):
         room.participants.remove(request.user)
         messages.success(request, f'You have left the room: {room.name}')
     
@@ -353,9 +602,9 @@ def leave_room(request, slug):
 
 @login_required
 def delete_room(request, slug):
-    room = get_object_or_404(Room, slug=slug)
+    room = get_room_or_404(slug)
     
-    if request.user != room.created_by:
+    if request.user.id != room.created_by_id:
         messages.error(request, 'Only room creator can delete the room.')
         return redirect('room', slug=slug)
     
@@ -369,19 +618,30 @@ def delete_room(request, slug):
 
 @login_required
 def room_settings(request, slug):
-    room = get_object_or_404(Room, slug=slug)
+    room = get_room_or_404(slug)
     
-    if request.user != room.created_by:
+    if request.user.id != room.created_by_id:
         messages.error(request, 'Only room creator can modify settings.')
         return redirect('room', slug=slug)
     
     if request.method == 'POST':
         name = request.POST.get('name', '').strip()
         is_private = request.POST.get('is_private') == 'on'
+        # Retention only changes when the form sends it; empty keeps messages forever
+        retention_days = request.POST.get('message_retention_days')
+        if retention_days is not None:
+            retention_days = retention_days.strip()
+            if retention_days and not (retention_days.isascii() and retention_days.isdigit()):
+                return JsonResponse(
+                    {'status': 'error', 'message': 'message_retention_days must be a number of days.'}, status=400
+                )
+            retention_days = int(retention_days) if retention_days else None
         
         if name:
             room.name = name
             room.is_private = is_private
+            if 'message_retention_days' in request.POST:
+                room.message_retention_days = retention_days
             room.save()
             messages.success(request, 'Room settings updated successfully.')
             return redirect('room', slug=room.slug)
@@ -411,16 +671,17 @@ def search_users(request):
 def my_invitations(request):
     """View for displaying user's pending invitations."""
     invitations = Invitation.objects.filter(
+        not_expired(timezone.now()),
         invited_user=request.user,
         status='pending'
-    ).select_related('room', 'inviting_user')
+    ).select_related('room', 'invited_by')
     
     # Return JSON response for AJAX requests
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         invitations_data = [{
             'code': str(inv.code),
             'room_name': inv.room.name,
-            'invited_by': inv.inviting_user.username,
+            'invited_by': inv.invited_by.username,
             'created_at': inv.created_at.isoformat()
         } for inv in invitations]
         return JsonResponse({'invitations': invitations_data})